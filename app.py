@@ -2,11 +2,8 @@ import os
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
 from dotenv import load_dotenv
 import json
-from functools import lru_cache
 from pathlib import Path
 import pandas as pd
-import plotly
-import plotly.express as px
 from datetime import datetime, timedelta
 import calendar
 import base64
@@ -21,17 +18,26 @@ DEV_MODE = True  # Bật development mode để tự động reload
 
 # Import các hàm logic
 from logic import (
-    import_from_gsheet, create_demo_data,
-    get_daily_activity, get_overall_calendar_day_info,
+    create_demo_data,
+    get_daily_activity,
     extract_booking_info_from_image_content,
     export_data_to_new_sheet,
     append_multiple_bookings_to_sheet,
     delete_booking_by_id, update_row_in_gsheet,
-    prepare_dashboard_data, delete_row_in_gsheet,
+    prepare_dashboard_data, delete_row_in_gsheet, RevenueCube, dashboard_day_range,
     delete_multiple_rows_in_gsheet,
     import_message_templates_from_gsheet,
     export_message_templates_to_gsheet
 )
+from booking_store import BookingStore
+from result_cache import VersionedLRUCache
+from charts import chart_json, collected_vs_uncollected_chart, collector_revenue_chart, monthly_revenue_chart
+from occupancy import (
+    OVERBOOKING_POLICY, DailySeries, NightlyRevenue, PropertyOccupancy, StayIndex, StayTimeline, audit_overbookings,
+    check_new_stays, describe_overbookings, find_available_checkins, get_calendar_occupancy
+)
+from write_queue import WRITE_BEHIND_ENABLED, WriteBehindQueue
+from sheets_quota import scheduler as sheets_scheduler
 
 # Cấu hình
 BASE_DIR = Path(__file__).resolve().parent
@@ -60,27 +66,85 @@ GCP_CREDS_FILE_PATH = os.getenv("GCP_CREDS_FILE_PATH")
 DEFAULT_SHEET_ID = os.getenv("DEFAULT_SHEET_ID")
 WORKSHEET_NAME = os.getenv("WORKSHEET_NAME")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-TOTAL_HOTEL_CAPACITY = 4
+# Tổng số phòng của tất cả chỗ nghỉ (sức chứa từng chỗ nghỉ: PROPERTY_CAPACITIES, xem occupancy.py)
+TOTAL_HOTEL_CAPACITY = int(os.getenv("TOTAL_HOTEL_CAPACITY", "4"))
+# Sau bao nhiêu giây thì dữ liệu được coi là cũ và làm mới ở nền (-1 để tắt)
+BOOKINGS_TTL_SECONDS = float(os.getenv("BOOKINGS_TTL_SECONDS", "300"))
 
 # --- Khởi tạo ---
 if GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
 
 # --- Hàm chính để tải dữ liệu ---
-@lru_cache(maxsize=1)
+# BookingStore giữ dữ liệu trong bộ nhớ và chỉ đồng bộ phần thay đổi (delta).
+booking_store = BookingStore(DEFAULT_SHEET_ID, GCP_CREDS_FILE_PATH, WORKSHEET_NAME,
+                             ttl_seconds=BOOKINGS_TTL_SECONDS)
+# Hàng đợi ghi trễ (tùy chọn): ghi nhận thay đổi ngay, đẩy lên sheet theo lô ở nền.
+write_queue = None
+if WRITE_BEHIND_ENABLED:
+    write_queue = WriteBehindQueue(DEFAULT_SHEET_ID, GCP_CREDS_FILE_PATH, WORKSHEET_NAME)
+    booking_store.set_pending_overlay(write_queue.pending_ops)
+    write_queue.start()
+# Kết quả dựng sẵn của dashboard theo (phiên bản dữ liệu, khoảng ngày, sắp xếp).
+dashboard_cache = VersionedLRUCache('dashboard')
+_demo_frames = None  # Dữ liệu demo được giữ lại cho tới lần "Đồng bộ" tiếp theo
+
 def load_data():
-    print("Đang tải dữ liệu đặt phòng từ nguồn...")
+    global _demo_frames
+    if _demo_frames is not None:
+        return _demo_frames
     try:
-        df = import_from_gsheet(DEFAULT_SHEET_ID, GCP_CREDS_FILE_PATH, WORKSHEET_NAME)
+        df, active_bookings = booking_store.get_frames()
         if df.empty:
             raise ValueError("Sheet đặt phòng trống hoặc không thể truy cập.")
-        active_bookings = df[df['Tình trạng'] != 'Đã hủy'].copy()
-        print("Tải dữ liệu từ Google Sheet thành công!")
         return df, active_bookings
     except Exception as e:
         print(f"Lỗi tải dữ liệu đặt phòng: {e}. Dùng dữ liệu demo.")
-        df_demo, active_bookings_demo = create_demo_data()
-        return df_demo, active_bookings_demo
+        _demo_frames = create_demo_data()
+        return _demo_frames
+
+def load_derived(key, builder, updater=None):
+    """
+    Cấu trúc dẫn xuất từ dữ liệu đặt phòng, được giữ lại cho tới khi dữ liệu đổi
+    (hoặc được cập nhật tại chỗ bằng updater khi sửa/xóa/thêm booking).
+    """
+    df, _ = load_data()
+    if _demo_frames is not None:
+        return builder(df)
+    return booking_store.derived(key, builder, updater, df=df)
+
+def overbooking_check(bookings, replaced_ids=None) -> bool:
+    """
+    Kiểm tra vượt sức chứa trước khi ghi. Có xung đột thì cảnh báo (hoặc chặn nếu
+    OVERBOOKING_POLICY=block). Trả về False nếu không được ghi.
+    """
+    df, _ = load_data()
+    try:
+        conflicts = check_new_stays(df, bookings, replaced_ids)
+    except Exception as e:
+        print(f"Không kiểm tra được trùng phòng: {e}")
+        return True
+    if not conflicts:
+        return True
+    message = describe_overbookings(conflicts)
+    if OVERBOOKING_POLICY == 'block':
+        flash(f'Không lưu vì vượt sức chứa: {message}', 'danger')
+        return False
+    flash(f'Cảnh báo vượt sức chứa: {message}', 'warning')
+    return True
+
+@app.context_processor
+def inject_data_age():
+    age = booking_store.age_seconds()
+    if age is None:
+        age_text = None
+    elif age < 60:
+        age_text = "vừa xong"
+    elif age < 3600:
+        age_text = f"{int(age // 60)} phút trước"
+    else:
+        age_text = f"{int(age // 3600)} giờ trước"
+    return dict(data_age_seconds=age, data_age_text=age_text)
 
 # --- CÁC ROUTE CỦA ỨNG DỤNG ---
 
@@ -100,12 +164,37 @@ def dashboard():
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
 
-    df, _ = load_data()
-    
-    # Gọi hàm logic với các tham số sắp xếp
     sort_by = request.args.get('sort_by', 'Tháng')
     sort_order = request.args.get('sort_order', 'desc')
-    dashboard_data = prepare_dashboard_data(df, start_date, end_date, sort_by, sort_order)
+
+    # Kết quả phụ thuộc phiên bản dữ liệu, tham số và ngày hôm nay (bộ lọc bỏ booking tương lai).
+    # Ngày bắt đầu mặc định có cả giờ hiện tại, nên khóa gồm cả ngày thực sự được tính.
+    start_ts = pd.Timestamp(start_date)
+    effective_start = start_ts.normalize() + pd.Timedelta(days=int(start_ts != start_ts.normalize()))
+    cache_key = (start_date.date(), effective_start.date(), end_date.date(), sort_by, sort_order,
+                 datetime.today().date())
+    # load_data() trước: nó có thể đồng bộ lại hoặc nạp snapshot của worker khác,
+    # làm tăng phiên bản; khóa phải là phiên bản của dữ liệu sẽ được dùng để dựng.
+    load_data()
+    version = booking_store.version
+    if _demo_frames is not None:
+        context = build_dashboard_context(start_date, end_date, sort_by, sort_order)
+    else:
+        context = dashboard_cache.get_or_build(
+            version, cache_key, lambda: build_dashboard_context(start_date, end_date, sort_by, sort_order))
+    return render_template('dashboard.html', **context)
+
+def build_dashboard_context(start_date, end_date, sort_by, sort_order) -> dict:
+    """
+    Toàn bộ dữ liệu cho template dashboard (số liệu, bảng, biểu đồ).
+    """
+    df, _ = load_data()
+    
+    revenue_cube = load_derived('revenue_cube', RevenueCube.from_dataframe, RevenueCube.updated)
+    dashboard_data = prepare_dashboard_data(df, start_date, end_date, sort_by, sort_order, cube=revenue_cube)
+    # Doanh thu ghi nhận theo đêm ở, ADR, RevPAR và công suất của từng chỗ nghỉ
+    nightly_revenue = load_derived('nightly_revenue', NightlyRevenue.from_dataframe)
+    property_performance_list = nightly_revenue.summary(*dashboard_day_range(start_date, end_date))
 
     # Chuẩn bị dữ liệu cho template
     monthly_revenue_list = dashboard_data.get('monthly_revenue_all_time', pd.DataFrame()).to_dict('records')
@@ -114,297 +203,24 @@ def dashboard():
     weekly_guests_list = dashboard_data.get('weekly_guests_all_time', pd.DataFrame()).to_dict('records')
     monthly_collected_revenue_list = dashboard_data.get('monthly_collected_revenue', pd.DataFrame()).to_dict('records')
 
-    # Tạo biểu đồ doanh thu hàng tháng với thiết kế đẹp hơn
-    monthly_revenue_df = pd.DataFrame(monthly_revenue_list)
-    monthly_revenue_chart_json = {}
-    
+    # Biểu đồ: dựng spec Plotly JSON thẳng từ các bảng tổng hợp và serialize một lần
+    monthly_revenue_df = dashboard_data.get('monthly_revenue_all_time', pd.DataFrame())
+    recognized = None
     if not monthly_revenue_df.empty:
-        print(f"DEBUG: Creating chart with {len(monthly_revenue_df)} data points")
-        print(f"DEBUG: Data columns: {monthly_revenue_df.columns.tolist()}")
-        print(f"DEBUG: Sample data: {monthly_revenue_df.head()}")
-        
-        # Sắp xếp lại theo tháng để biểu đồ đường đúng thứ tự
-        monthly_revenue_df_sorted = monthly_revenue_df.sort_values('Tháng')
-        
-        # Tạo biểu đồ combo: line + bar
-        fig = px.line(monthly_revenue_df_sorted, x='Tháng', y='Doanh thu', 
-                     title='📊 Doanh thu Hàng tháng', markers=True)
-        
-        # Thêm bar chart cho cùng dữ liệu
-        fig.add_bar(x=monthly_revenue_df_sorted['Tháng'], 
-                   y=monthly_revenue_df_sorted['Doanh thu'],
-                   name='Doanh thu',
-                   opacity=0.3,
-                   yaxis='y')
-        
-        # Cải thiện layout
-        fig.update_layout(
-            title={
-                'text': '📊 Doanh thu Hàng tháng (Tất cả thời gian)', 
-                'x': 0.5,
-                'font': {'size': 18, 'family': 'Arial, sans-serif', 'color': '#2c3e50'}
-            },
-            xaxis_title='Tháng',
-            yaxis_title='Doanh thu (VND)',
-            hovermode='x unified',
-            plot_bgcolor='rgba(0,0,0,0)',
-            paper_bgcolor='rgba(0,0,0,0)',
-            font={'family': 'Arial, sans-serif', 'size': 12},
-            margin=dict(l=60, r=30, t=80, b=50),
-            height=400,
-            showlegend=True,
-            legend=dict(
-                orientation="h",
-                yanchor="bottom",
-                y=1.02,
-                xanchor="right",
-                x=1
-            )
-        )
-        
-        # Cải thiện axes
-        fig.update_xaxes(
-            showgrid=True,
-            gridwidth=1,
-            gridcolor='rgba(128,128,128,0.2)',
-            showline=True,
-            linewidth=1,
-            linecolor='rgba(128,128,128,0.5)'
-        )
-        
-        fig.update_yaxes(
-            showgrid=True,
-            gridwidth=1,
-            gridcolor='rgba(128,128,128,0.2)',
-            showline=True,
-            linewidth=1,
-            linecolor='rgba(128,128,128,0.5)',
-            tickformat=',.0f'
-        )
-        
-        # Cải thiện line traces
-        fig.update_traces(
-            line=dict(width=3, color='#3498db'),
-            marker=dict(size=8, color='#e74c3c', line=dict(width=2, color='white')),
-            selector=dict(type='scatter')
-        )
-        
-        # Cải thiện bar traces  
-        fig.update_traces(
-            marker=dict(color='#3498db', opacity=0.3),
-            selector=dict(type='bar')
-        )
-        
-        monthly_revenue_chart_json = json.loads(fig.to_json())
-        print(f"DEBUG: Chart JSON created successfully")
-    else:
-        print("DEBUG: No monthly revenue data for chart")
+        # Doanh thu trải theo đêm ở: lượt ở vắt qua hai tháng được chia cho cả hai tháng
+        recognized = nightly_revenue.monthly(datetime.strptime(monthly_revenue_df['Tháng'].min(), '%Y-%m').date(),
+                                             datetime.strptime(monthly_revenue_df['Tháng'].max(), '%Y-%m').date())
+    monthly_revenue_chart_json = chart_json(monthly_revenue_chart(monthly_revenue_df, recognized))
 
-    # Tạo biểu đồ cột doanh thu đã thu vs chưa thu
-    collected_vs_uncollected_chart_json = {}
-    
-    # Tính toán doanh thu đã thu và chưa thu
-    if not df.empty:
-        # Chuyển đổi start_date và end_date thành Timestamp để lọc
-        start_ts = pd.Timestamp(start_date)
-        end_ts = pd.Timestamp(end_date)
-        
-        # Lọc theo thời gian đã chọn
-        df_period = df[
-            (df['Check-in Date'] >= start_ts) & 
-            (df['Check-in Date'] <= end_ts) &
-            (df['Check-in Date'] <= pd.Timestamp.now())
-        ].copy()
-        
-        # Tính doanh thu đã thu (LOC LE và THAO LE)
-        collected_df = df_period[
-            df_period['Người thu tiền'].isin(['LOC LE', 'THAO LE'])
-        ].copy()
-        
-        # Tính doanh thu chưa thu (các giá trị khác hoặc rỗng)
-        uncollected_df = df_period[
-            ~df_period['Người thu tiền'].isin(['LOC LE', 'THAO LE']) |
-            df_period['Người thu tiền'].isna() |
-            (df_period['Người thu tiền'] == '')
-        ].copy()
-        
-        # Nhóm theo tháng
-        if not collected_df.empty:
-            collected_df['Month_Period'] = collected_df['Check-in Date'].dt.to_period('M')
-            collected_monthly = collected_df.groupby('Month_Period')['Tổng thanh toán'].sum().reset_index()
-            collected_monthly['Tháng'] = collected_monthly['Month_Period'].dt.strftime('%Y-%m')
-        else:
-            collected_monthly = pd.DataFrame(columns=['Tháng', 'Tổng thanh toán'])
-        
-        if not uncollected_df.empty:
-            uncollected_df['Month_Period'] = uncollected_df['Check-in Date'].dt.to_period('M')
-            uncollected_monthly = uncollected_df.groupby('Month_Period')['Tổng thanh toán'].sum().reset_index()
-            uncollected_monthly['Tháng'] = uncollected_monthly['Month_Period'].dt.strftime('%Y-%m')
-        else:
-            uncollected_monthly = pd.DataFrame(columns=['Tháng', 'Tổng thanh toán'])
-        
-        # Merge dữ liệu để có cả hai cột
-        if not collected_monthly.empty and not uncollected_monthly.empty:
-            merged_data = pd.merge(
-                collected_monthly[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Đã thu'}),
-                uncollected_monthly[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Chưa thu'}),
-                on='Tháng', how='outer'
-            ).fillna(0)
-        elif not collected_monthly.empty:
-            merged_data = collected_monthly[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Đã thu'})
-            merged_data['Chưa thu'] = 0
-        elif not uncollected_monthly.empty:
-            merged_data = uncollected_monthly[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Chưa thu'})
-            merged_data['Đã thu'] = 0
-        else:
-            merged_data = pd.DataFrame(columns=['Tháng', 'Đã thu', 'Chưa thu'])
-        
-        if not merged_data.empty:
-            # Sắp xếp theo tháng
-            merged_data = merged_data.sort_values('Tháng')
-            
-            # Tạo biểu đồ cột grouped với custom hover
-            fig_collected = px.bar(
-                merged_data, 
-                x='Tháng', 
-                y=['Đã thu', 'Chưa thu'],
-                title='💰 Doanh thu Đã thu vs Chưa thu (Theo tháng)',
-                color_discrete_map={
-                    'Đã thu': '#2ecc71',
-                    'Chưa thu': '#e74c3c'
-                },
-                text_auto=True  # Hiển thị giá trị trên cột
-            )
-            
-            # Cải thiện text hiển thị trên cột
-            fig_collected.update_traces(
-                texttemplate='%{y:,.0f}đ',
-                textposition='outside',
-                hovertemplate='<b>%{fullData.name}</b><br>' +
-                             'Tháng: %{x}<br>' +
-                             'Số tiền: %{y:,.0f}đ<br>' +
-                             '<extra></extra>'
-            )
-            
-            # Cải thiện layout
-            fig_collected.update_layout(
-                title={
-                    'text': '💰 Doanh thu Đã thu vs Chưa thu (Theo tháng)',
-                    'x': 0.5,
-                    'font': {'size': 16, 'family': 'Arial, sans-serif', 'color': '#2c3e50'}
-                },
-                xaxis_title='Tháng',
-                yaxis_title='Doanh thu (VND)',
-                plot_bgcolor='rgba(0,0,0,0)',
-                paper_bgcolor='rgba(0,0,0,0)',
-                font={'family': 'Arial, sans-serif', 'size': 12},
-                margin=dict(l=60, r=30, t=100, b=50),  # Tăng margin top cho text trên cột
-                height=450,  # Tăng chiều cao để chứa text
-                showlegend=True,
-                legend=dict(
-                    orientation="h",
-                    yanchor="bottom",
-                    y=1.02,
-                    xanchor="center",
-                    x=0.5
-                ),
-                hovermode='x unified',
-                bargap=0.6,  # Khoảng cách giữa các nhóm cột
-                bargroupgap=0.1  # Khoảng cách giữa các cột trong nhóm
-            )
-            
-            # Cải thiện axes
-            fig_collected.update_xaxes(
-                showgrid=True,
-                gridwidth=1,
-                gridcolor='rgba(128,128,128,0.2)',
-                showline=True,
-                linewidth=1,
-                linecolor='rgba(128,128,128,0.5)'
-            )
-            
-            fig_collected.update_yaxes(
-                showgrid=True,
-                gridwidth=1,
-                gridcolor='rgba(128,128,128,0.2)',
-                showline=True,
-                linewidth=1,
-                linecolor='rgba(128,128,128,0.5)',
-                tickformat=',.0f'
-            )
-            
-            collected_vs_uncollected_chart_json = json.loads(fig_collected.to_json())
-            
-            # Tạo dữ liệu bảng để hiển thị
-            collected_vs_uncollected_table_data = merged_data.to_dict('records')
-            print(f"DEBUG: Collected vs Uncollected chart created successfully")
-        else:
-            print("DEBUG: No data for collected vs uncollected chart")
-            collected_vs_uncollected_table_data = []
-
-    # Tạo biểu đồ pie chart đẹp hơn cho người thu tiền
-    collector_revenue_data = dashboard_data.get('collector_revenue_selected', pd.DataFrame()).to_dict('records')
-    
-    collector_chart_data = {
-        'data': [{
-            'type': 'pie',
-            'labels': [row['Người thu tiền'] for row in collector_revenue_data],
-            'values': [row['Tổng thanh toán'] for row in collector_revenue_data],
-            'textinfo': 'label+percent+value',
-            'textposition': 'auto',
-            'hovertemplate': '<b>%{label}</b><br>' +
-                           'Doanh thu: %{value:,.0f}đ<br>' +
-                           'Tỷ lệ: %{percent}<br>' +
-                           '<extra></extra>',
-            'marker': {
-                'colors': ['#3498db', '#e74c3c', '#2ecc71', '#f39c12', '#9b59b6', '#1abc9c'],
-                'line': {
-                    'color': '#ffffff',
-                    'width': 2
-                }
-            },
-            'hole': 0.4,  # Tạo donut chart
-            'textfont': {
-                'size': 12,
-                'family': 'Arial, sans-serif'
-            }
-        }],
-        'layout': {
-            'title': {
-                'text': '💰 Doanh thu theo Người thu tiền',
-                'x': 0.5,
-                'font': {
-                    'size': 16,
-                    'family': 'Arial, sans-serif',
-                    'color': '#2c3e50'
-                }
-            },
-            'showlegend': True,
-            'legend': {
-                'orientation': 'v',
-                'x': 1.02,
-                'y': 0.5,
-                'font': {
-                    'size': 11,
-                    'family': 'Arial, sans-serif'
-                }
-            },
-            'height': 350,
-            'margin': {'l': 20, 'r': 100, 't': 60, 'b': 20},
-            'plot_bgcolor': 'rgba(0,0,0,0)',
-            'paper_bgcolor': 'rgba(0,0,0,0)',
-            'font': {
-                'family': 'Arial, sans-serif',
-                'size': 12,
-                'color': '#2c3e50'
-            }
-        }
-    }
+    # Doanh thu đã thu và chưa thu theo tháng (tính sẵn trong prepare_dashboard_data)
+    collected_vs_uncollected = dashboard_data['collected_vs_uncollected_monthly']
+    collected_vs_uncollected_chart_json = chart_json(collected_vs_uncollected_chart(collected_vs_uncollected))
+    collected_vs_uncollected_table_data = collected_vs_uncollected.to_dict('records')
 
     collector_revenue_list = dashboard_data.get('collector_revenue_selected', pd.DataFrame()).to_dict('records')
+    collector_chart_json = chart_json(collector_revenue_chart(collector_revenue_list))
 
-    return render_template(
-        'dashboard.html',
+    return dict(
         total_revenue=dashboard_data.get('total_revenue_selected', 0),
         total_guests=dashboard_data.get('total_guests_selected', 0),
         monthly_revenue_list=monthly_revenue_list,
@@ -415,8 +231,9 @@ def dashboard():
         monthly_revenue_chart_json=monthly_revenue_chart_json,
         collected_vs_uncollected_chart_json=collected_vs_uncollected_chart_json,
         collected_vs_uncollected_table_data=collected_vs_uncollected_table_data,
-        collector_chart_json=collector_chart_data,
+        collector_chart_json=collector_chart_json,
         collector_revenue_list=collector_revenue_list,
+        property_performance_list=property_performance_list,
         start_date=start_date.strftime('%Y-%m-%d'),
         end_date=end_date.strftime('%Y-%m-%d'),
         current_sort_by=sort_by,
@@ -454,16 +271,24 @@ def view_bookings():
 @app.route('/calendar/<int:year>/<int:month>')
 def calendar_view(year=None, month=None):
     today = datetime.today()
+    selected_property = request.args.get('property') or None
     if year is None or month is None:
-        return redirect(url_for('calendar_view', year=today.year, month=today.month))
+        return redirect(url_for('calendar_view', year=today.year, month=today.month, property=selected_property))
     
     current_month_start = datetime(year, month, 1)
     prev_month_date = (current_month_start.replace(day=1) - timedelta(days=1)).replace(day=1)
     next_month_date = (current_month_start.replace(day=1) + timedelta(days=32)).replace(day=1)
 
-    df, _ = load_data()
-    month_activities = {}
+    property_occupancy = load_derived('property_occupancy', PropertyOccupancy.from_dataframe, PropertyOccupancy.updated)
     month_matrix = calendar.monthcalendar(year, month)
+    _, last_day = calendar.monthrange(year, month)
+    # Tính công suất cho cả tháng trong một lần (toàn bộ hoặc một chỗ nghỉ)
+    if selected_property:
+        month_occupancy = property_occupancy.month_grid(selected_property, year, month)
+    else:
+        timeline = load_derived('stay_timeline', StayTimeline.from_dataframe)
+        month_occupancy = get_calendar_occupancy(current_month_start.date(), datetime(year, month, last_day).date(),
+                                                 timeline, TOTAL_HOTEL_CAPACITY)
     
     calendar_data = []
     for week in month_matrix:
@@ -472,7 +297,7 @@ def calendar_view(year=None, month=None):
             if day != 0:
                 current_date = datetime(year, month, day).date()
                 date_str = current_date.strftime('%Y-%m-%d')
-                day_info = get_overall_calendar_day_info(current_date, df, TOTAL_HOTEL_CAPACITY)
+                day_info = month_occupancy[current_date]
                 week_data.append((current_date, date_str, day_info))
             else:
                 week_data.append((None, None, None))
@@ -484,9 +309,102 @@ def calendar_view(year=None, month=None):
         current_month=current_month_start,
         prev_month=prev_month_date,
         next_month=next_month_date,
-        today=today.date()
+        today=today.date(),
+        properties=property_occupancy.properties,
+        selected_property=selected_property,
+        selected_capacity=property_occupancy.capacity(selected_property) if selected_property else TOTAL_HOTEL_CAPACITY
     )
 
+@app.route('/api/occupancy/properties')
+def property_occupancy_api():
+    """
+    Heatmap công suất theo chỗ nghỉ: ?start=YYYY-MM-DD&end=YYYY-MM-DD[&property=...].
+    Mặc định là tháng hiện tại.
+    """
+    today = datetime.today().date()
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else today.replace(day=1)
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') \
+            else today.replace(day=calendar.monthrange(today.year, today.month)[1])
+    except ValueError:
+        return jsonify({'error': 'Định dạng ngày không hợp lệ (YYYY-MM-DD).'}), 400
+    if end < start or (end - start).days > 731:
+        return jsonify({'error': 'Khoảng ngày không hợp lệ (tối đa 2 năm).'}), 400
+
+    property_occupancy = load_derived('property_occupancy', PropertyOccupancy.from_dataframe, PropertyOccupancy.updated)
+    properties = request.args.getlist('property') or None
+    return jsonify(property_occupancy.heatmap(start, end, properties))
+
+@app.route('/api/occupancy/heatmap')
+def occupancy_heatmap_api():
+    """
+    Heatmap công suất và doanh thu theo ngày cho cả năm (?year=YYYY, mặc định năm nay)
+    hoặc một khoảng nhiều tháng (?start=YYYY-MM-DD&end=YYYY-MM-DD).
+    Không tính đơn đã hủy (excludes_cancelled=true), khác doanh thu của dashboard.
+    """
+    try:
+        if request.args.get('start') or request.args.get('end'):
+            start = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+            end = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+        else:
+            year = int(request.args.get('year', datetime.today().year))
+            start, end = datetime(year, 1, 1).date(), datetime(year, 12, 31).date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Cần year hoặc cả start và end (YYYY-MM-DD).'}), 400
+    if end < start or (end - start).days > 731:
+        return jsonify({'error': 'Khoảng ngày không hợp lệ (tối đa 2 năm).'}), 400
+
+    daily_series = load_derived('daily_series', DailySeries.from_dataframe)
+    return jsonify(daily_series.heatmap(start, end, TOTAL_HOTEL_CAPACITY))
+
+@app.route('/api/overbookings')
+def overbookings_api():
+    """
+    Báo cáo toàn bảng các khoảng ngày vượt sức chứa theo chỗ nghỉ.
+    """
+    return jsonify(load_derived('overbooking_audit', audit_overbookings))
+
+@app.route('/api/revenue/nightly')
+def nightly_revenue_api():
+    """
+    Doanh thu ghi nhận theo đêm ở, ADR, RevPAR và công suất theo tháng:
+    ?start=YYYY-MM-DD&end=YYYY-MM-DD[&property=...]. Mặc định là 12 tháng gần nhất.
+    Không tính đơn đã hủy (excludes_cancelled=true trong kết quả).
+    """
+    today = datetime.today().date()
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else today
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') \
+            else (end.replace(day=1) - timedelta(days=334)).replace(day=1)
+    except ValueError:
+        return jsonify({'error': 'Định dạng ngày không hợp lệ (YYYY-MM-DD).'}), 400
+    if end < start or (end - start).days > 3660:
+        return jsonify({'error': 'Khoảng ngày không hợp lệ (tối đa 10 năm).'}), 400
+
+    nightly_revenue = load_derived('nightly_revenue', NightlyRevenue.from_dataframe)
+    properties = request.args.getlist('property') or None
+    return jsonify(nightly_revenue.monthly(start, end, properties))
+
+@app.route('/api/availability')
+def availability_api():
+    """
+    Tìm ngày check-in còn trống:
+    ?start=YYYY-MM-DD&end=YYYY-MM-DD&nights=N[&property=...][&rooms=K].
+    """
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+        nights = int(request.args.get('nights', 1))
+        rooms = int(request.args.get('rooms', 1))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Cần start, end (YYYY-MM-DD) và nights (số nguyên).'}), 400
+    if end < start or (end - start).days > 731 or not 1 <= nights <= 365 or rooms < 1:
+        return jsonify({'error': 'Khoảng ngày, số đêm hoặc số phòng không hợp lệ.'}), 400
+
+    property_occupancy = load_derived('property_occupancy', PropertyOccupancy.from_dataframe, PropertyOccupancy.updated)
+    properties = request.args.getlist('property') or None
+    return jsonify(find_available_checkins(property_occupancy, start, end, nights, properties, rooms))
+
 @app.route('/calendar/details/<string:date_str>')
 def calendar_details(date_str):
     try:
@@ -495,7 +413,8 @@ def calendar_details(date_str):
         flash("Định dạng ngày không hợp lệ.", "danger")
         return redirect(url_for('calendar_view'))
     df, _ = load_data()
-    activities = get_daily_activity(parsed_date, df)
+    stay_index = load_derived('stay_index', StayIndex.from_dataframe, StayIndex.updated)
+    activities = get_daily_activity(parsed_date, df, stay_index=stay_index)
     return render_template('calendar_details.html',
                            date=parsed_date.strftime('%d/%m/%Y'),
                            check_in=activities.get('check_in', []),
@@ -523,17 +442,39 @@ def process_pasted_image():
 @app.route('/bookings/sync')
 def sync_bookings():
     """
-    Đây là nơi ĐÚNG và DUY NHẤT để gọi cache_clear.
+    Đồng bộ lại toàn bộ dữ liệu từ Google Sheets (bỏ qua fingerprint đã lưu).
     """
+    global _demo_frames
     try:
-        load_data.cache_clear()
+        _demo_frames = None
+        booking_store.invalidate(full=True)
         flash('Dữ liệu đã được đồng bộ lại từ Google Sheets.', 'info')
-        print("Cache đã được xóa thành công qua nút Đồng bộ.")
+        print("Cache đã được đánh dấu đồng bộ lại qua nút Đồng bộ.")
     except Exception as e:
         flash(f'Lỗi khi xóa cache: {e}', 'danger')
 
     return redirect(url_for('view_bookings'))
 
+@app.route('/api/data_status')
+def data_status():
+    """Trạng thái bộ nhớ đệm dữ liệu đặt phòng (phiên bản, tuổi dữ liệu, số lần gộp request...)."""
+    return jsonify({**booking_store.status(), 'sheets_api': sheets_scheduler.status(),
+                    'dashboard_cache': dashboard_cache.status()})
+
+@app.route('/api/write_queue')
+def write_queue_status():
+    """Các thao tác ghi đang chờ đẩy lên Google Sheets (khi bật WRITE_BEHIND_ENABLED)."""
+    if write_queue is None:
+        return jsonify({'enabled': False})
+    return jsonify(write_queue.status())
+
+@app.route('/api/write_queue/retry', methods=['POST'])
+def write_queue_retry():
+    """Đưa các thao tác ghi đã thất bại trở lại hàng đợi."""
+    if write_queue is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'requeued': write_queue.retry_failed()})
+
 @app.route('/bookings/export')
 def export_bookings():
     try:
@@ -570,16 +511,43 @@ def save_extracted_bookings():
                 'Tình trạng': 'OK'
             })
 
-        if formatted_bookings:
-            append_multiple_bookings_to_sheet(
-                bookings=formatted_bookings,
-                gcp_creds_file_path=GCP_CREDS_FILE_PATH,
-                sheet_id=DEFAULT_SHEET_ID,
-                worksheet_name=WORKSHEET_NAME
-            )
-            # === SỬA LỖI QUAN TRỌNG: Xóa cache sau khi thêm ===
-            load_data.cache_clear()
-            flash(f'Đã lưu thành công {len(formatted_bookings)} đặt phòng mới!', 'success')
+        if formatted_bookings and not overbooking_check(formatted_bookings):
+            return redirect(url_for('add_from_image_page'))
+
+        if formatted_bookings and write_queue is not None:
+            # Hàng đợi đối chiếu với sheet theo mã đặt phòng: booking thiếu mã không đẩy lên được.
+            without_id = [booking for booking in formatted_bookings if not booking.get('Số đặt phòng')]
+            formatted_bookings = [booking for booking in formatted_bookings if booking.get('Số đặt phòng')]
+            if without_id:
+                flash(f'Bỏ qua {len(without_id)} đặt phòng không có mã đặt phòng.', 'warning')
+            if formatted_bookings:
+                write_queue.enqueue_append(formatted_bookings)
+                booking_store.apply_append(formatted_bookings)
+                flash(f'Đã ghi nhận {len(formatted_bookings)} đặt phòng mới, đang đồng bộ lên Google Sheets.', 'success')
+        elif formatted_bookings:
+            try:
+                report = append_multiple_bookings_to_sheet(
+                    bookings=formatted_bookings,
+                    gcp_creds_file_path=GCP_CREDS_FILE_PATH,
+                    sheet_id=DEFAULT_SHEET_ID,
+                    worksheet_name=WORKSHEET_NAME
+                )
+            except Exception:
+                # Có thể một phần đã được ghi: tải lại từ sheet thay vì đoán.
+                booking_store.invalidate()
+                raise
+            # Chỉ ghi vào bộ nhớ những booking thật sự vừa được thêm lên sheet; còn
+            # lại (đã có sẵn, không có mã) thì tải lại từ sheet ở lần đọc sau.
+            appended_ids = {str(booking_id) for booking_id in report['appended'] if booking_id}
+            appended = [booking for booking in formatted_bookings
+                        if booking.get('Số đặt phòng') and str(booking['Số đặt phòng']) in appended_ids]
+            applied = booking_store.apply_append(appended) if appended else 0
+            if applied < len(formatted_bookings) or report['skipped']:
+                booking_store.invalidate()
+            if report['skipped']:
+                flash(f"Bỏ qua {len(report['skipped'])} đặt phòng đã có trên sheet: "
+                      f"{', '.join(map(str, report['skipped']))}", 'warning')
+            flash(f"Đã lưu thành công {len(report['appended'])} đặt phòng mới!", 'success')
         else:
             flash('Không có đặt phòng hợp lệ nào để lưu.', 'info')
 
@@ -603,7 +571,19 @@ def edit_booking(booking_id):
             'Tình trạng': request.form.get('Tình trạng'),
             'Người thu tiền': request.form.get('Người thu tiền'),
         }
+
+        if not overbooking_check([{**new_data, 'Số đặt phòng': booking_id}], [booking_id]):
+            return redirect(url_for('edit_booking', booking_id=booking_id))
         
+        if write_queue is not None:
+            write_queue.enqueue_update(booking_id, new_data)
+            try:
+                booking_store.apply_update(booking_id, new_data)
+            except Exception as e:
+                print(f"Không áp dụng được thay đổi vào bộ nhớ: {e}")
+            flash('Đã lưu thay đổi, đang đồng bộ lên Google Sheets.', 'success')
+            return redirect(url_for('view_bookings'))
+
         success = update_row_in_gsheet(
             sheet_id=DEFAULT_SHEET_ID,
             gcp_creds_file_path=GCP_CREDS_FILE_PATH,
@@ -613,8 +593,14 @@ def edit_booking(booking_id):
         )
         
         if success:
-            # Xóa cache để tải lại dữ liệu mới
-            load_data.cache_clear()
+            # Ghi thẳng vào dữ liệu trong bộ nhớ, không cần tải lại từ sheet
+            try:
+                applied = booking_store.apply_update(booking_id, new_data)
+            except Exception as e:
+                print(f"Không áp dụng được thay đổi vào bộ nhớ: {e}")
+                applied = False
+            if not applied:
+                booking_store.invalidate()
             flash('Đã cập nhật đặt phòng thành công!', 'success')
         else:
             flash('Có lỗi xảy ra khi cập nhật đặt phòng trên Google Sheet.', 'danger')
@@ -625,6 +611,12 @@ def edit_booking(booking_id):
 
 @app.route('/booking/<booking_id>/delete', methods=['POST'])
 def delete_booking(booking_id):
+    if write_queue is not None:
+        write_queue.enqueue_delete([booking_id])
+        booking_store.apply_delete([booking_id])
+        flash(f'Đã xóa đặt phòng có ID: {booking_id}, đang đồng bộ lên Google Sheets.', 'success')
+        return redirect(url_for('view_bookings'))
+
     success = delete_row_in_gsheet(
         sheet_id=DEFAULT_SHEET_ID,
         gcp_creds_file_path=GCP_CREDS_FILE_PATH,
@@ -634,7 +626,8 @@ def delete_booking(booking_id):
     
     if success:
         flash(f'Đã xóa thành công đặt phòng có ID: {booking_id}', 'success')
-        load_data.cache_clear() # Xóa cache sau khi sửa đổi
+        if not booking_store.apply_delete([booking_id]):
+            booking_store.invalidate()
     else:
         flash('Lỗi khi xóa đặt phòng.', 'danger')
     return redirect(url_for('view_bookings'))
@@ -648,17 +641,34 @@ def delete_multiple_bookings():
         return jsonify({'success': False, 'message': 'Không có ID nào được cung cấp.'})
 
     try:
-        success = delete_multiple_rows_in_gsheet(
+        if write_queue is not None:
+            op_id = write_queue.enqueue_delete(ids_to_delete)
+            booking_store.apply_delete(ids_to_delete)
+            # Đẩy ngay để báo đúng mã nào đã xóa / không có trên sheet. Nếu lô chưa
+            # đẩy được (lỗi, hoặc phải chờ thao tác cũ hơn) thì báo là đang chờ.
+            result = write_queue.flush()
+            if result.get('success') and op_id in result['op_ids']:
+                missing = set(result['missing_deletes'])
+                return jsonify({
+                    'success': True,
+                    'deleted': [i for i in ids_to_delete if i not in missing],
+                    'missing': [i for i in ids_to_delete if i in missing],
+                })
+            return jsonify({'success': True, 'queued': True, 'deleted': [], 'missing': [],
+                            'pending': ids_to_delete})
+
+        report = delete_multiple_rows_in_gsheet(
             sheet_id=DEFAULT_SHEET_ID,
             gcp_creds_file_path=GCP_CREDS_FILE_PATH,
             worksheet_name=WORKSHEET_NAME,
             booking_ids=ids_to_delete
         )
-        if success:
-            load_data.cache_clear() # Xóa cache sau khi sửa đổi
-            return jsonify({'success': True})
+        if report['success']:
+            if report['deleted'] and not booking_store.apply_delete(report['deleted']):
+                booking_store.invalidate()
+            return jsonify(report)
         else:
-            return jsonify({'success': False, 'message': 'Lỗi khi xóa dữ liệu trên Google Sheets.'})
+            return jsonify({**report, 'message': 'Lỗi khi xóa dữ liệu trên Google Sheets.'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
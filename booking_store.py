@@ -0,0 +1,653 @@
+import os
+import atexit
+import datetime
+import hashlib
+import threading
+import weakref
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import pandas as pd
+
+from logic import (
+    add_derived_columns, build_bookings_dataframe, bytes_per_row, concat_booking_frames,
+    fetch_sheet_values, get_sheet_revision, invalidate_row_index, last_schema_report,
+    refresh_row_index_from_values, row_index_generation, update_booking_row, without_derived_columns
+)
+from data_snapshot import SharedVersionCounter, load_snapshot
+from sheets_quota import background_priority
+
+# ==============================================================================
+# BỘ NHỚ ĐỆM ĐẶT PHÒNG VỚI ĐỒNG BỘ DELTA
+# ==============================================================================
+# Thay cho lru_cache(maxsize=1) + cache_clear(): BookingStore giữ DataFrame trong
+# bộ nhớ cùng với "dấu vân tay" (fingerprint) của từng hàng thô trên sheet.
+#
+# - Trước khi tải lại, so sánh modifiedTime của spreadsheet: nếu không đổi thì
+#   giữ nguyên dữ liệu, không tải gì thêm.
+# - Khi sheet có thay đổi, chỉ những hàng có fingerprint mới mới được parse lại;
+#   các hàng không đổi được lấy lại từ DataFrame cũ.
+# - Worker mới khởi động đọc snapshot trên đĩa (data_snapshot.py) rồi kiểm tra
+#   lại với sheet ở thread nền, nên request đầu tiên không phải chờ tải sheet.
+# - Các worker dùng chung một bộ đếm phiên bản (SharedVersionCounter). Mỗi
+#   request chỉ đọc bộ đếm; nếu worker khác đã đổi dữ liệu thì nạp snapshot
+#   tương ứng, nếu worker khác vừa invalidate thì tự đồng bộ lại với sheet.
+# - Stale-while-revalidate: dữ liệu quá TTL vẫn được trả về ngay, trong khi một
+#   thread nền (duy nhất) kiểm tra lại với sheet. Request không phải chờ tải.
+# - Single-flight: khi nhiều request cùng thiếu dữ liệu (ví dụ ngay sau khi
+#   invalidate), chỉ một lần đồng bộ thật sự chạy, các request khác chờ kết quả.
+# - Write-through: sau khi ghi thành công lên sheet, cùng thay đổi đó được áp
+#   dụng trực tiếp vào DataFrame thay vì tải lại. Sửa một booking chỉ sao chép
+#   các cột bị sửa; snapshot dùng chung được ghi lại sau
+#   SNAPSHOT_PUBLISH_DELAY_SECONDS (gộp nhiều lần ghi liền nhau) ở thread nền,
+#   không giữ khóa trong lúc ghi file.
+# - Khi bật hàng đợi ghi trễ (write_queue.py), các thay đổi chưa được đẩy lên
+#   sheet được áp lại sau mỗi lần đồng bộ để không "biến mất" tạm thời.
+
+ID_COLUMN = 'Số đặt phòng'
+# Fingerprint của hàng vừa ghi cục bộ: không khớp với hàng nào trên sheet nên
+# lần đồng bộ sau sẽ parse lại đúng giá trị mà sheet lưu (sau USER_ENTERED).
+LOCAL_WRITE_FINGERPRINT = 0
+# Thời gian gộp các lần ghi cục bộ trước khi ghi lại snapshot cho worker khác (0: ghi ngay).
+SNAPSHOT_PUBLISH_DELAY_SECONDS = float(os.getenv("SNAPSHOT_PUBLISH_DELAY_SECONDS", "1"))
+
+# Các store còn sống; một hook atexit duy nhất công bố thay đổi còn treo của
+# chúng (tham chiếu yếu nên không giữ store lại sau khi hết dùng).
+_stores: "weakref.WeakSet[BookingStore]" = weakref.WeakSet()
+
+
+def _flush_all_publishes() -> None:
+    for store in list(_stores):
+        store.flush_publish()
+
+
+atexit.register(_flush_all_publishes)
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi đồng thời có cùng key thành một lần thực thi duy nhất.
+    Người gọi đến sau sẽ chờ và nhận cùng kết quả (hoặc cùng exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, 'SingleFlight._Call'] = {}
+        self.stats = {'calls': 0, 'executions': 0, 'collapsed': 0, 'errors': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.stats['collapsed'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = SingleFlight._Call()
+                self.stats['executions'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def row_fingerprint(row) -> int:
+    """
+    Fingerprint 64-bit ổn định giữa các process (khác với hash() của Python),
+    để có thể lưu cùng snapshot.
+    """
+    digest = hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class BookingStore:
+    """
+    Giữ DataFrame đặt phòng trong bộ nhớ và đồng bộ theo delta với Google Sheet.
+    """
+
+    def __init__(self, sheet_id: str, gcp_creds_file_path: str, worksheet_name: str | None = None,
+                 shared_version: SharedVersionCounter | None = None, ttl_seconds: float = 300,
+                 publish_delay: float = SNAPSHOT_PUBLISH_DELAY_SECONDS):
+        self.sheet_id = sheet_id
+        self.gcp_creds_file_path = gcp_creds_file_path
+        self.worksheet_name = worksheet_name
+        self.ttl_seconds = ttl_seconds
+        self.publish_delay = publish_delay
+
+        # _lock bảo vệ trạng thái trong bộ nhớ; _sync_lock đảm bảo chỉ một lần
+        # đồng bộ chạy tại một thời điểm và không giữ _lock trong lúc gọi mạng.
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._df: Optional[pd.DataFrame] = None
+        self._active: Optional[pd.DataFrame] = None
+        self._header: Optional[tuple] = None
+        # Fingerprint của hàng thô tương ứng với từng dòng của self._df.
+        self._fingerprints: List[int] = []
+        self._revision: Optional[str] = None
+        self._dirty = False
+        self._invalidation_gen = 0
+        self._refreshing = False
+        self._shared = shared_version if shared_version is not None else SharedVersionCounter()
+        self._seen_shared_version: Optional[int] = None
+        self._flight = SingleFlight()
+        # Cấu trúc dẫn xuất (timeline, chỉ mục...) theo từng DataFrame, xem derived().
+        self._derived: Dict[Hashable, tuple] = {}
+        # Hàm trả về các thao tác ghi đang chờ đẩy lên sheet (xem set_pending_overlay).
+        self._pending_overlay: Optional[Callable[[], List[dict]]] = None
+        # Có thay đổi cục bộ chưa được công bố qua snapshot (xem _schedule_publish).
+        self._publish_pending = False
+        self._publish_timer: Optional[threading.Timer] = None
+
+        self.version = 0
+        self.loaded_at: Optional[datetime.datetime] = None
+        # Lần cuối dữ liệu được xác nhận khớp với sheet (kể cả khi không đổi).
+        self.checked_at: Optional[datetime.datetime] = None
+        self.stats = {'full_loads': 0, 'delta_syncs': 0, 'unchanged_checks': 0,
+                      'rows_reparsed': 0, 'rows_reused': 0, 'snapshot_loads': 0,
+                      'remote_invalidations': 0, 'stale_served': 0, 'local_writes': 0,
+                      'snapshot_publishes': 0}
+        _stores.add(self)
+
+    # --------------------------------------------------------------------------
+    # Đọc dữ liệu
+    # --------------------------------------------------------------------------
+
+    def get(self) -> pd.DataFrame:
+        """
+        Trả về DataFrame hiện tại. Chỉ chặn request khi chưa có dữ liệu hoặc bị
+        đánh dấu dirty; dữ liệu quá TTL được trả về ngay và làm mới ở nền.
+        """
+        with self._lock:
+            self._check_shared_version()
+            needs_sync = self._df is None or self._dirty
+            stale = not needs_sync and self.is_stale()
+
+        if needs_sync:
+            try:
+                self.coalesced_sync()
+            except Exception as e:
+                if self._df is None:
+                    raise
+                print(f"Đồng bộ thất bại, tiếp tục dùng dữ liệu đang có: {e}")
+        elif stale:
+            self.stats['stale_served'] += 1
+            self.refresh_in_background()
+        return self._df
+
+    def get_frames(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Trả về (df, active_bookings). active_bookings chỉ được tính lại khi dữ liệu đổi.
+        """
+        df = self.get()
+        with self._lock:
+            if self._active is None or self._df is not df:
+                df = self._df
+                self._active = df[df['Tình trạng'] != 'Đã hủy'].copy() if 'Tình trạng' in df.columns else df.copy()
+            return df, self._active
+
+    def derived(self, key: Hashable, builder: Callable[[pd.DataFrame], Any],
+                updater: Optional[Callable[[Any, dict, pd.DataFrame], Any]] = None,
+                df: Optional[pd.DataFrame] = None) -> Any:
+        """
+        Trả về builder(df) cho dữ liệu hiện tại, chỉ tính lại khi dữ liệu đổi.
+        Nếu có updater, các thay đổi tại chỗ (apply_*) gọi
+        updater(giá_trị_cũ, change, df_mới) thay vì dựng lại bằng builder;
+        change = {'kind': 'update'|'delete'|'append', 'positions': [...]}.
+        Truyền df (đã lấy từ get()) để chắc chắn kết quả khớp đúng DataFrame đó.
+        Kết quả phải được coi là chỉ đọc.
+        """
+        if df is None:
+            df = self.get()
+        with self._lock:
+            entry = self._derived.get(key)
+            if entry is not None and entry[0] is df:
+                return entry[1]
+        value = builder(df)
+        with self._lock:
+            if self._df is df:
+                self._derived[key] = (df, value, updater)
+        return value
+
+    def _update_derived(self, old_df: Optional[pd.DataFrame], change: dict):
+        for key, (df, value, updater) in list(self._derived.items()):
+            if df is not old_df or updater is None:
+                del self._derived[key]
+                continue
+            try:
+                self._derived[key] = (self._df, updater(value, change, self._df), updater)
+            except Exception as e:
+                print(f"Không cập nhật được dữ liệu dẫn xuất '{key}', sẽ dựng lại: {e}")
+                del self._derived[key]
+
+    def age_seconds(self) -> Optional[float]:
+        """
+        Số giây kể từ lần cuối dữ liệu được xác nhận với sheet (None nếu chưa tải).
+        """
+        if self.checked_at is None:
+            return None
+        return (datetime.datetime.now() - self.checked_at).total_seconds()
+
+    def is_stale(self) -> bool:
+        age = self.age_seconds()
+        return self.ttl_seconds is not None and self.ttl_seconds >= 0 and age is not None and age > self.ttl_seconds
+
+    def invalidate(self, full: bool = False):
+        """
+        Đánh dấu dữ liệu cần đồng bộ lại ở lần đọc tiếp theo.
+        full=True bỏ toàn bộ fingerprint để parse lại từ đầu (nút "Đồng bộ").
+        """
+        with self._lock:
+            self._dirty = True
+            self._invalidation_gen += 1
+            self._revision = None
+            # Báo cho các worker khác biết dữ liệu của họ đã cũ.
+            self._seen_shared_version = self._shared.bump()
+            if full:
+                self._fingerprints = []
+                self._header = None
+
+    # --------------------------------------------------------------------------
+    # Snapshot trên đĩa và phiên bản dùng chung giữa các worker
+    # --------------------------------------------------------------------------
+
+    def _check_shared_version(self):
+        current = self._shared.read()
+        if current == self._seen_shared_version:
+            return
+        cold_start = self._df is None
+        self._seen_shared_version = current
+        # Worker khác đã ghi (có thể đã xóa hàng): số hàng trong chỉ mục không còn đáng tin.
+        invalidate_row_index(self.sheet_id, self.worksheet_name)
+        if self._publish_pending and not cold_start:
+            # Đang có thay đổi cục bộ chưa công bố: nạp snapshot của worker khác sẽ làm
+            # mất nó, nên đồng bộ lại với sheet (đã có cả hai thay đổi) rồi mới công bố.
+            self.stats['remote_invalidations'] += 1
+            self._dirty = True
+            return
+
+        snapshot = load_snapshot(self._shared.path.parent)
+        if snapshot is not None:
+            df, fingerprints, meta = snapshot
+            if (meta.get('data_version') == current and meta.get('sheet_id') == self.sheet_id
+                    and meta.get('worksheet_name') == self.worksheet_name):
+                # Cột dẫn xuất không được lưu trong snapshot, tính lại khi nạp.
+                self._df = add_derived_columns(df)
+                self._header = tuple(meta['header']) if meta.get('header') else None
+                self._fingerprints = fingerprints
+                self._revision = meta.get('revision')
+                self._dirty = False
+                self.stats['snapshot_loads'] += 1
+                self._bump()
+                self.checked_at = datetime.datetime.fromisoformat(meta['saved_at']) if meta.get('saved_at') else None
+                print(f"Đã nạp {len(df)} đặt phòng từ snapshot v{current} ({meta.get('saved_at')}).")
+                if cold_start:
+                    self.refresh_in_background()
+                return
+
+        # Worker khác đã invalidate nhưng chưa có snapshot mới: tự đồng bộ với sheet.
+        if not cold_start:
+            self.stats['remote_invalidations'] += 1
+            self._dirty = True
+
+    def _snapshot_meta(self) -> dict:
+        return {
+            'sheet_id': self.sheet_id,
+            'worksheet_name': self.worksheet_name,
+            'header': list(self._header) if self._header else None,
+            'revision': self._revision,
+        }
+
+    def _publish_snapshot(self):
+        self._publish_pending = False
+        self.stats['snapshot_publishes'] += 1
+        self._seen_shared_version = self._shared.publish_snapshot(
+            without_derived_columns(self._df), self._fingerprints, self._snapshot_meta())
+
+    def _schedule_publish(self):
+        """
+        Công bố snapshot sau publish_delay giây, gộp các lần ghi liền nhau thành
+        một lần ghi file. Gọi khi đang giữ self._lock.
+        """
+        self._publish_pending = True
+        if self.publish_delay <= 0:
+            self.flush_publish()
+            return
+        if self._publish_timer is None:
+            self._publish_timer = threading.Timer(self.publish_delay, self.flush_publish)
+            self._publish_timer.daemon = True
+            self._publish_timer.start()
+
+    def flush_publish(self):
+        """
+        Công bố ngay các thay đổi cục bộ đang chờ. File snapshot được ghi ngoài
+        self._lock (DataFrame không bao giờ bị sửa tại chỗ nên đọc an toàn).
+        """
+        with self._lock:
+            self._publish_timer = None
+            if not self._publish_pending:
+                return
+            self._publish_pending = False
+            df, fingerprints, meta = self._df, list(self._fingerprints), self._snapshot_meta()
+            if self._header is None or len(fingerprints) != len(df):
+                self._seen_shared_version = self._shared.bump()
+                return
+            self.stats['snapshot_publishes'] += 1
+        version = self._shared.publish_snapshot(without_derived_columns(df), fingerprints, meta)
+        with self._lock:
+            # Phiên bản này là của chính worker này: không nạp lại snapshot của mình.
+            if self._seen_shared_version is None or version > self._seen_shared_version:
+                self._seen_shared_version = version
+            # Dữ liệu đã đổi trong lúc ghi file: snapshot vừa ghi có thể cũ hơn bản
+            # mà sync() vừa công bố, nên công bố lại bản hiện tại.
+            if self._df is not df and self._header is not None:
+                self._schedule_publish()
+
+    def refresh_in_background(self) -> bool:
+        """
+        Chạy sync() ở một thread nền (tối đa một thread cùng lúc).
+        """
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+
+        def _run():
+            try:
+                # Làm mới nền nhường quota đọc cho request của người dùng.
+                with background_priority():
+                    self.coalesced_sync()
+            except Exception as e:
+                print(f"Lỗi khi đồng bộ nền: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name="bookings-refresh", daemon=True).start()
+        return True
+
+    # --------------------------------------------------------------------------
+    # Đồng bộ với Google Sheet
+    # --------------------------------------------------------------------------
+
+    def coalesced_sync(self) -> bool:
+        """
+        sync() qua single-flight. Key gồm cả invalidation_gen để một request
+        đến sau invalidate() không ghép vào lần đồng bộ đã bắt đầu trước đó.
+        """
+        key = ('sync', self.sheet_id, self.worksheet_name, self._invalidation_gen)
+        return self._flight.do(key, self.sync)
+
+    def sync(self, force: bool = False) -> bool:
+        """
+        Đồng bộ với sheet. Trả về True nếu dữ liệu trong bộ nhớ thay đổi.
+        """
+        with self._sync_lock:
+            with self._lock:
+                invalidation_gen = self._invalidation_gen
+                known_revision = self._revision
+                has_data = self._df is not None
+
+            revision = get_sheet_revision(self.sheet_id, self.gcp_creds_file_path)
+            if not force and has_data and revision is not None and revision == known_revision:
+                with self._lock:
+                    self.stats['unchanged_checks'] += 1
+                    self._finish_sync(invalidation_gen)
+                return False
+
+            index_generation = row_index_generation(self.sheet_id, self.worksheet_name)
+            data = fetch_sheet_values(self.sheet_id, self.gcp_creds_file_path, self.worksheet_name)
+            # Dữ liệu vừa tải cũng dùng để làm mới chỉ mục số hàng, không tốn thêm API
+            # (bỏ qua nếu trong lúc tải process này đã xóa/thêm hàng).
+            refresh_row_index_from_values(self.sheet_id, self.worksheet_name, data, index_generation)
+            with self._lock:
+                changed = self._apply_values(data)
+                if changed:
+                    self._apply_pending_overlay()
+                self._revision = revision
+                self._finish_sync(invalidation_gen)
+                if changed and self._header is not None:
+                    self._publish_snapshot()
+                return changed
+
+    def _finish_sync(self, invalidation_gen: int):
+        self.checked_at = datetime.datetime.now()
+        # Nếu có invalidate() trong lúc đang đồng bộ thì vẫn giữ cờ dirty.
+        if invalidation_gen == self._invalidation_gen:
+            self._dirty = False
+
+    def _apply_values(self, data: List[List[str]]) -> bool:
+        if not data or len(data) < 2:
+            return self._replace(pd.DataFrame(), None, [])
+
+        header = tuple(data[0])
+        new_rows = data[1:]
+        new_fingerprints = [row_fingerprint(row) for row in new_rows]
+
+        if self._df is None or header != self._header or not self._fingerprints:
+            self.stats['full_loads'] += 1
+            self.stats['rows_reparsed'] += len(new_rows)
+            df = build_bookings_dataframe(list(header), new_rows, report=True)
+            return self._replace(df, header, new_fingerprints)
+
+        if new_fingerprints == self._fingerprints:
+            return False
+
+        # Ghép hàng mới với hàng cũ theo fingerprint.
+        old_positions: Dict[int, List[int]] = {}
+        for pos, fingerprint in enumerate(self._fingerprints):
+            old_positions.setdefault(fingerprint, []).append(pos)
+
+        reused_new, reused_old, fresh = [], [], []
+        for i, fingerprint in enumerate(new_fingerprints):
+            bucket = old_positions.get(fingerprint)
+            if bucket:
+                reused_new.append(i)
+                reused_old.append(bucket.pop())
+            else:
+                fresh.append(i)
+
+        parts = []
+        if reused_old:
+            reused = self._df.iloc[reused_old]
+            reused.index = reused_new
+            parts.append(reused)
+        if fresh:
+            parsed = build_bookings_dataframe(list(header), [new_rows[i] for i in fresh])
+            parsed.index = fresh
+            parts.append(parsed)
+
+        df = concat_booking_frames(parts).sort_index().reset_index(drop=True)
+        self.stats['delta_syncs'] += 1
+        self.stats['rows_reparsed'] += len(fresh)
+        self.stats['rows_reused'] += len(reused_old)
+        print(f"Đồng bộ delta: {len(fresh)} hàng mới/thay đổi, {len(reused_old)} hàng giữ nguyên, "
+              f"{len(self._fingerprints) - len(reused_old)} hàng bị bỏ.")
+        return self._replace(df, header, new_fingerprints)
+
+    def _replace(self, df: pd.DataFrame, header: Optional[tuple], fingerprints: List[int]) -> bool:
+        self._df = df
+        self._header = header
+        self._fingerprints = fingerprints
+        self._bump()
+        return True
+
+    def _bump(self):
+        self._active = None
+        self.version += 1
+        self.loaded_at = datetime.datetime.now()
+
+    # --------------------------------------------------------------------------
+    # Write-through: áp dụng thay đổi đã ghi thành công lên sheet
+    # --------------------------------------------------------------------------
+
+    def apply_update(self, booking_id: str, new_data: Dict[str, Any]) -> bool:
+        """
+        Cập nhật một booking trong bộ nhớ. Trả về False nếu không áp dụng được
+        (khi đó người gọi nên invalidate()).
+        """
+        with self._lock:
+            result = self._updated_frame(self._df, self._fingerprints, booking_id, new_data)
+            if result is None:
+                return False
+            self._commit_local_write(*result)
+            return True
+
+    def apply_delete(self, booking_ids: List[str]) -> int:
+        """
+        Xóa các booking khỏi bộ nhớ. Trả về số hàng đã xóa.
+        """
+        with self._lock:
+            result = self._deleted_frame(self._df, self._fingerprints, booking_ids)
+            if result is None:
+                return 0
+            self._commit_local_write(*result)
+            return len(result[2]['positions'])
+
+    def apply_append(self, bookings: List[Dict[str, Any]]) -> int:
+        """
+        Thêm các booking mới vào bộ nhớ. Trả về số hàng đã thêm.
+        """
+        with self._lock:
+            result = self._appended_frame(self._df, self._fingerprints, bookings)
+            if result is None:
+                return 0
+            self._commit_local_write(*result)
+            return len(bookings)
+
+    # Các hàm dưới đây không sửa self._df: trả về (df, fingerprints, change) mới hoặc None.
+
+    def _updated_frame(self, df, fingerprints, booking_id, new_data):
+        if df is None or ID_COLUMN not in df.columns:
+            return None
+        positions = (df[ID_COLUMN] == booking_id).to_numpy().nonzero()[0]
+        if len(positions) == 0:
+            return None
+        # Frame mới chỉ sao chép các cột bị sửa; request đang đọc frame cũ không bị ảnh hưởng.
+        df = update_booking_row(df, int(positions[0]), new_data)
+        fingerprints = list(fingerprints)
+        if positions[0] < len(fingerprints):
+            fingerprints[positions[0]] = LOCAL_WRITE_FINGERPRINT
+        return df, fingerprints, {'kind': 'update', 'positions': [int(positions[0])]}
+
+    def _deleted_frame(self, df, fingerprints, booking_ids):
+        if df is None or ID_COLUMN not in df.columns or not booking_ids:
+            return None
+        mask = df[ID_COLUMN].isin(set(booking_ids)).to_numpy()
+        if not mask.any():
+            return None
+        keep = (~mask).nonzero()[0]
+        new_fingerprints = [fingerprints[i] for i in keep] if len(fingerprints) == len(mask) else []
+        change = {'kind': 'delete', 'positions': mask.nonzero()[0].tolist()}
+        return df.iloc[keep].reset_index(drop=True), new_fingerprints, change
+
+    def _appended_frame(self, df, fingerprints, bookings):
+        if df is None or self._header is None or not bookings:
+            return None
+        header = list(self._header)
+        rows = [['' if booking.get(col) is None else str(booking.get(col)) for col in header]
+                for booking in bookings]
+        parsed = build_bookings_dataframe(header, rows)
+        change = {'kind': 'append', 'positions': list(range(len(df), len(df) + len(rows)))}
+        df = concat_booking_frames([df, parsed], ignore_index=True)
+        return df, fingerprints + [LOCAL_WRITE_FINGERPRINT] * len(rows), change
+
+    def set_pending_overlay(self, provider: Optional[Callable[[], List[dict]]]):
+        """
+        Đăng ký hàm trả về các thao tác chưa được ghi lên sheet, dạng
+        {'kind': 'update'|'delete'|'append', 'payload': {...}}, theo thứ tự.
+        """
+        self._pending_overlay = provider
+
+    def _apply_pending_overlay(self):
+        if self._pending_overlay is None:
+            return
+        try:
+            ops = self._pending_overlay()
+        except Exception as e:
+            print(f"Không đọc được các thao tác ghi đang chờ: {e}")
+            return
+        df, fingerprints = self._df, self._fingerprints
+        applied = 0
+        for op in ops:
+            payload = op.get('payload') or {}
+            try:
+                if op['kind'] == 'update':
+                    result = self._updated_frame(df, fingerprints, payload.get('booking_id'), payload.get('new_data') or {})
+                elif op['kind'] == 'delete':
+                    result = self._deleted_frame(df, fingerprints, payload.get('booking_ids') or [])
+                elif op['kind'] == 'append':
+                    # Bỏ qua booking đã có trên sheet (đã được đẩy lên nhưng chưa đánh dấu xong).
+                    existing = set(df[ID_COLUMN]) if df is not None and ID_COLUMN in df.columns else set()
+                    bookings = [b for b in payload.get('bookings') or [] if b.get(ID_COLUMN) not in existing]
+                    result = self._appended_frame(df, fingerprints, bookings)
+                else:
+                    result = None
+            except Exception as e:
+                print(f"Không áp lại được thao tác ghi đang chờ #{op.get('id')}: {e}")
+                result = None
+            if result is not None:
+                df, fingerprints, _ = result
+                applied += 1
+        if applied:
+            self._df, self._fingerprints = df, fingerprints
+            self._bump()
+            print(f"Đã áp lại {applied} thao tác ghi đang chờ đồng bộ lên sheet.")
+
+    def _commit_local_write(self, df: pd.DataFrame, fingerprints: List[int], change: dict):
+        old_df = self._df
+        self._df = df
+        self._fingerprints = fingerprints
+        self.stats['local_writes'] += 1
+        self._bump()
+        self._update_derived(old_df, change)
+        # Công bố cho các worker khác: họ nạp snapshot này thay vì gọi Google Sheets.
+        self._schedule_publish()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'version': self.version,
+                'shared_version': self._seen_shared_version,
+                'rows': 0 if self._df is None else len(self._df),
+                'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+                'checked_at': self.checked_at.isoformat() if self.checked_at else None,
+                'age_seconds': self.age_seconds(),
+                'ttl_seconds': self.ttl_seconds,
+                'refreshing': self._refreshing,
+                'sync_in_flight': self._flight.in_flight(),
+                'sync_calls': self._flight.stats['calls'],
+                'sync_executions': self._flight.stats['executions'],
+                'sync_collapsed': self._flight.stats['collapsed'],
+                'revision': self._revision,
+                'dirty': self._dirty,
+                'publish_pending': self._publish_pending,
+                'bytes_per_row': None if self._df is None else round(bytes_per_row(self._df), 1),
+                'schema_report': dict(last_schema_report),
+                **self.stats,
+            }
@@ -0,0 +1,163 @@
+import pandas as pd
+from jinja2.utils import htmlsafe_json_dumps
+from markupsafe import Markup
+
+# ==============================================================================
+# SPEC BIỂU ĐỒ DASHBOARD (PLOTLY JSON THUẦN)
+# ==============================================================================
+# Các biểu đồ được dựng thẳng thành dict theo định dạng Plotly.js từ các bảng
+# tổng hợp, không qua plotly.express/Figure (vốn phải dựng figure, áp style rồi
+# to_json() + json.loads() chỉ để Jinja serialize lại lần nữa). chart_json()
+# serialize spec một lần thành chuỗi an toàn để nhúng trong <script>; chuỗi này
+# nằm trong context dashboard được cache theo phiên bản dữ liệu.
+
+FONT = {'family': 'Arial, sans-serif', 'size': 12}
+AXIS_STYLE = {
+    'showgrid': True,
+    'gridwidth': 1,
+    'gridcolor': 'rgba(128,128,128,0.2)',
+    'showline': True,
+    'linewidth': 1,
+    'linecolor': 'rgba(128,128,128,0.5)',
+}
+MONEY_AXIS_STYLE = {**AXIS_STYLE, 'tickformat': ',.0f'}
+
+
+def _title(text: str, size: int) -> dict:
+    return {'text': text, 'x': 0.5, 'font': {'size': size, 'family': 'Arial, sans-serif', 'color': '#2c3e50'}}
+
+
+def chart_json(spec: dict) -> Markup:
+    """Serialize spec một lần, an toàn để chèn trực tiếp vào <script>."""
+    return htmlsafe_json_dumps(spec)
+
+
+def monthly_revenue_chart(monthly_revenue: pd.DataFrame, recognized: dict | None = None) -> dict:
+    """
+    Doanh thu hàng tháng (đường + cột) từ bảng ['Tháng', 'Doanh thu'], kèm doanh
+    thu trải theo đêm ở nếu có (kết quả NightlyRevenue.monthly). Hai chuỗi khác
+    nhau về đơn hủy (cột tính cả đơn đã hủy, đường đêm ở thì không) nên tên
+    chuỗi ghi rõ điều đó.
+    """
+    if monthly_revenue.empty:
+        return {}
+    monthly_revenue = monthly_revenue.sort_values('Tháng')
+    months = monthly_revenue['Tháng'].tolist()
+    revenue = [int(value) for value in monthly_revenue['Doanh thu']]
+    data = [
+        {
+            'type': 'scatter',
+            'mode': 'lines+markers',
+            'name': '',
+            'showlegend': False,
+            'x': months,
+            'y': revenue,
+            'hovertemplate': 'Tháng=%{x}<br>Doanh thu=%{y}<extra></extra>',
+            'line': {'width': 3, 'color': '#3498db'},
+            'marker': {'size': 8, 'color': '#e74c3c', 'line': {'width': 2, 'color': 'white'}},
+        },
+        {
+            'type': 'bar',
+            'name': 'Doanh thu theo tháng check-in (gồm đơn đã hủy)',
+            'x': months,
+            'y': revenue,
+            'marker': {'color': '#3498db', 'opacity': 0.3},
+        },
+    ]
+    if recognized:
+        excluded = ' (không gồm đơn đã hủy)' if recognized.get('excludes_cancelled') else ''
+        data.append({
+            'type': 'scatter',
+            'mode': 'lines+markers',
+            'name': 'Doanh thu theo đêm ở' + excluded,
+            'x': recognized['months'],
+            'y': recognized['revenue'],
+            'line': {'width': 2, 'color': '#f39c12', 'dash': 'dot'},
+            'marker': {'size': 6, 'color': '#f39c12'},
+        })
+    return {
+        'data': data,
+        'layout': {
+            'title': _title('📊 Doanh thu Hàng tháng (Tất cả thời gian)', 18),
+            'xaxis': {'title': {'text': 'Tháng'}, **AXIS_STYLE},
+            'yaxis': {'title': {'text': 'Doanh thu (VND)'}, **MONEY_AXIS_STYLE},
+            'hovermode': 'x unified',
+            'plot_bgcolor': 'rgba(0,0,0,0)',
+            'paper_bgcolor': 'rgba(0,0,0,0)',
+            'font': FONT,
+            'margin': {'l': 60, 'r': 30, 't': 80, 'b': 50},
+            'height': 400,
+            'showlegend': True,
+            'legend': {'orientation': 'h', 'yanchor': 'bottom', 'y': 1.02, 'xanchor': 'right', 'x': 1},
+        },
+    }
+
+
+def collected_vs_uncollected_chart(table: pd.DataFrame) -> dict:
+    """
+    Cột chồng "Đã thu" / "Chưa thu" theo tháng từ bảng ['Tháng', 'Đã thu', 'Chưa thu'].
+    """
+    if table.empty:
+        return {}
+    months = table['Tháng'].tolist()
+    series = [('Đã thu', '#2ecc71'), ('Chưa thu', '#e74c3c')]
+    return {
+        'data': [{
+            'type': 'bar',
+            'name': name,
+            'x': months,
+            'y': [int(value) for value in table[name]],
+            'marker': {'color': color},
+            'texttemplate': '%{y:,.0f}đ',
+            'textposition': 'outside',
+            'hovertemplate': '<b>%{fullData.name}</b><br>Tháng: %{x}<br>Số tiền: %{y:,.0f}đ<br><extra></extra>',
+        } for name, color in series],
+        'layout': {
+            'title': _title('💰 Doanh thu Đã thu vs Chưa thu (Theo tháng)', 16),
+            'xaxis': {'title': {'text': 'Tháng'}, **AXIS_STYLE},
+            'yaxis': {'title': {'text': 'Doanh thu (VND)'}, **MONEY_AXIS_STYLE},
+            'barmode': 'relative',
+            'plot_bgcolor': 'rgba(0,0,0,0)',
+            'paper_bgcolor': 'rgba(0,0,0,0)',
+            'font': FONT,
+            'margin': {'l': 60, 'r': 30, 't': 100, 'b': 50},
+            'height': 450,
+            'showlegend': True,
+            'legend': {'orientation': 'h', 'yanchor': 'bottom', 'y': 1.02, 'xanchor': 'center', 'x': 0.5},
+            'hovermode': 'x unified',
+            'bargap': 0.6,
+            'bargroupgap': 0.1,
+        },
+    }
+
+
+def collector_revenue_chart(rows: list[dict]) -> dict:
+    """
+    Biểu đồ donut doanh thu theo người thu tiền từ các dòng {'Người thu tiền', 'Tổng thanh toán'}.
+    """
+    return {
+        'data': [{
+            'type': 'pie',
+            'labels': [row['Người thu tiền'] for row in rows],
+            'values': [int(row['Tổng thanh toán']) for row in rows],
+            'textinfo': 'label+percent+value',
+            'textposition': 'auto',
+            'hovertemplate': '<b>%{label}</b><br>Doanh thu: %{value:,.0f}đ<br>Tỷ lệ: %{percent}<br><extra></extra>',
+            'marker': {
+                'colors': ['#3498db', '#e74c3c', '#2ecc71', '#f39c12', '#9b59b6', '#1abc9c'],
+                'line': {'color': '#ffffff', 'width': 2},
+            },
+            'hole': 0.4,  # Tạo donut chart
+            'textfont': {'size': 12, 'family': 'Arial, sans-serif'},
+        }],
+        'layout': {
+            'title': _title('💰 Doanh thu theo Người thu tiền', 16),
+            'showlegend': True,
+            'legend': {'orientation': 'v', 'x': 1.02, 'y': 0.5, 'font': {'size': 11, 'family': 'Arial, sans-serif'}},
+            'height': 350,
+            'margin': {'l': 20, 'r': 100, 't': 60, 'b': 20},
+            'plot_bgcolor': 'rgba(0,0,0,0)',
+            'paper_bgcolor': 'rgba(0,0,0,0)',
+            'font': {**FONT, 'color': '#2c3e50'},
+        },
+    }
@@ -0,0 +1,176 @@
+"""
+Fixture dùng chung cho các test: một worksheet giả lập trong bộ nhớ, đủ các
+lệnh gspread mà logic.py dùng (batch_get, batch_update, delete_rows,
+append_rows, deleteDimension...), để kiểm tra đường ghi mà không gọi Google;
+và bộ sinh booking ngẫu nhiên cho BookingStore và các chỉ mục dẫn xuất.
+"""
+
+import datetime
+import re
+
+import pytest
+from gspread.utils import a1_to_rowcol
+
+import booking_store
+import logic
+from booking_store import BookingStore
+from data_snapshot import SharedVersionCounter
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def batch_update(self, body):
+        # Chỉ hỗ trợ deleteDimension theo hàng; các khoảng được xóa theo thứ tự gửi lên.
+        for request in body['requests']:
+            dimension = request['deleteDimension']['range']
+            del self.worksheet.rows[dimension['startIndex']:dimension['endIndex']]
+        self.worksheet.calls.append(('deleteDimension', len(body['requests'])))
+        return {}
+
+
+class FakeWorksheet:
+    id = 0
+
+    def __init__(self, header, rows):
+        self.rows = [list(header)] + [list(row) for row in rows]
+        self.spreadsheet = FakeSpreadsheet(self)
+        self.calls = []
+        # Gọi trước mỗi lệnh append_rows (để giả lập lỗi sau khi server đã ghi).
+        self.before_append = None
+
+    # Tiện ích cho test
+    def ids(self):
+        col = self.rows[0].index(logic.BOOKING_ID_COLUMN)
+        return [row[col] for row in self.rows[1:]]
+
+    def cell(self, booking_id, column):
+        col = self.rows[0].index(column)
+        id_col = self.rows[0].index(logic.BOOKING_ID_COLUMN)
+        return [row[col] for row in self.rows[1:] if row[id_col] == booking_id]
+
+    def _value(self, row, col):
+        if row - 1 < len(self.rows) and col - 1 < len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ''
+
+    @staticmethod
+    def _trim(values):
+        values = list(values)
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    # API gspread
+    def get_all_values(self):
+        self.calls.append(('get_all_values',))
+        width = len(self.rows[0])
+        return [row + [''] * (width - len(row)) for row in self.rows]
+
+    def row_values(self, row):
+        self.calls.append(('row_values', row))
+        return self._trim(self.rows[row - 1])
+
+    def batch_get(self, ranges):
+        self.calls.append(('batch_get', tuple(ranges)))
+        results = []
+        for a1 in ranges:
+            if re.fullmatch(r'\d+:\d+', a1):
+                results.append([self._trim(self.rows[int(a1.split(':')[0]) - 1])])
+            elif re.fullmatch(r'[A-Z]+:[A-Z]+', a1):
+                _, col = a1_to_rowcol(a1.split(':')[0] + '1')
+                column = [[self._value(row, col)] for row in range(1, len(self.rows) + 1)]
+                while column and column[-1] == ['']:
+                    column.pop()
+                results.append([cell if cell != [''] else [] for cell in column])
+            else:
+                value = self._value(*a1_to_rowcol(a1))
+                results.append([[value]] if value != '' else [])
+        return results
+
+    def batch_update(self, updates, value_input_option=None):
+        self.calls.append(('batch_update', len(updates)))
+        for update in updates:
+            row, col = a1_to_rowcol(update['range'])
+            while len(self.rows[row - 1]) < col:
+                self.rows[row - 1].append('')
+            self.rows[row - 1][col - 1] = update['values'][0][0]
+        return {}
+
+    def delete_rows(self, start, end=None):
+        self.calls.append(('delete_rows', start))
+        del self.rows[start - 1:(end or start)]
+
+    def append_rows(self, values, value_input_option=None):
+        if self.before_append is not None:
+            self.before_append(values)
+        self.calls.append(('append_rows', len(values)))
+        first = len(self.rows) + 1
+        self.rows.extend([list(row) for row in values])
+        return {'updates': {'updatedRange': f"'Sheet'!A{first}:C{len(self.rows)}"}}
+
+    def api_calls(self, name):
+        return [call for call in self.calls if call[0] == name]
+
+
+SHEET_HEADER = ['Số đặt phòng', 'Tên người đặt', 'Tổng thanh toán']
+
+
+@pytest.fixture
+def fake_sheet(monkeypatch):
+    """
+    Worksheet giả lập với 5 booking B1..B5; mọi hàm ghi trong logic.py dùng nó.
+    """
+    sheet = FakeWorksheet(SHEET_HEADER, [[f'B{i}', f'Khách {i}', str(i * 100000)] for i in range(1, 6)])
+    monkeypatch.setattr(logic, '_get_worksheet', lambda *args, **kwargs: sheet)
+    monkeypatch.setattr(logic, '_row_indexes', {})
+    return sheet
+
+
+# ==============================================================================
+# BOOKING NGẪU NHIÊN
+# ==============================================================================
+
+HEADER = ['Số đặt phòng', 'Tên chỗ nghỉ', 'Tên người đặt', 'Check-in Date', 'Check-out Date',
+          'Tình trạng', 'Tổng thanh toán', 'Người thu tiền', 'Thành viên Genius']
+FIRST_DAY = datetime.date(2025, 1, 1)
+COLLECTORS = ['LOC LE', 'THAO LE', '', 'N/A']
+
+
+def random_booking(rng, booking_id: str, first: datetime.date = FIRST_DAY, span: int = 60,
+                   missing_id: float = 0.0) -> list[str]:
+    """
+    Một hàng sheet ngẫu nhiên theo HEADER: chỗ nghỉ A/B/C, check-in trong
+    [first, first + span], từ -1 đến 9 đêm, đôi khi thiếu ngày hoặc đã hủy.
+    """
+    check_in = first + datetime.timedelta(days=rng.randint(0, span))
+    check_out = check_in + datetime.timedelta(days=rng.randint(-1, 9))
+    return [booking_id if rng.random() >= missing_id else '', rng.choice('ABC'), 'Khách',
+            check_in.isoformat() if rng.random() > 0.03 else '',
+            check_out.isoformat() if rng.random() > 0.03 else '',
+            rng.choice(['OK', 'OK', 'OK', 'Đã hủy']), str(rng.randint(0, 3_000_000)),
+            rng.choice(COLLECTORS), rng.choice(['Có', 'Không', ''])]
+
+
+def bookings_frame(rng, n: int, **kwargs):
+    """DataFrame (đã parse như khi tải từ sheet) của n booking ngẫu nhiên B0..B{n-1}."""
+    return logic.build_bookings_dataframe(HEADER, [random_booking(rng, f'B{i}', **kwargs) for i in range(n)])
+
+
+@pytest.fixture
+def sheet_values(monkeypatch):
+    """
+    Nội dung sheet mà BookingStore.sync đọc (chỉ có hàng tiêu đề HEADER); test
+    thêm/sửa hàng trực tiếp trong danh sách trả về.
+    """
+    values = [list(HEADER)]
+    monkeypatch.setattr(booking_store, 'get_sheet_revision', lambda *args: None)
+    monkeypatch.setattr(booking_store, 'fetch_sheet_values', lambda *args: [list(row) for row in values])
+    return values
+
+
+def memory_store(tmp_path, **kwargs) -> BookingStore:
+    """BookingStore đọc sheet_values, với bộ đếm phiên bản dùng chung trong tmp_path."""
+    return BookingStore('sheet-id', 'creds', 'BookingManager',
+                        shared_version=SharedVersionCounter(tmp_path), **kwargs)
@@ -0,0 +1,199 @@
+import os
+import json
+import glob
+import mmap
+import struct
+import datetime
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Tuple
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:  # pyarrow là tùy chọn: không có thì dùng pickle (không memory-map được)
+    feather = None
+
+try:
+    import fcntl
+except ImportError:  # Windows khi chạy local: bỏ qua khóa liên process
+    fcntl = None
+
+# ==============================================================================
+# SNAPSHOT DỮ LIỆU ĐẶT PHÒNG TRÊN ĐĨA
+# ==============================================================================
+# Worker gunicorn mới khởi động (hoặc vừa bị recycle bởi --max-requests) đọc
+# snapshot dạng cột (Feather/Arrow, memory-map) thay vì chờ tải toàn bộ Google
+# Sheet. Snapshot đi kèm một file meta JSON chứa "version stamp" (revision của
+# sheet, thời điểm lưu, định dạng) để worker biết cần kiểm tra lại với sheet.
+#
+# File dữ liệu được ghi với tên duy nhất rồi mới cập nhật meta bằng os.replace,
+# nên worker khác không bao giờ đọc phải file đang ghi dở.
+#
+# SharedVersionCounter là một bộ đếm 8 byte được memory-map từ file, dùng chung
+# cho mọi worker: mỗi lần dữ liệu đổi (hoặc bị invalidate) ở một worker, bộ đếm
+# tăng lên và các worker còn lại chỉ cần đọc 8 byte này ở mỗi request để biết
+# phải nạp lại snapshot.
+#
+# Phạm vi: đây là cơ chế giữ dữ liệu của các worker luôn mới (không phải gọi lại
+# Google Sheets), KHÔNG phải bộ nhớ dùng chung. Chỉ có bộ đếm là được chia sẻ;
+# mỗi worker vẫn dựng DataFrame pandas riêng từ snapshot (to_pandas() sao chép
+# cột chuỗi/category), nên bộ nhớ cho dữ liệu đặt phòng vẫn tính theo số worker.
+# memory_map=True chỉ giúp đọc file nhanh hơn qua page cache của hệ điều hành.
+
+BASE_DIR = Path(__file__).resolve().parent
+SNAPSHOT_DIR = Path(os.getenv("BOOKINGS_SNAPSHOT_DIR", BASE_DIR / ".cache"))
+SNAPSHOT_NAME = "bookings"
+# Tăng số này khi cách parse/kiểu dữ liệu thay đổi để bỏ qua snapshot cũ.
+SNAPSHOT_FORMAT_VERSION = 2
+FINGERPRINT_COLUMN = "__fingerprint"
+
+
+def _meta_path(directory: Path) -> Path:
+    return directory / f"{SNAPSHOT_NAME}.meta.json"
+
+
+def save_snapshot(df: pd.DataFrame, fingerprints: list[int], meta: dict, directory: Path = SNAPSHOT_DIR) -> Optional[Path]:
+    """
+    Lưu DataFrame (kèm fingerprint từng hàng) và meta vào thư mục snapshot.
+    Trả về đường dẫn file dữ liệu, hoặc None nếu lưu thất bại.
+    """
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        suffix = "feather" if feather is not None else "pkl"
+        data_path = directory / f"{SNAPSHOT_NAME}-{stamp}-{os.getpid()}.{suffix}"
+
+        frame = df.reset_index(drop=True).copy()
+        frame[FINGERPRINT_COLUMN] = pd.Series(fingerprints, dtype='int64')
+        if feather is not None:
+            feather.write_feather(frame, data_path, compression='uncompressed')
+        else:
+            frame.to_pickle(data_path)
+
+        full_meta = {
+            **meta,
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'file': data_path.name,
+            'rows': len(df),
+            'saved_at': datetime.datetime.now().isoformat(),
+        }
+        tmp_meta = directory / f"{SNAPSHOT_NAME}.meta.{os.getpid()}.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(full_meta, f, ensure_ascii=False)
+        os.replace(tmp_meta, _meta_path(directory))
+
+        _remove_old_files(directory)
+        return data_path
+    except Exception as e:
+        print(f"Không lưu được snapshot dữ liệu: {e}")
+        return None
+
+
+def load_snapshot(directory: Path = SNAPSHOT_DIR) -> Optional[Tuple[pd.DataFrame, list[int], dict]]:
+    """
+    Đọc snapshot mới nhất. Trả về (df, fingerprints, meta) hoặc None nếu không có/không hợp lệ.
+    """
+    meta_path = _meta_path(directory)
+    if not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+            print("Snapshot dữ liệu có định dạng cũ, bỏ qua.")
+            return None
+
+        data_path = directory / meta['file']
+        if data_path.suffix == '.feather':
+            if feather is None:
+                return None
+            frame = feather.read_table(data_path, memory_map=True).to_pandas()
+        else:
+            frame = pd.read_pickle(data_path)
+
+        fingerprints = frame.pop(FINGERPRINT_COLUMN).tolist()
+        return frame, fingerprints, meta
+    except Exception as e:
+        print(f"Không đọc được snapshot dữ liệu: {e}")
+        return None
+
+
+def _remove_old_files(directory: Path, keep: int = 2):
+    # Giữ lại cả file trước đó để worker vừa đọc meta cũ vẫn mở được file của nó.
+    paths = sorted(glob.glob(str(directory / f"{SNAPSHOT_NAME}-*")), key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class SharedVersionCounter:
+    """
+    Bộ đếm phiên bản dữ liệu tăng dần, dùng chung giữa các worker qua mmap.
+    """
+
+    def __init__(self, directory: Path = SNAPSHOT_DIR, name: str = SNAPSHOT_NAME):
+        self.path = directory / f"{name}.version"
+        self.lock_path = directory / f"{name}.lock"
+        self._local_lock = threading.Lock()
+        self._mm = None
+
+    def _map(self):
+        if self._mm is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Chỉ append nên nhiều worker cùng tạo file cũng không ghi đè giá trị đã có.
+            with open(self.path, 'ab') as f:
+                if os.path.getsize(self.path) < 8:
+                    f.write(b'\x00' * 8)
+            with open(self.path, 'r+b') as f:
+                self._mm = mmap.mmap(f.fileno(), 8)
+        return self._mm
+
+    def read(self) -> int:
+        """Đọc phiên bản hiện tại (chỉ là đọc 8 byte từ bộ nhớ dùng chung)."""
+        try:
+            return struct.unpack_from('<Q', self._map(), 0)[0]
+        except (OSError, ValueError) as e:
+            print(f"Không đọc được bộ đếm phiên bản dùng chung: {e}")
+            return 0
+
+    def _write(self, value: int):
+        struct.pack_into('<Q', self._map(), 0, value)
+        self._mm.flush()
+
+    @contextmanager
+    def locked(self):
+        """Khóa độc quyền giữa các thread và các process (flock)."""
+        with self._local_lock:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def bump(self) -> int:
+        """Tăng phiên bản lên 1 và trả về giá trị mới."""
+        with self.locked():
+            value = self.read() + 1
+            self._write(value)
+            return value
+
+    def publish_snapshot(self, df: pd.DataFrame, fingerprints: list[int], meta: dict) -> int:
+        """
+        Lưu snapshot gắn với phiên bản mới rồi mới công bố phiên bản đó,
+        để worker nào thấy phiên bản mới cũng đọc được đúng snapshot.
+        """
+        with self.locked():
+            value = self.read() + 1
+            if save_snapshot(df, fingerprints, {**meta, 'data_version': value}, self.path.parent) is None:
+                return self.read()
+            self._write(value)
+            return value
@@ -1,7 +1,14 @@
 import os
 import json
+import hashlib
+import threading
 import gspread
 import tempfile
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+
+from sheets_quota import ScheduledClient
 
 def _get_gspread_client_production():
     """
@@ -50,3 +57,94 @@ def get_gspread_client_safe(gcp_creds_file_path=None):
     
     # Cuối cùng, thử production method
     return _get_gspread_client_production()
+
+# ==============================================================================
+# POOL KẾT NỐI DÙNG CHUNG (CLIENT / SPREADSHEET / WORKSHEET)
+# ==============================================================================
+# Mỗi process giữ lại một gspread client duy nhất cho mỗi bộ credentials.
+# AuthorizedSession tự dùng lại access token và tự refresh khi token hết hạn
+# (hoặc khi server trả 401), còn requests.Session giữ kết nối keep-alive.
+# Client là ScheduledClient nên mọi request đều đi qua bộ lập lịch quota
+# (sheets_quota.py).
+# Spreadsheet và Worksheet cũng được giữ lại để không phải gọi lại
+# open_by_key() và worksheet() (mỗi lần là một lượt fetch metadata).
+
+HTTP_POOL_MAXSIZE = int(os.getenv("GSHEET_HTTP_POOL_MAXSIZE", "10"))
+
+_pool_lock = threading.RLock()
+_client_pool = {}
+_spreadsheet_pool = {}
+_worksheet_pool = {}
+
+def _resolve_credentials(gcp_creds_file_path=None):
+    """
+    Trả về (key, credentials) theo đúng thứ tự ưu tiên của get_gspread_client_safe:
+    GCP_CREDENTIALS_JSON -> file truyền vào -> GCP_CREDS_FILE_PATH/gcp_credentials.json.
+    """
+    gcp_credentials_json = os.getenv('GCP_CREDENTIALS_JSON')
+    if gcp_credentials_json:
+        key = "env:" + hashlib.sha1(gcp_credentials_json.encode('utf-8')).hexdigest()
+        if key in _client_pool:
+            return key, None
+        info = json.loads(gcp_credentials_json)
+        return key, ServiceAccountCredentials.from_service_account_info(info, scopes=gspread.auth.DEFAULT_SCOPES)
+
+    for path in (gcp_creds_file_path, os.getenv("GCP_CREDS_FILE_PATH", "gcp_credentials.json")):
+        if path and os.path.exists(path):
+            key = "file:" + os.path.abspath(path)
+            if key in _client_pool:
+                return key, None
+            return key, ServiceAccountCredentials.from_service_account_file(path, scopes=gspread.auth.DEFAULT_SCOPES)
+
+    raise Exception("Không tìm thấy Google credentials")
+
+def get_pooled_client(gcp_creds_file_path=None) -> gspread.Client:
+    """
+    Trả về gspread client dùng chung cho cả process (tạo một lần, dùng mãi).
+    """
+    with _pool_lock:
+        key, credentials = _resolve_credentials(gcp_creds_file_path)
+        client = _client_pool.get(key)
+        if client is None:
+            print(f"Tạo kết nối Google Sheets dùng chung ({key.split(':', 1)[0]})")
+            session = AuthorizedSession(credentials)
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=2)
+            session.mount("https://", adapter)
+            client = ScheduledClient(auth=credentials, session=session)
+            _client_pool[key] = client
+        return client
+
+def get_spreadsheet(sheet_id: str, gcp_creds_file_path=None):
+    """
+    Trả về handle Spreadsheet đã mở sẵn cho sheet_id.
+    """
+    client = get_pooled_client(gcp_creds_file_path)
+    with _pool_lock:
+        spreadsheet = _spreadsheet_pool.get((id(client), sheet_id))
+        if spreadsheet is None:
+            spreadsheet = client.open_by_key(sheet_id)
+            _spreadsheet_pool[(id(client), sheet_id)] = spreadsheet
+        return spreadsheet
+
+def get_worksheet(sheet_id: str, gcp_creds_file_path=None, worksheet_name=None):
+    """
+    Trả về handle Worksheet đã mở sẵn. worksheet_name=None nghĩa là sheet đầu tiên.
+    """
+    spreadsheet = get_spreadsheet(sheet_id, gcp_creds_file_path)
+    with _pool_lock:
+        key = (id(spreadsheet.client), sheet_id, worksheet_name or "")
+        worksheet = _worksheet_pool.get(key)
+        if worksheet is None:
+            worksheet = spreadsheet.worksheet(worksheet_name) if worksheet_name else spreadsheet.sheet1
+            _worksheet_pool[key] = worksheet
+        return worksheet
+
+def invalidate_sheet_handles(sheet_id=None):
+    """
+    Bỏ các handle Spreadsheet/Worksheet đã lưu (ví dụ sau khi worksheet bị đổi tên
+    hoặc xóa). Client và token vẫn được giữ lại.
+    """
+    with _pool_lock:
+        for pool in (_spreadsheet_pool, _worksheet_pool):
+            for key in [k for k in pool if sheet_id is None or k[1] == sheet_id]:
+                del pool[key]
@@ -10,12 +10,15 @@ import gspread
 from PIL import Image
 import json
 import google.generativeai as genai
-import plotly.express as px
-import plotly.io as p_json
-import plotly
 import calendar
+import bisect
+import os
+import threading
+import time
 from io import BytesIO
-from gcp_helper import get_gspread_client_safe
+from gcp_helper import get_pooled_client, get_spreadsheet, get_worksheet, invalidate_sheet_handles
+from gspread.exceptions import APIError
+from sheets_quota import retryable_status, scheduler
 
 # ==============================================================================
 # GOOGLE SHEETS HELPER
@@ -23,207 +26,702 @@ from gcp_helper import get_gspread_client_safe
 
 def _get_gspread_client(gcp_creds_file_path: str):
     try:
-        return get_gspread_client_safe(gcp_creds_file_path)
+        return get_pooled_client(gcp_creds_file_path)
     except Exception as e:
         print(f"Lỗi nghiêm trọng khi xác thực với file credentials '{gcp_creds_file_path}': {e}")
         raise
 
+def _get_spreadsheet(sheet_id: str, gcp_creds_file_path: str):
+    try:
+        return get_spreadsheet(sheet_id, gcp_creds_file_path)
+    except Exception as e:
+        print(f"Lỗi khi mở spreadsheet '{sheet_id}': {e}")
+        invalidate_sheet_handles(sheet_id)
+        raise
+
+def _get_worksheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str | None = None):
+    """
+    Lấy worksheet từ pool dùng chung thay vì open_by_key() + worksheet() mỗi lần gọi.
+    """
+    try:
+        return get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+    except Exception as e:
+        print(f"Lỗi khi mở worksheet '{worksheet_name}': {e}")
+        invalidate_sheet_handles(sheet_id)
+        raise
+
+# ==============================================================================
+# CHỈ MỤC 'SỐ ĐẶT PHÒNG' -> SỐ HÀNG TRÊN SHEET
+# ==============================================================================
+# Giữ một chỉ mục từ mã đặt phòng sang số hàng trên sheet và header -> số cột,
+# để sửa/xóa chỉ cần một lệnh ghi theo đúng vùng thay vì get_all_values() + find().
+# Chỉ mục được cập nhật khi ứng dụng append/xóa hàng, được làm mới miễn phí mỗi
+# khi BookingStore tải lại toàn bộ giá trị, và tự kiểm tra lại (một lệnh batch_get
+# cho header + cột mã đặt phòng) khi quá ROW_INDEX_TTL_SECONDS.
+#
+# Chỉ mục chỉ sống trong một process: worker khác xóa hàng hay nhân viên sửa tay
+# trên sheet đều làm lệch số hàng mà process này không biết. Vì vậy số hàng lấy
+# từ chỉ mục KHÔNG BAO GIỜ được dùng để ghi/xóa khi chưa đối chiếu: trước mỗi lần
+# ghi, _verified_row_index() đọc header và ô mã đặt phòng tại đúng các hàng đó
+# (một lệnh batch_get); lệch ở đâu thì tải lại cả cột mã đặt phòng. Chỉ mục cũng
+# bị bỏ mỗi khi phiên bản dữ liệu dùng chung đổi (BookingStore).
+
+ROW_INDEX_TTL_SECONDS = float(os.getenv("ROW_INDEX_TTL_SECONDS", "60"))
+# Quá số ô này thì đọc lại cả cột mã đặt phòng thay vì từng ô (vẫn một lệnh gọi).
+ROW_VERIFY_MAX_CELLS = 200
+BOOKING_ID_COLUMN = 'Số đặt phòng'
+
+class SheetRowIndex:
+    """
+    Chỉ mục mã đặt phòng -> danh sách số hàng (bắt đầu từ 1, hàng 1 là header).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.header: list[str] = []
+        self.col_map: dict[str, int] = {}
+        self.id_to_rows: dict[str, list[int]] = {}
+        self.last_row = 1
+        self.built_at: float | None = None
+        # Tăng mỗi khi process này làm dịch hàng (append/xóa) hoặc invalidate, để
+        # không dựng lại chỉ mục từ dữ liệu đã tải trước thay đổi đó.
+        self.generation = 0
+        self.stats = {'verified': 0, 'mismatches': 0, 'reloads': 0}
+
+    def is_fresh(self) -> bool:
+        return self.built_at is not None and (time.monotonic() - self.built_at) < ROW_INDEX_TTL_SECONDS
+
+    def invalidate(self):
+        with self.lock:
+            self.built_at = None
+            self.generation += 1
+
+    def rebuild(self, header: list[str], id_values: list[str]):
+        """
+        id_values là giá trị cột mã đặt phòng từ hàng 2 trở đi.
+        """
+        with self.lock:
+            self.header = list(header)
+            self.col_map = {}
+            for i, name in enumerate(header):
+                self.col_map.setdefault(name, i + 1)
+            self.id_to_rows = {}
+            for offset, booking_id in enumerate(id_values):
+                if booking_id:
+                    self.id_to_rows.setdefault(booking_id, []).append(offset + 2)
+            self.last_row = len(id_values) + 1
+            self.built_at = time.monotonic()
+
+    def rebuild_from_values(self, values: list[list[str]], generation: int | None = None):
+        """
+        generation: giá trị self.generation lúc bắt đầu tải values. Nếu từ đó tới giờ
+        process này đã append/xóa hàng thì values đã cũ -> chỉ đánh dấu cần kiểm tra lại.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                self.invalidate()
+                return
+            if not values:
+                self.rebuild([], [])
+                return
+            header = values[0]
+            id_col = header.index(BOOKING_ID_COLUMN) if BOOKING_ID_COLUMN in header else None
+            ids = [row[id_col] if id_col is not None and len(row) > id_col else '' for row in values[1:]]
+            self.rebuild(header, ids)
+
+    def lookup(self, booking_id: str) -> list[int]:
+        with self.lock:
+            return list(self.id_to_rows.get(booking_id, []))
+
+    def on_rows_deleted(self, rows: list[int]):
+        """
+        Cập nhật chỉ mục sau khi xóa các hàng: bỏ các hàng đã xóa và dời các hàng phía dưới lên.
+        """
+        deleted = sorted(set(rows))
+        if not deleted:
+            return
+        deleted_set = set(deleted)
+        with self.lock:
+            self.generation += 1
+            shifted = {}
+            for booking_id, booking_rows in self.id_to_rows.items():
+                kept = [r - bisect.bisect_left(deleted, r) for r in booking_rows if r not in deleted_set]
+                if kept:
+                    shifted[booking_id] = kept
+            self.id_to_rows = shifted
+            self.last_row -= len([r for r in deleted if r <= self.last_row])
+
+    def on_rows_appended(self, booking_ids: list[str], first_row: int | None):
+        """
+        Cập nhật chỉ mục sau khi append. first_row=None nghĩa là không biết vị trí -> làm mới lần sau.
+        """
+        with self.lock:
+            self.generation += 1
+            if first_row is None:
+                self.built_at = None
+                return
+            for offset, booking_id in enumerate(booking_ids):
+                if booking_id:
+                    self.id_to_rows.setdefault(str(booking_id), []).append(first_row + offset)
+            self.last_row = max(self.last_row, first_row + len(booking_ids) - 1)
+
+_row_indexes: dict[tuple, SheetRowIndex] = {}
+_row_indexes_lock = threading.Lock()
+
+def _row_index_for(sheet_id: str, worksheet_name: str | None) -> SheetRowIndex:
+    with _row_indexes_lock:
+        return _row_indexes.setdefault((sheet_id, worksheet_name or ""), SheetRowIndex())
+
+def row_index_generation(sheet_id: str, worksheet_name: str | None) -> int:
+    """Đọc trước khi tải dữ liệu, rồi truyền vào refresh_row_index_from_values."""
+    return _row_index_for(sheet_id, worksheet_name).generation
+
+def refresh_row_index_from_values(sheet_id: str, worksheet_name: str | None, values: list[list[str]],
+                                  generation: int | None = None):
+    """
+    Làm mới chỉ mục từ dữ liệu đã tải sẵn (không tốn thêm lệnh gọi API).
+    """
+    _row_index_for(sheet_id, worksheet_name).rebuild_from_values(values, generation)
+
+def invalidate_row_index(sheet_id: str, worksheet_name: str | None):
+    _row_index_for(sheet_id, worksheet_name).invalidate()
+
+def _column_letter(col: int) -> str:
+    return gspread.utils.rowcol_to_a1(1, col).rstrip('0123456789')
+
+def _trim_row(row: list) -> list[str]:
+    # API bỏ các ô trống ở cuối hàng, get_all_values() thì không: so sánh sau khi cắt.
+    row = [str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+def get_row_index(worksheet, sheet_id: str, worksheet_name: str | None, force: bool = False) -> SheetRowIndex:
+    """
+    Trả về chỉ mục hàng còn hiệu lực, kiểm tra lại với sheet nếu đã quá hạn.
+    """
+    index = _row_index_for(sheet_id, worksheet_name)
+    with index.lock:
+        if index.is_fresh() and not force:
+            return index
+        id_col = index.col_map.get(BOOKING_ID_COLUMN)
+        if id_col:
+            # Một lệnh gọi duy nhất cho cả header và cột mã đặt phòng.
+            id_letter = _column_letter(id_col)
+            header_range, id_range = worksheet.batch_get(['1:1', f'{id_letter}:{id_letter}'])
+            header = header_range[0] if header_range else []
+            if BOOKING_ID_COLUMN in header and header.index(BOOKING_ID_COLUMN) + 1 == id_col:
+                index.rebuild(header, [row[0] if row else '' for row in id_range[1:]])
+                return index
+        index.rebuild_from_values(worksheet.get_all_values())
+        return index
+
+def _verified_row_index(worksheet, sheet_id: str, worksheet_name: str | None, booking_ids) -> SheetRowIndex:
+    """
+    Trả về chỉ mục mà số hàng của booking_ids vừa được đối chiếu với sheet.
+    Đọc header + ô mã đặt phòng tại các hàng đã biết trong một lệnh batch_get;
+    nếu có ID chưa có trong chỉ mục hoặc ô nào không khớp thì tải lại cả cột mã
+    đặt phòng. Người gọi nên giữ index.lock cho tới khi ghi xong.
+    """
+    index = get_row_index(worksheet, sheet_id, worksheet_name)
+    with index.lock:
+        booking_ids = list(dict.fromkeys(str(booking_id) for booking_id in booking_ids))
+        id_col = index.col_map.get(BOOKING_ID_COLUMN)
+        cells = [(booking_id, row) for booking_id in booking_ids for row in index.lookup(booking_id)]
+        known = all(index.lookup(booking_id) for booking_id in booking_ids)
+        if id_col and known and cells and len(cells) <= ROW_VERIFY_MAX_CELLS:
+            id_letter = _column_letter(id_col)
+            results = worksheet.batch_get(['1:1'] + [f'{id_letter}{row}' for _, row in cells])
+            header = results[0][0] if results and results[0] else []
+            values = [str(result[0][0]) if result and result[0] else '' for result in results[1:]]
+            if _trim_row(header) == _trim_row(index.header) and \
+                    all(value == booking_id for (booking_id, _), value in zip(cells, values)):
+                index.stats['verified'] += 1
+                return index
+            index.stats['mismatches'] += 1
+            print("Chỉ mục số hàng đã lệch so với Google Sheet, tải lại cột mã đặt phòng.")
+        index.stats['reloads'] += 1
+        return get_row_index(worksheet, sheet_id, worksheet_name, force=True)
+
+def get_sheet_revision(sheet_id: str, gcp_creds_file_path: str) -> str | None:
+    """
+    Trả về thời điểm sửa đổi cuối cùng (modifiedTime) của spreadsheet.
+    Đây là một lệnh gọi metadata rất nhẹ, dùng để biết có cần tải lại dữ liệu hay không.
+    """
+    try:
+        spreadsheet = _get_spreadsheet(sheet_id, gcp_creds_file_path)
+        spreadsheet.refresh_lastUpdateTime()
+        return spreadsheet.lastUpdateTime
+    except Exception as e:
+        print(f"Không lấy được revision của Google Sheet: {e}")
+        return None
+
+def fetch_sheet_values(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str | None = None) -> list[list[str]]:
+    """
+    Tải toàn bộ giá trị thô (bao gồm header) của worksheet.
+    """
+    try:
+        worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+        return worksheet.get_all_values()
+    except Exception as e:
+        print(f"Lỗi khi tải dữ liệu từ Google Sheet: {e}")
+        invalidate_sheet_handles(sheet_id)
+        raise
+
+# ==============================================================================
+# SCHEMA DỮ LIỆU ĐẶT PHÒNG
+# ==============================================================================
+# Mỗi cột được khai báo một kiểu gọn nhẹ thay vì để tất cả là chuỗi Python
+# (object): các cột có ít giá trị lặp lại thành category (mỗi hàng chỉ còn một
+# mã int8/int16), số tiền VND là int64, ngày là datetime64. Cột không khai báo
+# (tên khách, mã đặt phòng...) giữ nguyên chuỗi.
+
+BOOKING_CATEGORY_COLUMNS = ('Tình trạng', 'Người thu tiền', 'Tên chỗ nghỉ', 'Thành viên Genius')
+BOOKING_AMOUNT_COLUMNS = ('Tổng thanh toán',)
+# Ngày trên sheet luôn theo định dạng YYYY-MM-DD.
+BOOKING_DATE_COLUMNS = {'Check-in Date': '%Y-%m-%d', 'Check-out Date': '%Y-%m-%d'}
+
+# Báo cáo bộ nhớ của lần parse toàn bộ gần nhất (xem build_bookings_dataframe).
+last_schema_report: dict = {}
+
+def parse_vnd_amounts(values: pd.Series) -> pd.Series:
+    """
+    Chuyển cột số tiền (chuỗi) thành int64 VND, vectorized.
+    Giá trị đã là số được chuyển thẳng; chỉ những ô có ký tự khác (dấu phẩy,
+    "đ", khoảng trắng...) mới phải qua regex. Ô không đọc được tính là 0.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        amounts = values.astype('float64')
+    else:
+        amounts = pd.to_numeric(values, errors='coerce')
+        dirty = amounts.isna() & values.notna() & (values.astype(str) != '')
+        if dirty.any():
+            cleaned = values[dirty].astype(str).str.replace(r'[^\d.]', '', regex=True)
+            amounts[dirty] = pd.to_numeric(cleaned, errors='coerce')
+    return amounts.fillna(0).round().astype('int64')
+
+def apply_booking_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ép các cột đã khai báo về đúng kiểu (sửa trực tiếp trên df và trả về df).
+    Gọi lại an toàn trên DataFrame đã đúng kiểu.
+    """
+    for column in BOOKING_AMOUNT_COLUMNS:
+        if column in df.columns and df[column].dtype != 'int64':
+            df[column] = parse_vnd_amounts(df[column])
+    for column, date_format in BOOKING_DATE_COLUMNS.items():
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], format=date_format, errors='coerce')
+    for column in BOOKING_CATEGORY_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+def concat_booking_frames(frames: list[pd.DataFrame], **kwargs) -> pd.DataFrame:
+    """
+    pd.concat giữ được kiểu category: hợp nhất danh mục của các phần trước khi
+    nối (nếu danh mục khác nhau, pandas sẽ trả về cột object).
+    """
+    frames = [frame for frame in frames if frame is not None]
+    for column in BOOKING_CATEGORY_COLUMNS:
+        parts = [frame[column] for frame in frames if column in frame.columns]
+        if len(parts) < 2 or not all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            continue
+        categories = sorted(set().union(*(part.cat.categories for part in parts)), key=str)
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                  if column in frame.columns else frame for frame in frames]
+    return apply_booking_schema(pd.concat(frames, **kwargs))
+
+def bytes_per_row(df: pd.DataFrame) -> float:
+    return float(df.memory_usage(deep=True).sum()) / max(len(df), 1)
+
+# ==============================================================================
+# CỘT DẪN XUẤT (TÍNH MỘT LẦN KHI NẠP DỮ LIỆU)
+# ==============================================================================
+# Các cột này được thêm ngay khi parse và chỉ được đọc (không sửa) ở các route,
+# nên dashboard/lịch không phải copy cả bảng hay gọi lại .dt.to_period() mỗi
+# request. Ngày được lưu thêm dạng số ngày kể từ 1970-01-01 (int64) để so sánh
+# và searchsorted nhanh; ngày trống được mã hóa bằng MISSING_DAY.
+
+MONTH_COLUMN = 'Month_Period'
+WEEK_COLUMN = 'Week_Period'          # Tuần ISO (thứ Hai - Chủ nhật)
+CHECKIN_DAY_COLUMN = 'Checkin_Day'
+CHECKOUT_DAY_COLUMN = 'Checkout_Day'
+NIGHTS_COLUMN = 'Nights'
+CANCELLED_COLUMN = 'Is_Cancelled'
+DERIVED_COLUMNS = (MONTH_COLUMN, WEEK_COLUMN, CHECKIN_DAY_COLUMN, CHECKOUT_DAY_COLUMN,
+                   NIGHTS_COLUMN, CANCELLED_COLUMN)
+MISSING_DAY = np.iinfo(np.int64).min
+
+def date_to_day(value) -> int:
+    """Chuyển date/datetime/chuỗi ngày thành số ngày kể từ 1970-01-01."""
+    return int(np.datetime64(pd.Timestamp(value).date(), 'D').astype('int64'))
+
+def day_to_date(day: int) -> datetime.date:
+    return (np.datetime64(int(day), 'D')).astype(datetime.date)
+
+def _dates_to_days(dates: pd.Series) -> np.ndarray:
+    # NaT được numpy biểu diễn đúng bằng giá trị nhỏ nhất của int64 (MISSING_DAY).
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+
+def add_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Thêm (hoặc tính lại) các cột dẫn xuất, sửa trực tiếp trên df và trả về df.
+    """
+    if 'Check-in Date' not in df.columns:
+        return df
+    check_in = df['Check-in Date']
+    check_out = df['Check-out Date'] if 'Check-out Date' in df.columns else pd.Series(pd.NaT, index=df.index)
+    df[MONTH_COLUMN] = check_in.dt.to_period('M')
+    df[WEEK_COLUMN] = check_in.dt.to_period('W')
+    checkin_days = _dates_to_days(check_in)
+    checkout_days = _dates_to_days(check_out)
+    df[CHECKIN_DAY_COLUMN] = checkin_days
+    df[CHECKOUT_DAY_COLUMN] = checkout_days
+    valid = (checkin_days != MISSING_DAY) & (checkout_days != MISSING_DAY)
+    df[NIGHTS_COLUMN] = np.where(valid, np.maximum(checkout_days - checkin_days, 0), 0)
+    if 'Tình trạng' in df.columns:
+        df[CANCELLED_COLUMN] = (df['Tình trạng'] == 'Đã hủy').to_numpy()
+    else:
+        df[CANCELLED_COLUMN] = False
+    return df
+
+def ensure_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Trả về df nếu đã có cột dẫn xuất, nếu không thì một bản sao đã thêm cột
+    (chỉ xảy ra với DataFrame không đi qua build_bookings_dataframe).
+    """
+    if df is None or df.empty or CHECKIN_DAY_COLUMN in df.columns:
+        return df
+    return add_derived_columns(apply_booking_schema(df.copy()))
+
+def without_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Bỏ các cột dẫn xuất (khi export hoặc lưu snapshot)."""
+    return df.drop(columns=[c for c in DERIVED_COLUMNS if c in df.columns])
+
+def build_bookings_dataframe(header: list[str], rows: list[list[str]], report: bool = False) -> pd.DataFrame:
+    """
+    Chuyển các hàng thô của sheet thành DataFrame với đúng kiểu dữ liệu.
+    Được dùng cho cả lần tải đầu tiên và cho các hàng thay đổi khi đồng bộ delta.
+    report=True in ra số byte/hàng trước và sau khi áp schema.
+    """
+    df = pd.DataFrame(rows, columns=header)
+    raw_bytes = bytes_per_row(df) if report else None
+
+    apply_booking_schema(df)
+
+    if report:
+        typed_bytes = bytes_per_row(df)
+        last_schema_report.clear()
+        last_schema_report.update({
+            'rows': len(df),
+            'bytes_per_row_raw': round(raw_bytes, 1),
+            'bytes_per_row_typed': round(typed_bytes, 1),
+            'reduction': round(1 - typed_bytes / raw_bytes, 3) if raw_bytes else None,
+        })
+        print(f"Schema đặt phòng: {len(df)} hàng, {raw_bytes:.0f} -> {typed_bytes:.0f} byte/hàng.")
+    return add_derived_columns(df)
+
 def import_from_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str | None = None) -> pd.DataFrame:
     """
     Hàm này sẽ đọc dữ liệu từ Google Sheet và thực hiện việc chuyển đổi kiểu dữ liệu
     một lần duy nhất và chính xác tại đây.
     """
     try:
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
-        worksheet = sh.worksheet(worksheet_name) if worksheet_name else sh.sheet1
-        data = worksheet.get_all_values()
+        data = fetch_sheet_values(sheet_id, gcp_creds_file_path, worksheet_name)
         if not data or len(data) < 2:
             return pd.DataFrame()
-        
-        df = pd.DataFrame(data[1:], columns=data[0])
-        
-        if 'Tổng thanh toán' in df.columns:
-            df['Tổng thanh toán'] = pd.to_numeric(df['Tổng thanh toán'].astype(str).str.replace('[^\\d.]', '', regex=True), errors='coerce').fillna(0)
-        
-        # === SỬA LỖI QUAN TRỌNG NHẤT ===
-        # Ép Pandas đọc ngày tháng theo đúng định dạng YYYY-MM-DD từ sheet của bạn.
-        # Điều này loại bỏ mọi sự mơ hồ và sửa lỗi "dừng ở ngày 13".
-        # Chúng ta sẽ sử dụng các cột này trong toàn bộ ứng dụng.
-        if 'Check-in Date' in df.columns:
-            df['Check-in Date'] = pd.to_datetime(df['Check-in Date'], format='%Y-%m-%d', errors='coerce')
-        if 'Check-out Date' in df.columns:
-            df['Check-out Date'] = pd.to_datetime(df['Check-out Date'], format='%Y-%m-%d', errors='coerce')
-            
-        return df
+        return build_bookings_dataframe(data[0], data[1:], report=True)
     except Exception as e:
         print(f"Lỗi khi import từ Google Sheet: {e}")
         raise
 
 def export_data_to_new_sheet(df: pd.DataFrame, gcp_creds_file_path: str, sheet_id: str) -> str:
-    gc = _get_gspread_client(gcp_creds_file_path)
-    spreadsheet = gc.open_by_key(sheet_id)
+    spreadsheet = _get_spreadsheet(sheet_id, gcp_creds_file_path)
     worksheet_name = f"Export_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-    df_str = df.astype(str)
+    df_str = without_derived_columns(df).astype(str)
     new_worksheet = spreadsheet.add_worksheet(title=worksheet_name, rows=len(df_str) + 1, cols=df_str.shape[1])
     new_worksheet.update([df_str.columns.values.tolist()] + df_str.values.tolist(), 'A1')
     return worksheet_name
 
-def append_multiple_bookings_to_sheet(bookings: List[Dict[str, Any]], gcp_creds_file_path: str, sheet_id: str, worksheet_name: str):
-    gc = _get_gspread_client(gcp_creds_file_path)
-    spreadsheet = gc.open_by_key(sheet_id)
-    worksheet = spreadsheet.worksheet(worksheet_name)
-    header = worksheet.row_values(1)
-    rows_to_append = [[booking.get(col, '') for col in header] for booking in bookings]
-    if rows_to_append:
-        worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+def _first_appended_row(append_response: dict) -> int | None:
+    """
+    Lấy số hàng đầu tiên vừa được append từ phản hồi values.append (ví dụ "'Sheet'!A10:K12").
+    """
+    try:
+        updated_range = append_response['updates']['updatedRange']
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+def append_multiple_bookings_to_sheet(bookings: List[Dict[str, Any]], gcp_creds_file_path: str, sheet_id: str, worksheet_name: str,
+                                      skip_existing: bool = False) -> dict:
+    """
+    Thêm các booking vào cuối sheet bằng một lệnh append_rows.
+    Append không lặp lại an toàn (5xx có thể đến sau khi server đã ghi), nên
+    scheduler chỉ tự gửi lại khi bị 429: với 5xx, hàm này chờ backoff, đọc lại
+    cột mã đặt phòng và chỉ gửi lại các booking chưa có trên sheet.
+    skip_existing=True: đối chiếu như vậy ngay từ lần gửi đầu (hàng đợi ghi dùng
+    khi gửi lại một lô có thể đã được ghi). Trả về {'appended': [...], 'skipped': [...]}.
+    """
+    report = {'appended': [], 'skipped': []}
+    worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+    index = _row_index_for(sheet_id, worksheet_name)
+
+    def drop_existing(index, bookings):
+        fresh = []
+        for booking in bookings:
+            booking_id = booking.get(BOOKING_ID_COLUMN)
+            if booking_id and index.lookup(str(booking_id)):
+                report['skipped'].append(booking_id)
+            else:
+                fresh.append(booking)
+        if len(fresh) < len(bookings):
+            print(f"Bỏ qua {len(bookings) - len(fresh)} đặt phòng đã có trên sheet: {report['skipped']}")
+        return fresh
+
+    with index.lock:
+        if skip_existing:
+            index = get_row_index(worksheet, sheet_id, worksheet_name, force=True)
+            bookings = drop_existing(index, bookings)
+        attempt = 0
+        while bookings:
+            header = index.header if index.is_fresh() and index.header else worksheet.row_values(1)
+            rows_to_append = [[booking.get(col, '') for col in header] for booking in bookings]
+            try:
+                response = worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+            except APIError as e:
+                # Booking không có mã thì không đối chiếu được: không gửi lại.
+                if retryable_status(e) is None or attempt >= scheduler.max_retries \
+                        or not all(booking.get(BOOKING_ID_COLUMN) for booking in bookings):
+                    index.invalidate()
+                    raise
+                scheduler.backoff(attempt, e)
+                attempt += 1
+                index = get_row_index(worksheet, sheet_id, worksheet_name, force=True)
+                bookings = drop_existing(index, bookings)
+                continue
+            index.on_rows_appended([booking.get(BOOKING_ID_COLUMN, '') for booking in bookings],
+                                   _first_appended_row(response))
+            report['appended'] = [booking.get(BOOKING_ID_COLUMN, '') for booking in bookings]
+            break
+    return report
+
+def _cell_updates_for_row(index: SheetRowIndex, row_index: int, new_data: dict) -> list[dict]:
+    updates = []
+    for key, value in new_data.items():
+        col_index = index.col_map.get(key)
+        if col_index:
+            updates.append({
+                'range': gspread.utils.rowcol_to_a1(row_index, col_index),
+                'values': [['' if value is None else str(value)]],
+            })
+    return updates
+
+def update_multiple_rows_in_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str, updates_by_id: dict[str, dict]) -> dict:
+    """
+    Cập nhật nhiều booking cùng lúc trong MỘT lệnh batch_update.
+    Trả về báo cáo: {'success', 'updated', 'missing'}.
+    """
+    report = {'success': True, 'updated': [], 'missing': []}
+    if not updates_by_id:
+        return report
+    try:
+        worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+        index = _row_index_for(sheet_id, worksheet_name)
+        with index.lock:
+            # Số hàng phải được đối chiếu với sheet ngay trước khi ghi.
+            index = _verified_row_index(worksheet, sheet_id, worksheet_name, updates_by_id)
+
+            cell_updates = []
+            for booking_id, new_data in updates_by_id.items():
+                rows = index.lookup(booking_id)
+                if not rows:
+                    report['missing'].append(booking_id)
+                    continue
+                # Mã trùng trên nhiều hàng: cập nhật tất cả, giống như khi xóa.
+                for row_index in rows:
+                    cell_updates.extend(_cell_updates_for_row(index, row_index, new_data))
+                report['updated'].append(booking_id)
+
+            if cell_updates:
+                worksheet.batch_update(cell_updates, value_input_option='USER_ENTERED')
+                print(f"Đã cập nhật {len(cell_updates)} ô cho {len(report['updated'])} đặt phòng.")
+        return report
+    except Exception as e:
+        print(f"Lỗi nghiêm trọng khi cập nhật hàng loạt trên Google Sheet: {e}")
+        invalidate_sheet_handles(sheet_id)
+        _row_index_for(sheet_id, worksheet_name).invalidate()
+        return {'success': False, 'updated': [], 'missing': [], 'error': str(e)}
 
 def update_row_in_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str, booking_id: str, new_data: dict) -> bool:
     """
-    Tìm một hàng trong Google Sheet dựa trên booking_id và cập nhật nó.
+    Tìm hàng trong Google Sheet dựa trên booking_id và cập nhật nó.
+    Vị trí hàng lấy từ chỉ mục mã đặt phòng và được đối chiếu với sheet (một
+    lệnh đọc) trước khi ghi bằng một lệnh batch_update. Nếu mã bị trùng trên
+    nhiều hàng thì cập nhật tất cả các hàng đó.
     """
     try:
         print(f"Bắt đầu cập nhật Google Sheet cho ID: {booking_id}")
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
-        worksheet = sh.worksheet(worksheet_name)
-        
-        # Lấy toàn bộ dữ liệu để tìm đúng hàng và cột
-        data = worksheet.get_all_values()
-        if not data:
-            print("Lỗi: Sheet trống.")
-            return False
-            
-        header = data[0]
-        
-        # Tìm cột chứa 'Số đặt phòng'
-        try:
-            id_col_index = header.index('Số đặt phòng') + 1  # gspread dùng index từ 1
-        except ValueError:
-            print("Lỗi: Không tìm thấy cột 'Số đặt phòng' trong header.")
-            return False
-
-        # Tìm hàng có booking_id tương ứng
-        cell = worksheet.find(booking_id, in_column=id_col_index)
-        if not cell:
-            print(f"Lỗi: Không tìm thấy hàng với ID {booking_id} trong cột {id_col_index}.")
-            return False
-            
-        row_index = cell.row
-        print(f"Đã tìm thấy ID {booking_id} tại hàng {row_index}.")
-
-        # Tạo một danh sách các ô cần cập nhật
-        cells_to_update = []
-        for key, value in new_data.items():
-            if key in header:
-                col_index = header.index(key) + 1
-                # Thêm ô vào danh sách để cập nhật hàng loạt
-                cells_to_update.append(gspread.Cell(row=row_index, col=col_index, value=str(value)))
-
-        if cells_to_update:
-            worksheet.update_cells(cells_to_update, value_input_option='USER_ENTERED')
-            print(f"Đã cập nhật thành công {len(cells_to_update)} ô cho ID {booking_id}.")
-            return True
-        else:
-            print("Không có dữ liệu hợp lệ để cập nhật.")
-            return False
+        worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+        index = _row_index_for(sheet_id, worksheet_name)
+        with index.lock:
+            # Tìm hàng có booking_id tương ứng (đã đối chiếu với sheet)
+            index = _verified_row_index(worksheet, sheet_id, worksheet_name, [booking_id])
+
+            if BOOKING_ID_COLUMN not in index.col_map:
+                print("Lỗi: Không tìm thấy cột 'Số đặt phòng' trong header.")
+                return False
+
+            rows = index.lookup(booking_id)
+            if not rows:
+                print(f"Lỗi: Không tìm thấy hàng với ID {booking_id}.")
+                return False
+
+            print(f"Đã tìm thấy ID {booking_id} tại hàng {rows}.")
+
+            # Tạo danh sách các vùng cần cập nhật (mọi hàng mang mã này), gửi trong một lệnh duy nhất
+            updates = [update for row_index in rows for update in _cell_updates_for_row(index, row_index, new_data)]
+
+            if updates:
+                worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+                print(f"Đã cập nhật thành công {len(updates)} ô cho ID {booking_id}.")
+                return True
+            else:
+                print("Không có dữ liệu hợp lệ để cập nhật.")
+                return False
 
     except Exception as e:
         print(f"Lỗi nghiêm trọng khi cập nhật Google Sheet: {e}")
+        invalidate_sheet_handles(sheet_id)
+        _row_index_for(sheet_id, worksheet_name).invalidate()
         return False
 
+def _merge_row_ranges(row_indices: list[int]) -> list[tuple[int, int]]:
+    """
+    Gộp các chỉ số hàng (bắt đầu từ 1) liền nhau thành các khoảng [start, end].
+    Các khoảng được trả về theo thứ tự từ dưới lên trên để xóa không làm lệch chỉ số.
+    """
+    ranges = []
+    for row_index in sorted(set(row_indices)):
+        if ranges and row_index == ranges[-1][1] + 1:
+            ranges[-1][1] = row_index
+        else:
+            ranges.append([row_index, row_index])
+    return [(start, end) for start, end in reversed(ranges)]
+
+def _delete_row_ranges(worksheet, row_indices: list[int]) -> int:
+    """
+    Xóa các hàng (bắt đầu từ 1) bằng MỘT lệnh batchUpdate, mỗi khoảng liền nhau
+    là một deleteDimension. Trả về số khoảng đã gửi.
+    """
+    ranges = _merge_row_ranges(row_indices)
+    requests = [{
+        'deleteDimension': {
+            'range': {
+                'sheetId': worksheet.id,
+                'dimension': 'ROWS',
+                'startIndex': start - 1,  # API dùng index từ 0, end không bao gồm
+                'endIndex': end,
+            }
+        }
+    } for start, end in ranges]
+    worksheet.spreadsheet.batch_update({'requests': requests})
+    return len(ranges)
+
 def delete_row_in_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str, booking_id: str) -> bool:
     """
-    Tìm một hàng trong Google Sheet dựa trên booking_id và xóa nó.
+    Tìm hàng trong Google Sheet dựa trên booking_id và xóa nó. Nếu mã bị trùng
+    trên nhiều hàng thì xóa tất cả trong một lệnh batchUpdate, giống
+    delete_multiple_rows_in_gsheet.
     """
     try:
         print(f"Bắt đầu xóa trên Google Sheet cho ID: {booking_id}")
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
-        worksheet = sh.worksheet(worksheet_name)
-        
-        header = worksheet.row_values(1)
-        try:
-            id_col_index = header.index('Số đặt phòng') + 1
-        except ValueError:
-            print("Lỗi: Không tìm thấy cột 'Số đặt phòng'.")
-            return False
-
-        cell = worksheet.find(booking_id, in_column=id_col_index)
-        if not cell:
-            print(f"Lỗi: Không tìm thấy hàng với ID {booking_id} để xóa.")
-            return False
-            
-        worksheet.delete_rows(cell.row)
-        print(f"Đã xóa thành công hàng chứa ID {booking_id}.")
+        worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
+        index = _row_index_for(sheet_id, worksheet_name)
+        with index.lock:
+            # Không bao giờ xóa theo số hàng chưa được đối chiếu với sheet.
+            index = _verified_row_index(worksheet, sheet_id, worksheet_name, [booking_id])
+
+            if BOOKING_ID_COLUMN not in index.col_map:
+                print("Lỗi: Không tìm thấy cột 'Số đặt phòng'.")
+                return False
+
+            rows = index.lookup(booking_id)
+            if not rows:
+                print(f"Lỗi: Không tìm thấy hàng với ID {booking_id} để xóa.")
+                return False
+
+            _delete_row_ranges(worksheet, rows)
+            index.on_rows_deleted(rows)
+        print(f"Đã xóa thành công {len(rows)} hàng chứa ID {booking_id}.")
         return True
 
     except Exception as e:
         print(f"Lỗi nghiêm trọng khi xóa trên Google Sheet: {e}")
+        invalidate_sheet_handles(sheet_id)
+        _row_index_for(sheet_id, worksheet_name).invalidate()
         return False
 
-def delete_multiple_rows_in_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str, booking_ids: list[str]) -> bool:
+def delete_multiple_rows_in_gsheet(sheet_id: str, gcp_creds_file_path: str, worksheet_name: str, booking_ids: list[str]) -> dict:
     """
     Xóa nhiều hàng trong Google Sheet dựa trên danh sách các booking_id.
-    Phiên bản này hiệu quả và đáng tin cậy hơn.
+    Các hàng liền nhau được gộp thành khoảng và xóa bằng MỘT lệnh batchUpdate
+    (nhiều deleteDimension), thay vì gọi delete_rows() cho từng hàng.
+    Trả về báo cáo: {'success', 'deleted', 'missing', 'rows_deleted', 'ranges'}.
     """
+    report = {'success': True, 'deleted': [], 'missing': [], 'rows_deleted': 0, 'ranges': 0}
     if not booking_ids:
-        return True
+        return report
     try:
         print(f"Bắt đầu xóa hàng loạt trên Google Sheet cho các ID: {booking_ids}")
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
-        worksheet = sh.worksheet(worksheet_name)
-        
-        # 1. Đọc tất cả dữ liệu một lần duy nhất
-        all_data = worksheet.get_all_values()
-        if not all_data:
-            print("Sheet trống, không có gì để xóa.")
-            return True
-
-        header = all_data[0]
-        try:
-            # Tìm chỉ số của cột 'Số đặt phòng'
-            id_col_index = header.index('Số đặt phòng')
-        except ValueError:
-            print("Lỗi: Không tìm thấy cột 'Số đặt phòng' trong header.")
-            return False
-
-        # 2. Tạo một set các ID cần xóa để tra cứu nhanh
-        ids_to_delete_set = set(booking_ids)
-        rows_to_delete_indices = []
-
-        # 3. Tìm tất cả các chỉ số hàng cần xóa
-        # Duyệt từ hàng thứ 2 (bỏ qua header)
-        for i, row in enumerate(all_data[1:]):
-            # i bắt đầu từ 0, tương ứng với hàng 2 trong sheet
-            row_index_in_sheet = i + 2 
-            if len(row) > id_col_index:
-                booking_id_in_row = row[id_col_index]
-                if booking_id_in_row in ids_to_delete_set:
-                    rows_to_delete_indices.append(row_index_in_sheet)
-
-        # 4. Xóa các hàng từ dưới lên trên để tránh lỗi sai chỉ số
-        if rows_to_delete_indices:
-            # Sắp xếp các chỉ số theo thứ tự giảm dần
-            sorted_rows_to_delete = sorted(rows_to_delete_indices, reverse=True)
-            print(f"Đã tìm thấy {len(sorted_rows_to_delete)} hàng để xóa. Bắt đầu xóa...")
-            
-            for row_index in sorted_rows_to_delete:
-                worksheet.delete_rows(row_index)
-            
-            print(f"Đã xóa thành công {len(sorted_rows_to_delete)} hàng.")
-        else:
-            print("Không tìm thấy hàng nào khớp với các ID được cung cấp.")
+        worksheet = _get_worksheet(sheet_id, gcp_creds_file_path, worksheet_name)
         
-        return True
+        index = _row_index_for(sheet_id, worksheet_name)
+        with index.lock:
+            # 1. Lấy chỉ mục mã đặt phòng -> số hàng, đối chiếu với sheet ngay trước khi xóa
+            #    (không cần tải toàn bộ sheet; ID chưa có trong chỉ mục thì tải lại cột mã)
+            index = _verified_row_index(worksheet, sheet_id, worksheet_name, booking_ids)
+            if BOOKING_ID_COLUMN not in index.col_map:
+                print("Lỗi: Không tìm thấy cột 'Số đặt phòng' trong header.")
+                report['success'] = False
+                return report
+
+            # 2. Tìm tất cả các chỉ số hàng cần xóa
+            rows_to_delete_indices = []
+            found_ids = set()
+            for booking_id in set(booking_ids):
+                rows = index.lookup(booking_id)
+                if rows:
+                    rows_to_delete_indices.extend(rows)
+                    found_ids.add(booking_id)
+
+            report['deleted'] = [booking_id for booking_id in booking_ids if booking_id in found_ids]
+            report['missing'] = [booking_id for booking_id in booking_ids if booking_id not in found_ids]
+
+            # 3. Gộp thành các khoảng liền nhau và xóa tất cả trong một lần gọi API
+            if rows_to_delete_indices:
+                print(f"Đã tìm thấy {len(rows_to_delete_indices)} hàng. Bắt đầu xóa...")
+                report['ranges'] = _delete_row_ranges(worksheet, rows_to_delete_indices)
+                index.on_rows_deleted(rows_to_delete_indices)
+                report['rows_deleted'] = len(rows_to_delete_indices)
+                print(f"Đã xóa thành công {len(rows_to_delete_indices)} hàng.")
+            else:
+                print("Không tìm thấy hàng nào khớp với các ID được cung cấp.")
+
+        return report
 
     except Exception as e:
         # In ra lỗi chi tiết hơn để debug
         import traceback
         print(f"Lỗi nghiêm trọng khi xóa hàng loạt trên Google Sheet: {e}")
         traceback.print_exc()
-        return False
+        invalidate_sheet_handles(sheet_id)
+        _row_index_for(sheet_id, worksheet_name).invalidate()
+        report['success'] = False
+        report['deleted'] = []
+        report['error'] = str(e)
+        return report
 
 # ==============================================================================
 # LOGIC CHO MẪU TIN NHẮN (VỚI DEBUG VÀ XỬ LÝ LỖI NÂNG CAP)
@@ -239,18 +737,18 @@ def import_message_templates_from_gsheet(sheet_id: str, gcp_creds_file_path: str
     try:
         # Bước 1: Kết nối với Google Sheets
         print("Bước 1: Đang kết nối với Google Sheets...")
-        gc = _get_gspread_client(gcp_creds_file_path)
+        _get_gspread_client(gcp_creds_file_path)
         print("✓ Kết nối thành công")
         
         # Bước 2: Mở spreadsheet
         print(f"Bước 2: Đang mở spreadsheet với ID: {sheet_id}")
-        sh = gc.open_by_key(sheet_id)
+        sh = _get_spreadsheet(sheet_id, gcp_creds_file_path)
         print("✓ Mở spreadsheet thành công")
         
         # Bước 3: Tìm worksheet 'MessageTemplate'
         print("Bước 3: Đang tìm worksheet 'MessageTemplate'...")
         try:
-            worksheet = sh.worksheet('MessageTemplate')
+            worksheet = get_worksheet(sheet_id, gcp_creds_file_path, 'MessageTemplate')
             print("✓ Tìm thấy worksheet 'MessageTemplate'")
         except gspread.exceptions.WorksheetNotFound:
             print("❌ Không tìm thấy worksheet 'MessageTemplate'")
@@ -324,6 +822,7 @@ def import_message_templates_from_gsheet(sheet_id: str, gcp_creds_file_path: str
         print(f"❌ LỖI NGHIÊM TRỌNG: {e}")
         import traceback
         traceback.print_exc()
+        invalidate_sheet_handles(sheet_id)
         
         # Trả về dữ liệu mẫu nếu có lỗi
         print("Trả về dữ liệu mẫu do có lỗi...")
@@ -363,12 +862,11 @@ def export_message_templates_to_gsheet(templates: list[dict], sheet_id: str, gcp
         
     try:
         print(f"Đang export {len(templates)} templates...")
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
+        sh = _get_spreadsheet(sheet_id, gcp_creds_file_path)
         
         # Tìm hoặc tạo worksheet
         try:
-            worksheet = sh.worksheet('MessageTemplate')
+            worksheet = get_worksheet(sheet_id, gcp_creds_file_path, 'MessageTemplate')
             worksheet.clear()
             print("✓ Đã xóa dữ liệu cũ")
         except gspread.exceptions.WorksheetNotFound:
@@ -395,6 +893,7 @@ def export_message_templates_to_gsheet(templates: list[dict], sheet_id: str, gcp
         print(f"❌ Lỗi khi export: {e}")
         import traceback
         traceback.print_exc()
+        invalidate_sheet_handles(sheet_id)
         return False
 
 def safe_import_message_templates(sheet_id: str, gcp_creds_file_path: str) -> list[dict]:
@@ -433,8 +932,7 @@ def debug_message_templates_connection(sheet_id: str, gcp_creds_file_path: str):
         print("=== DEBUG MESSAGE TEMPLATES ===")
         
         # Test kết nối
-        gc = _get_gspread_client(gcp_creds_file_path)
-        sh = gc.open_by_key(sheet_id)
+        sh = _get_spreadsheet(sheet_id, gcp_creds_file_path)
         debug_info['status'] = 'connected'
         
         # Kiểm tra worksheets
@@ -470,20 +968,311 @@ def create_demo_data() -> tuple[pd.DataFrame, pd.DataFrame]:
         'Tình trạng': ['OK', 'OK', 'OK', 'OK'],
         'Tổng thanh toán': [300000, 450000, 600000, 1200000],
         'Số đặt phòng': [f'DEMO{i+1:09d}' for i in range(4)],
-        'Người thu tiền': ['LOC LE', 'THAO LE', 'THAO LE', 'LOC LE']
+        'Người thu tiền': ['LOC LE', 'THAO LE', 'THAO LE', 'LOC LE'],
+        'Thành viên Genius': ['Không', 'Có', 'Không', 'Không']
     }
     df_demo = pd.DataFrame(demo_data)
-    df_demo['Check-in Date'] = pd.to_datetime(df_demo['Ngày đến'], errors='coerce')
-    df_demo['Check-out Date'] = pd.to_datetime(df_demo['Ngày đi'], errors='coerce')
-    df_demo['Tổng thanh toán'] = pd.to_numeric(df_demo['Tổng thanh toán'], errors='coerce').fillna(0)
+    df_demo['Check-in Date'] = df_demo['Ngày đến']
+    df_demo['Check-out Date'] = df_demo['Ngày đi']
+    add_derived_columns(apply_booking_schema(df_demo))
     active_bookings_demo = df_demo[df_demo['Tình trạng'] != 'Đã hủy'].copy()
     return df_demo, active_bookings_demo
 
-def prepare_dashboard_data(df: pd.DataFrame, start_date, end_date, sort_by=None, sort_order='asc') -> dict:
+# ==============================================================================
+# KHỐI TỔNG HỢP DOANH THU / LƯỢT KHÁCH CHO DASHBOARD
+# ==============================================================================
+# Thay vì groupby toàn bộ lịch sử ở mỗi request '/', RevenueCube giữ sẵn tổng
+# doanh thu, số booking và số mã đặt phòng theo từng ô
+#
+#     (ngày check-in, chỗ nghỉ, người thu tiền, Genius, tình trạng)
+#
+# Tháng/tuần suy ra từ ngày check-in, nên cùng một khối trả lời được cả các
+# bảng theo tháng/tuần lẫn bộ lọc theo khoảng ngày của dashboard. Số ô chỉ tăng
+# theo số ngày có booking (nhân với vài tổ hợp), không theo số hàng.
+#
+# Khi sửa/xóa/thêm booking tại chỗ (BookingStore.derived), RevenueCube.updated
+# trừ phần đóng góp cũ của các hàng bị ảnh hưởng và cộng phần mới, không quét lại
+# bảng. Mỗi lần cập nhật tạo khối mới nên request đang đọc không bị ảnh hưởng.
+#
+# Tổng của khoảng ngày người dùng chọn (tổng doanh thu, số khách, doanh thu theo
+# người thu tiền) được đọc từ RangeTotals: mảng cộng dồn theo ngày check-in,
+# dựng một lần cho mỗi phiên bản khối, nên đổi khoảng ngày không phụ thuộc kích
+# thước dữ liệu.
+
+CUBE_DIMENSIONS = ['day', 'property', 'collector', 'genius', 'status']
+_CUBE_SOURCE_COLUMNS = {
+    'property': 'Tên chỗ nghỉ',
+    'collector': 'Người thu tiền',
+    'genius': 'Thành viên Genius',
+    'status': 'Tình trạng',
+}
+UNCOLLECTED_VALUES = ('', 'N/A')
+# Người thu tiền được tính là "Đã thu" trong biểu đồ Đã thu vs Chưa thu, ví dụ COLLECTOR_NAMES='LOC LE,THAO LE'.
+COLLECTOR_NAMES = tuple(name.strip() for name in os.getenv("COLLECTOR_NAMES", "LOC LE,THAO LE").split(',') if name.strip())
+
+
+class RangeTotals:
+    """
+    Tổng cộng dồn theo ngày check-in (toàn bộ và theo từng người thu tiền): tổng
+    của khoảng [first_day, last_day] bất kỳ chỉ cần hai lần tìm nhị phân và một phép trừ.
+    """
+
+    def __init__(self, days: np.ndarray, amount_cum: np.ndarray, rows_cum: np.ndarray,
+                 collectors: list, collector_amount_cum: np.ndarray, collector_rows_cum: np.ndarray):
+        self.days = days
+        self.amount_cum = amount_cum
+        self.rows_cum = rows_cum
+        self.collectors = collectors
+        self.collector_amount_cum = collector_amount_cum
+        self.collector_rows_cum = collector_rows_cum
+
+    @classmethod
+    def from_cells(cls, cells: pd.DataFrame) -> 'RangeTotals':
+        dated = cells[cells['day'] != MISSING_DAY]
+        days, day_index = np.unique(dated['day'].to_numpy(), return_inverse=True)
+        amounts = dated['amount'].to_numpy()
+        rows = dated['rows'].to_numpy()
+        # Cột 0 là tổng rỗng, nên tổng các ngày [lo, hi) = cum[hi] - cum[lo].
+        amount_cum = np.concatenate([[0], np.cumsum(np.bincount(day_index, amounts, len(days)).astype('int64'))])
+        rows_cum = np.concatenate([[0], np.cumsum(np.bincount(day_index, rows, len(days)).astype('int64'))])
+
+        has_collector = dated['collector'].notna().to_numpy()
+        codes, collectors = pd.factorize(dated['collector'][has_collector], sort=True)
+        per_amount = np.zeros((len(collectors), len(days) + 1), dtype='int64')
+        per_rows = np.zeros((len(collectors), len(days) + 1), dtype='int64')
+        np.add.at(per_amount, (codes, day_index[has_collector] + 1), amounts[has_collector])
+        np.add.at(per_rows, (codes, day_index[has_collector] + 1), rows[has_collector])
+        return cls(days, amount_cum, rows_cum, list(collectors),
+                   np.cumsum(per_amount, axis=1), np.cumsum(per_rows, axis=1))
+
+    def _bounds(self, first_day: int, last_day: int) -> tuple:
+        return (int(np.searchsorted(self.days, first_day, side='left')),
+                int(np.searchsorted(self.days, last_day, side='right')))
+
+    def totals(self, first_day: int, last_day: int) -> tuple:
+        """(tổng doanh thu, số booking) có check-in trong [first_day, last_day]."""
+        lo, hi = self._bounds(first_day, last_day)
+        if hi <= lo:
+            return 0, 0
+        return int(self.amount_cum[hi] - self.amount_cum[lo]), int(self.rows_cum[hi] - self.rows_cum[lo])
+
+    def by_collector(self, first_day: int, last_day: int) -> list:
+        """[(người thu tiền, doanh thu)] của các người thu có booking trong khoảng, theo thứ tự tên."""
+        lo, hi = self._bounds(first_day, last_day)
+        if hi <= lo:
+            return []
+        amounts = self.collector_amount_cum[:, hi] - self.collector_amount_cum[:, lo]
+        rows = self.collector_rows_cum[:, hi] - self.collector_rows_cum[:, lo]
+        return [(name, int(amount)) for name, amount, count in zip(self.collectors, amounts, rows) if count > 0]
+
+
+class RevenueCube:
+    """
+    Tổng (doanh thu, số booking, số mã đặt phòng) theo ô (ngày, chỗ nghỉ, người thu, Genius, tình trạng).
+    """
+
+    def __init__(self, cells: dict, row_keys: list, row_amounts: np.ndarray, row_has_id: np.ndarray):
+        # ô -> (doanh thu, số booking, số booking có mã); tuple để sao chép nông khi cập nhật.
+        self.cells = cells
+        # Đóng góp của từng hàng DataFrame (theo vị trí), để cập nhật theo delta.
+        self.row_keys = row_keys
+        self.row_amounts = row_amounts
+        self.row_has_id = row_has_id
+        self._frame = None
+        self._all_time = None
+        self._range_totals = None
+
+    @staticmethod
+    def _row_contributions(df: pd.DataFrame, positions=None) -> tuple:
+        """(khóa ô, doanh thu, có mã) của các hàng ở `positions` (mặc định mọi hàng)."""
+        rows = df if positions is None else df.iloc[positions]
+        dimensions = [rows[CHECKIN_DAY_COLUMN].tolist()]
+        for column in _CUBE_SOURCE_COLUMNS.values():
+            if column in rows.columns:
+                dimensions.append([None if pd.isna(value) else str(value) for value in rows[column].tolist()])
+            else:
+                dimensions.append([None] * len(rows))
+        amounts = rows['Tổng thanh toán'].to_numpy().astype('int64')
+        has_id = rows['Số đặt phòng'].notna().to_numpy()
+        return list(zip(*dimensions)), amounts, has_id
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'RevenueCube':
+        if df is None or df.empty:
+            return cls({}, [], np.zeros(0, dtype='int64'), np.zeros(0, dtype=bool))
+        df = ensure_derived_columns(df)
+        row_keys, amounts, has_id = cls._row_contributions(df)
+        frame = pd.DataFrame({'key': row_keys, 'amount': amounts, 'rows': 1, 'ids': has_id.astype('int64')})
+        totals = frame.groupby('key', sort=False)[['amount', 'rows', 'ids']].sum()
+        cells = {key: (int(a), int(r), int(i)) for key, a, r, i in
+                 zip(totals.index, totals['amount'], totals['rows'], totals['ids'])}
+        return cls(cells, row_keys, amounts, has_id)
+
+    def _add(self, key, amount: int, has_id: bool, sign: int):
+        amount_total, rows, ids = self.cells.get(key, (0, 0, 0))
+        rows += sign
+        if rows == 0:
+            self.cells.pop(key, None)
+        else:
+            self.cells[key] = (amount_total + sign * amount, rows, ids + sign * int(has_id))
+
+    def updated(self, change: dict, df: pd.DataFrame) -> 'RevenueCube':
+        """
+        Khối mới sau một thay đổi tại chỗ (xem BookingStore.derived).
+        """
+        positions = sorted(change['positions'])
+        new = RevenueCube(dict(self.cells),
+                          list(self.row_keys), self.row_amounts.copy(), self.row_has_id.copy())
+        if change['kind'] in ('update', 'delete'):
+            for position in positions:
+                new._add(new.row_keys[position], int(new.row_amounts[position]), new.row_has_id[position], -1)
+        if change['kind'] == 'delete':
+            removed = set(positions)
+            new.row_keys = [key for i, key in enumerate(new.row_keys) if i not in removed]
+            new.row_amounts = np.delete(new.row_amounts, positions)
+            new.row_has_id = np.delete(new.row_has_id, positions)
+            return new
+        if change['kind'] not in ('update', 'append'):
+            raise ValueError(f"Loại thay đổi không hỗ trợ: {change['kind']}")
+
+        df = ensure_derived_columns(df)
+        if change['kind'] == 'append':
+            grow = len(df) - len(new.row_keys)
+            new.row_keys.extend([None] * grow)
+            new.row_amounts = np.concatenate([new.row_amounts, np.zeros(grow, dtype='int64')])
+            new.row_has_id = np.concatenate([new.row_has_id, np.zeros(grow, dtype=bool)])
+        keys, amounts, has_id = self._row_contributions(df, np.asarray(positions, dtype='int64'))
+        for position, key, amount, row_has_id in zip(positions, keys, amounts, has_id):
+            new._add(key, int(amount), row_has_id, 1)
+            new.row_keys[position], new.row_amounts[position], new.row_has_id[position] = key, amount, row_has_id
+        return new
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Các ô dưới dạng DataFrame (kèm tháng/tuần và cờ đã thu theo COLLECTOR_NAMES),
+        tính một lần cho mỗi phiên bản khối.
+        """
+        if self._frame is None:
+            frame = pd.DataFrame(list(self.cells.keys()), columns=CUBE_DIMENSIONS)
+            values = np.array(list(self.cells.values()), dtype='int64').reshape(-1, 3)
+            frame['amount'], frame['rows'], frame['ids'] = values[:, 0], values[:, 1], values[:, 2]
+            frame['day'] = frame['day'].astype('int64')
+            dates = pd.Series(np.where(frame['day'] == MISSING_DAY, np.datetime64('NaT'),
+                                       frame['day'].to_numpy().astype('datetime64[D]')).astype('datetime64[ns]'))
+            frame[MONTH_COLUMN] = dates.dt.to_period('M')
+            frame[WEEK_COLUMN] = dates.dt.to_period('W')
+            frame['collected'] = frame['collector'].isin(COLLECTOR_NAMES)
+            self._frame = frame
+        return self._frame
+
+    def all_time_tables(self) -> dict:
+        """
+        Các bảng "toàn thời gian" của dashboard (không phụ thuộc bộ lọc ngày),
+        tính một lần cho mỗi phiên bản khối. Kết quả chỉ được đọc.
+        """
+        if self._all_time is not None:
+            return self._all_time
+        cells = self.frame()
+        dated = cells[cells['day'] != MISSING_DAY]
+
+        # 1. Doanh thu hàng tháng trên toàn bộ dữ liệu
+        monthly_revenue = dated.groupby(MONTH_COLUMN)['amount'].sum().reset_index()
+        monthly_revenue['Tháng'] = monthly_revenue[MONTH_COLUMN].dt.strftime('%Y-%m')
+        monthly_revenue = monthly_revenue[['Tháng', 'amount']].rename(columns={'amount': 'Doanh thu'})
+
+        # 2. Doanh thu đã thu hàng tháng
+        collected = dated[dated['collector'].notna() & ~dated['collector'].isin(UNCOLLECTED_VALUES)]
+        if not collected.empty:
+            monthly_collected_revenue = collected.groupby(MONTH_COLUMN)['amount'].sum().reset_index()
+            monthly_collected_revenue['Tháng'] = monthly_collected_revenue[MONTH_COLUMN].dt.strftime('%Y-%m')
+            monthly_collected_revenue = monthly_collected_revenue[['Tháng', 'amount']].rename(columns={'amount': 'Doanh thu đã thu'})
+        else:
+            monthly_collected_revenue = pd.DataFrame(columns=['Tháng', 'Doanh thu đã thu'])
+
+        # 3. Thống kê Genius (kể cả booking chưa có ngày check-in)
+        genius_stats = cells[cells['genius'].notna()].groupby('genius')[['amount', 'ids']].sum().reset_index()
+        genius_stats.columns = ['Thành viên Genius', 'Tổng doanh thu', 'Số lượng booking']
+
+        # 4. Khách hàng hàng tháng (all time)
+        monthly_guests = dated.groupby(MONTH_COLUMN)['rows'].sum().reset_index(name='Số khách')
+        monthly_guests['Tháng'] = monthly_guests[MONTH_COLUMN].dt.strftime('%Y-%m')
+        monthly_guests = monthly_guests[['Tháng', 'Số khách']]
+
+        # 5. Khách hàng hàng tuần (all time)
+        weekly_guests = dated.groupby(WEEK_COLUMN)['rows'].sum().reset_index(name='Số khách')
+        weekly_guests['Tuần'] = weekly_guests[WEEK_COLUMN].astype(str)
+        weekly_guests = weekly_guests[['Tuần', 'Số khách']]
+
+        self._all_time = {
+            'monthly_revenue': monthly_revenue,
+            'monthly_collected_revenue': monthly_collected_revenue,
+            'genius_stats': genius_stats,
+            'monthly_guests': monthly_guests,
+            'weekly_guests': weekly_guests,
+        }
+        return self._all_time
+
+    def range_totals(self) -> RangeTotals:
+        """Chỉ mục tổng cộng dồn theo ngày, tính một lần cho mỗi phiên bản khối."""
+        if self._range_totals is None:
+            self._range_totals = RangeTotals.from_cells(self.frame())
+        return self._range_totals
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+
+def collected_vs_uncollected_monthly(cube: RevenueCube, first_day: int, last_day: int,
+                                     collectors: Optional[tuple] = None) -> pd.DataFrame:
+    """
+    Doanh thu "Đã thu" / "Chưa thu" theo tháng của các booking có check-in trong
+    [first_day, last_day]. Đã thu là booking có người thu tiền thuộc `collectors`
+    (mặc định COLLECTOR_NAMES), còn lại (kể cả chưa có người thu) là chưa thu.
+    Trả về DataFrame ['Tháng', 'Đã thu', 'Chưa thu'] sắp theo tháng.
+    """
+    columns = ['Tháng', 'Đã thu', 'Chưa thu']
+    cells = cube.frame()
+    if cells.empty:
+        return pd.DataFrame(columns=columns)
+    collected = cells['collected'] if collectors is None else cells['collector'].isin(collectors)
+    in_range = ((cells['day'] != MISSING_DAY) & (cells['day'] >= first_day) & (cells['day'] <= last_day)).to_numpy()
+    if not in_range.any():
+        return pd.DataFrame(columns=columns)
+
+    # Một lần groupby (tháng, cờ đã thu) rồi xoay cờ thành hai cột.
+    pivot = (cells.loc[in_range, 'amount']
+             .groupby([cells.loc[in_range, MONTH_COLUMN], collected[in_range]])
+             .sum()
+             .unstack(fill_value=0)
+             .reindex(columns=[True, False], fill_value=0))
+    return pd.DataFrame({
+        'Tháng': pivot.index.strftime('%Y-%m'),
+        'Đã thu': pivot[True].to_numpy(),
+        'Chưa thu': pivot[False].to_numpy(),
+    })
+
+def dashboard_day_range(start_date, end_date) -> tuple:
+    """
+    Khoảng ngày check-in [first_day, last_day] mà dashboard tính cho bộ lọc
+    (start_date, end_date), không tính booking tương lai.
+    """
+    # Ngày check-in luôn là 00:00, nên "check-in >= start" với start có giờ tương
+    # đương ngày bắt đầu là ngày hôm sau; "check-in <= end/now" là ngày của end/now.
+    start_ts = pd.Timestamp(start_date)
+    first_day = date_to_day(start_ts) + int(start_ts != start_ts.normalize())
+    last_day = min(date_to_day(end_date), date_to_day(pd.Timestamp.now()))
+    return first_day, last_day
+
+def prepare_dashboard_data(df: pd.DataFrame, start_date, end_date, sort_by=None, sort_order='asc',
+                           cube: Optional[RevenueCube] = None) -> dict:
     """
     Chuẩn bị tất cả dữ liệu cho Dashboard với bộ lọc và sắp xếp động.
+    Mọi số liệu được đọc từ RevenueCube (truyền cube đã tính sẵn cho phiên bản
+    dữ liệu hiện tại, nếu không sẽ dựng từ df).
     """
-    if df.empty:
+    if cube is None:
+        cube = RevenueCube.from_dataframe(df)
+    if len(cube) == 0:
         return {
             'total_revenue_selected': 0,
             'total_guests_selected': 0,
@@ -492,72 +1281,30 @@ def prepare_dashboard_data(df: pd.DataFrame, start_date, end_date, sort_by=None,
             'monthly_collected_revenue': pd.DataFrame(),
             'genius_stats': pd.DataFrame(),
             'monthly_guests_all_time': pd.DataFrame(),
-            'weekly_guests_all_time': pd.DataFrame()
+            'weekly_guests_all_time': pd.DataFrame(),
+            'collected_vs_uncollected_monthly': pd.DataFrame(columns=['Tháng', 'Đã thu', 'Chưa thu'])
         }
 
-    # Đảm bảo cột ngày tháng đúng định dạng
-    df = df.copy()
-    df['Check-in Date'] = pd.to_datetime(df['Check-in Date'])
-
     # --- TÍNH TOÁN TRƯỚC KHI LỌC (ALL TIME DATA) ---
-    
-    # 1. Doanh thu hàng tháng trên toàn bộ dữ liệu
-    df_with_period = df.copy()
-    df_with_period['Month_Period'] = df_with_period['Check-in Date'].dt.to_period('M')
-    monthly_revenue = df_with_period.groupby('Month_Period')['Tổng thanh toán'].sum().reset_index()
-    monthly_revenue['Tháng'] = monthly_revenue['Month_Period'].dt.strftime('%Y-%m')
-    monthly_revenue = monthly_revenue[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Doanh thu'})
-
-    # 2. Doanh thu đã thu hàng tháng
-    collected_df = df[df['Người thu tiền'].notna() & (df['Người thu tiền'] != '') & (df['Người thu tiền'] != 'N/A')].copy()
-    if not collected_df.empty:
-        collected_df['Month_Period'] = collected_df['Check-in Date'].dt.to_period('M')
-        monthly_collected_revenue = collected_df.groupby('Month_Period')['Tổng thanh toán'].sum().reset_index()
-        monthly_collected_revenue['Tháng'] = monthly_collected_revenue['Month_Period'].dt.strftime('%Y-%m')
-        monthly_collected_revenue = monthly_collected_revenue[['Tháng', 'Tổng thanh toán']].rename(columns={'Tổng thanh toán': 'Doanh thu đã thu'})
-    else:
-        monthly_collected_revenue = pd.DataFrame(columns=['Tháng', 'Doanh thu đã thu'])
-
-    # 3. Thống kê Genius
-    genius_stats = df.groupby('Thành viên Genius').agg({
-        'Tổng thanh toán': 'sum',
-        'Số đặt phòng': 'count'
-    }).reset_index()
-    genius_stats.columns = ['Thành viên Genius', 'Tổng doanh thu', 'Số lượng booking']
-
-    # 4. Khách hàng hàng tháng (all time)
-    monthly_guests = df_with_period.groupby('Month_Period').size().reset_index(name='Số khách')
-    monthly_guests['Tháng'] = monthly_guests['Month_Period'].dt.strftime('%Y-%m')
-    monthly_guests = monthly_guests[['Tháng', 'Số khách']]
-
-    # 5. Khách hàng hàng tuần (all time)
-    df_with_week = df.copy()
-    df_with_week['Week_Period'] = df_with_week['Check-in Date'].dt.to_period('W')
-    weekly_guests = df_with_week.groupby('Week_Period').size().reset_index(name='Số khách')
-    weekly_guests['Tuần'] = weekly_guests['Week_Period'].astype(str)
-    weekly_guests = weekly_guests[['Tuần', 'Số khách']]
+    all_time = cube.all_time_tables()
+    monthly_revenue = all_time['monthly_revenue']
+    monthly_collected_revenue = all_time['monthly_collected_revenue']
+    genius_stats = all_time['genius_stats']
+    monthly_guests = all_time['monthly_guests']
+    weekly_guests = all_time['weekly_guests']
 
     # --- LỌC DỮ LIỆU THEO THỜI GIAN NGƯỜI DÙNG CHỌN ---
-    start_ts = pd.Timestamp(start_date)
-    end_ts = pd.Timestamp(end_date)
-    
-    # Lọc theo khoảng thời gian và loại bỏ booking tương lai
-    df_filtered = df[
-        (df['Check-in Date'] >= start_ts) & 
-        (df['Check-in Date'] <= end_ts) &
-        (df['Check-in Date'] <= pd.Timestamp.now())
-    ].copy()
+    first_day, last_day = dashboard_day_range(start_date, end_date)
+    range_totals = cube.range_totals()
 
     # --- TÍNH TOÁN CÁC CHỈ SỐ THEO THỜI GIAN ĐÃ CHỌN ---
-    total_revenue_selected = df_filtered['Tổng thanh toán'].sum()
-    total_guests_selected = len(df_filtered)
+    total_revenue_selected, total_guests_selected = range_totals.totals(first_day, last_day)
     
     # Doanh thu theo người thu tiền (trong khoảng thời gian đã chọn)
-    collector_revenue_selected = df_filtered.groupby('Người thu tiền')['Tổng thanh toán'].sum().reset_index()
+    collector_revenue_selected = pd.DataFrame(range_totals.by_collector(first_day, last_day),
+                                              columns=['Người thu tiền', 'Tổng thanh toán'])
     collector_revenue_selected = collector_revenue_selected[
-        collector_revenue_selected['Người thu tiền'].notna() & 
-        (collector_revenue_selected['Người thu tiền'] != '') & 
-        (collector_revenue_selected['Người thu tiền'] != 'N/A')
+        ~collector_revenue_selected['Người thu tiền'].isin(UNCOLLECTED_VALUES)
     ]
 
     # --- SẮP XẾP ĐỘNG ---
@@ -581,6 +1328,7 @@ def prepare_dashboard_data(df: pd.DataFrame, start_date, end_date, sort_by=None,
         'genius_stats': genius_stats,
         'monthly_guests_all_time': monthly_guests,
         'weekly_guests_all_time': weekly_guests,
+        'collected_vs_uncollected_monthly': collected_vs_uncollected_monthly(cube, first_day, last_day),
     }
 
 def extract_booking_info_from_image_content(image_bytes: bytes) -> List[Dict[str, Any]]:
@@ -702,72 +1450,66 @@ def parse_app_standard_date(date_input: Any) -> Optional[datetime.date]:
 
     return None
 
-def get_daily_activity(date_to_check: datetime.date, df: pd.DataFrame) -> dict:
+def _activity_records(df: pd.DataFrame, rows: np.ndarray) -> list[dict]:
+    """
+    Lấy các hàng theo mask hoặc vị trí (chỉ các cột gốc), ngày trả về dạng datetime.date như trước.
+    """
+    columns = [c for c in df.columns if c not in DERIVED_COLUMNS]
+    subset = df.loc[rows, columns] if rows.dtype == bool else df.iloc[rows][columns]
+    if subset.empty:
+        return []
+    subset = subset.assign(**{
+        column: subset[column].dt.date for column in ('Check-in Date', 'Check-out Date') if column in subset.columns
+    })
+    return subset.to_dict(orient='records')
+
+def get_daily_activity(date_to_check: datetime.date, df: pd.DataFrame, stay_index=None) -> dict:
     """
     Hàm này tính toán các hoạt động cho một ngày cụ thể, bao gồm:
     - Khách check-in hôm nay.
     - Khách check-out hôm nay.
     - Khách đang ở (đã check-in trước đó và chưa check-out).
+    stay_index (occupancy.StayIndex dựng trên đúng df này) cho phép tra cứu
+    theo ngày mà không quét cả bảng.
     """
     if df is None or df.empty:
         return {'check_in': [], 'check_out': [], 'staying_over': []}
 
-    df_local = df.copy()
+    if stay_index is not None:
+        day = date_to_day(date_to_check)
+        return {
+            'check_in': _activity_records(df, stay_index.arrivals(day)),
+            'check_out': _activity_records(df, stay_index.departures(day)),
+            'staying_over': _activity_records(df, stay_index.staying_over(day)),
+        }
 
-    # Chuyển đổi cột datetime sang date để so sánh chính xác ngày.
-    df_local['Check-in Date'] = pd.to_datetime(df_local['Check-in Date'], errors='coerce').dt.date
-    df_local['Check-out Date'] = pd.to_datetime(df_local['Check-out Date'], errors='coerce').dt.date
+    # So sánh trên cột số ngày đã tính sẵn, không copy hay chuyển đổi lại cả bảng.
+    df = ensure_derived_columns(df)
+    day = date_to_day(date_to_check)
+    checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()
+    checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()
 
-    # Lọc các booking có tình trạng OK
-    active_bookings = df_local[df_local['Tình trạng'] != 'Đã hủy'].copy()
-    if active_bookings.empty:
+    # Chỉ lấy các booking chưa hủy
+    active = ~df[CANCELLED_COLUMN].to_numpy()
+    if not active.any():
         return {'check_in': [], 'check_out': [], 'staying_over': []}
 
-    # 1. Lấy khách CHECK-IN hôm nay
-    check_ins_df = active_bookings[active_bookings['Check-in Date'] == date_to_check]
-
-    # 2. Lấy khách CHECK-OUT hôm nay
-    check_outs_df = active_bookings[active_bookings['Check-out Date'] == date_to_check]
-
-    # 3. Lấy khách ĐANG Ở (không check-in và cũng không check-out hôm nay)
-    staying_over_df = active_bookings[
-        (active_bookings['Check-in Date'] < date_to_check) &
-        (active_bookings['Check-out Date'] > date_to_check)
-    ]
-    
-    # Trả về toàn bộ thông tin của các booking này dưới dạng dictionary
+    # 1. Khách CHECK-IN hôm nay, 2. khách CHECK-OUT hôm nay,
+    # 3. khách ĐANG Ở (không check-in và cũng không check-out hôm nay).
+    # Ngày trống (MISSING_DAY) nhỏ hơn mọi ngày nên không lọt vào điều kiện "> day".
     return {
-        'check_in': check_ins_df.to_dict(orient='records'),
-        'check_out': check_outs_df.to_dict(orient='records'),
-        'staying_over': staying_over_df.to_dict(orient='records')
+        'check_in': _activity_records(df, active & (checkin_days == day)),
+        'check_out': _activity_records(df, active & (checkout_days == day)),
+        'staying_over': _activity_records(df, active & (checkin_days != MISSING_DAY)
+                                          & (checkin_days < day) & (checkout_days > day)),
     }
 
-def get_overall_calendar_day_info(date_to_check: datetime.date, df: pd.DataFrame, total_capacity: int) -> dict:
+def calendar_day_status(occupied_units: int, total_capacity: int) -> dict:
     """
-    Hàm này tính toán công suất phòng và trả về cả thông tin trạng thái và màu sắc.
+    Văn bản và màu sắc của một ngày trên lịch theo số phòng đang có khách.
     """
-    if df is None or df.empty or total_capacity == 0:
-        return {
-            'occupied_units': 0, 'available_units': total_capacity,
-            'status_text': "Trống", 'status_color': 'empty' # Màu cho ngày trống
-        }
-
-    df_local = df.copy()
-
-    df_local['Check-in Date'] = pd.to_datetime(df_local['Check-in Date'], errors='coerce').dt.date
-    df_local['Check-out Date'] = pd.to_datetime(df_local['Check-out Date'], errors='coerce').dt.date
-
-    active_on_date = df_local[
-        (df_local['Check-in Date'].notna()) &
-        (df_local['Check-out Date'].notna()) &
-        (df_local['Check-in Date'] <= date_to_check) & 
-        (df_local['Check-out Date'] > date_to_check) &
-        (df_local['Tình trạng'] != 'Đã hủy')
-    ]
-    
-    occupied_units = len(active_on_date)
     available_units = max(0, total_capacity - occupied_units)
-    
+
     # Quyết định văn bản và màu sắc dựa trên tình trạng
     if occupied_units == 0:
         status_text = "Trống"
@@ -786,6 +1528,29 @@ def get_overall_calendar_day_info(date_to_check: datetime.date, df: pd.DataFrame
         'status_color': status_color  # Trả về thêm thông tin màu sắc
     }
 
+def get_overall_calendar_day_info(date_to_check: datetime.date, df: pd.DataFrame, total_capacity: int) -> dict:
+    """
+    Hàm này tính toán công suất phòng và trả về cả thông tin trạng thái và màu sắc.
+    """
+    if df is None or df.empty or total_capacity == 0:
+        return {
+            'occupied_units': 0, 'available_units': total_capacity,
+            'status_text': "Trống", 'status_color': 'empty' # Màu cho ngày trống
+        }
+
+    df = ensure_derived_columns(df)
+    day = date_to_day(date_to_check)
+    checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()
+    checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()
+    active_on_date = (
+        (checkin_days != MISSING_DAY) &
+        (checkout_days != MISSING_DAY) &
+        (checkin_days <= day) &
+        (checkout_days > day) &
+        ~df[CANCELLED_COLUMN].to_numpy()
+    )
+    return calendar_day_status(int(active_on_date.sum()), total_capacity)
+
 def delete_booking_by_id(df: pd.DataFrame, booking_id: str) -> pd.DataFrame:
     """
     Tìm và xóa một đặt phòng dựa trên Số đặt phòng.
@@ -819,15 +1584,52 @@ def update_booking_by_id(df: pd.DataFrame, booking_id: str, new_data: dict) -> p
         for key, value in new_data.items():
             if key in df.columns:
                 # Chuyển đổi kiểu dữ liệu trước khi gán
-                if 'Date' in key and value:
-                    df.loc[idx, key] = pd.to_datetime(value)
-                elif 'thanh toán' in key.lower() and value:
-                    df.loc[idx, key] = float(value)
+                if 'Date' in key:
+                    df.loc[idx, key] = pd.to_datetime(value) if value else pd.NaT
+                elif 'thanh toán' in key.lower():
+                    df.loc[idx, key] = int(parse_vnd_amounts(pd.Series([value]))[0])
                 else:
+                    if isinstance(df[key].dtype, pd.CategoricalDtype) and value is not None \
+                            and value not in df[key].cat.categories:
+                        df[key] = df[key].cat.set_categories(sorted([*df[key].cat.categories, value], key=str))
                     df.loc[idx, key] = value
+
+        # Tính lại cột dẫn xuất cho riêng hàng vừa sửa.
+        if CHECKIN_DAY_COLUMN in df.columns:
+            row = add_derived_columns(df.loc[[idx]].copy())
+            for column in DERIVED_COLUMNS:
+                df.at[idx, column] = row.at[idx, column]
         
         print(f"Đã cập nhật đặt phòng có ID: {booking_id}")
     else:
         print(f"Không tìm thấy đặt phòng có ID: {booking_id} để cập nhật.")
 
-    return df
\ No newline at end of file
+    return df
+
+def update_booking_row(df: pd.DataFrame, position: int, new_data: dict) -> pd.DataFrame:
+    """
+    Trả về DataFrame mới với hàng thứ position đã được cập nhật, không sửa df.
+    Copy-on-write theo cột: chỉ các cột có giá trị thay đổi (kể cả cột dẫn xuất)
+    được sao chép, các cột còn lại dùng chung dữ liệu với df.
+    """
+    row = df.iloc[[position]].copy()
+    row = update_booking_by_id(row, row['Số đặt phòng'].iloc[0], new_data)
+    columns = [key for key in new_data if key in df.columns]
+    if CHECKIN_DAY_COLUMN in df.columns:
+        columns += [column for column in DERIVED_COLUMNS if column in df.columns]
+
+    updated = df.copy(deep=False)
+    for column in dict.fromkeys(columns):
+        value = row[column].iloc[0]
+        series = df[column]
+        current = series.iloc[position]
+        if (pd.isna(value) and pd.isna(current)) or (not pd.isna(value) and not pd.isna(current) and value == current):
+            continue
+        if isinstance(series.dtype, pd.CategoricalDtype) and not pd.isna(value) \
+                and value not in series.cat.categories:
+            series = series.cat.set_categories(sorted([*series.cat.categories, value], key=str))
+        else:
+            series = series.copy()
+        series.iloc[position] = value
+        updated[column] = series
+    return updated
\ No newline at end of file
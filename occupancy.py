@@ -0,0 +1,895 @@
+import os
+import json
+import calendar
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from logic import (
+    CANCELLED_COLUMN, CHECKIN_DAY_COLUMN, CHECKOUT_DAY_COLUMN, MISSING_DAY,
+    calendar_day_status, date_to_day, day_to_date, ensure_derived_columns
+)
+
+PROPERTY_COLUMN = 'Tên chỗ nghỉ'
+# Số phòng/căn của mỗi chỗ nghỉ, ví dụ PROPERTY_CAPACITIES='{"Home in Old Quarter": 2}'.
+# Chỗ nghỉ không được khai báo dùng DEFAULT_PROPERTY_CAPACITY.
+DEFAULT_PROPERTY_CAPACITY = int(os.getenv("DEFAULT_PROPERTY_CAPACITY", "1"))
+
+
+def load_property_capacities() -> dict:
+    raw = os.getenv("PROPERTY_CAPACITIES")
+    if not raw:
+        return {}
+    try:
+        return {str(name): int(capacity) for name, capacity in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"PROPERTY_CAPACITIES không hợp lệ, dùng sức chứa mặc định: {e}")
+        return {}
+
+
+PROPERTY_CAPACITIES = load_property_capacities()
+
+# ==============================================================================
+# CÔNG SUẤT PHÒNG THEO NGÀY (VECTORIZED)
+# ==============================================================================
+# Thay vì lọc toàn bộ bảng cho từng ngày của lịch, StayTimeline giữ hai mảng
+# đã sắp xếp: ngày check-in và ngày check-out của các booking còn hiệu lực.
+# Số phòng có khách trong ngày D (ở trong khoảng [check-in, check-out)) là
+#
+#     #(check-in <= D) - #(check-out <= D)
+#
+# nên cả một tháng chỉ cần hai lần np.searchsorted trên mảng đã sắp xếp, không
+# phụ thuộc vào độ dài lịch sử đặt phòng. Timeline được dựng một lần cho mỗi
+# phiên bản dữ liệu (BookingStore.derived).
+
+
+class StayTimeline:
+    """
+    Ngày check-in/check-out (số ngày kể từ 1970-01-01) đã sắp xếp của các booking chưa hủy.
+    """
+
+    def __init__(self, checkin_days: np.ndarray, checkout_days: np.ndarray):
+        self.starts = np.sort(checkin_days)
+        self.ends = np.sort(checkout_days)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'StayTimeline':
+        if df is None or df.empty:
+            empty = np.empty(0, dtype='int64')
+            return cls(empty, empty)
+        df = ensure_derived_columns(df)
+        checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()
+        checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()
+        # Chỉ các lượt ở hợp lệ: đủ hai ngày, chưa hủy và check-out sau check-in.
+        valid = ((checkin_days != MISSING_DAY) & (checkout_days != MISSING_DAY)
+                 & (checkout_days > checkin_days) & ~df[CANCELLED_COLUMN].to_numpy())
+        return cls(checkin_days[valid], checkout_days[valid])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def occupied_counts(self, first_day: int, last_day: int) -> np.ndarray:
+        """
+        Số lượt ở đang diễn ra cho mỗi ngày trong [first_day, last_day] (tính cả hai đầu).
+        """
+        days = np.arange(first_day, last_day + 1, dtype='int64')
+        return (np.searchsorted(self.starts, days, side='right')
+                - np.searchsorted(self.ends, days, side='right'))
+
+
+def get_calendar_occupancy(start_date: datetime.date, end_date: datetime.date, timeline: StayTimeline,
+                           total_capacity: int) -> dict:
+    """
+    Công suất phòng cho mọi ngày trong [start_date, end_date]. Trả về
+    {date: {'occupied_units', 'available_units', 'status_text', 'status_color'}},
+    giống hệt kết quả của get_overall_calendar_day_info cho từng ngày.
+    """
+    first_day, last_day = date_to_day(start_date), date_to_day(end_date)
+    if last_day < first_day:
+        return {}
+    if total_capacity == 0:
+        counts = np.zeros(last_day - first_day + 1, dtype='int64')
+    else:
+        counts = timeline.occupied_counts(first_day, last_day)
+    return {
+        day_to_date(first_day + offset): calendar_day_status(int(count), total_capacity)
+        for offset, count in enumerate(counts)
+    }
+
+
+# ==============================================================================
+# HEATMAP CÔNG SUẤT VÀ DOANH THU THEO NGÀY (CẢ NĂM)
+# ==============================================================================
+# Xem tính mùa vụ trước đây phải lật 12 trang lịch. DailySeries quét bảng một
+# lần cho mỗi phiên bản dữ liệu và giữ các mảng theo ngày trên toàn bộ lịch sử:
+# số phòng có khách (np.add.at +1/-1 rồi cumsum), số lượt đến và doanh thu theo
+# ngày check-in (np.bincount). Mỗi request chỉ cắt một đoạn của các mảng này.
+#
+# Mọi chuỗi chỉ tính booking chưa hủy, kể cả doanh thu; vì vậy doanh thu ở đây
+# thấp hơn doanh thu theo tháng check-in của dashboard (tính cả đơn đã hủy).
+# Kết quả có 'excludes_cancelled': True để ghi rõ điều đó.
+
+
+class DailySeries:
+    """
+    Các mảng theo ngày (bắt đầu từ ngày origin) trên toàn bộ dữ liệu đặt phòng.
+    """
+
+    def __init__(self, origin: int, occupied: np.ndarray, arrivals: np.ndarray, revenue: np.ndarray):
+        self.origin = origin
+        self.occupied = occupied
+        self.arrivals = arrivals
+        self.revenue = revenue
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'DailySeries':
+        empty = np.zeros(0, dtype='int64')
+        if df is None or df.empty:
+            return cls(0, empty, empty, empty)
+        df = ensure_derived_columns(df)
+        checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()
+        checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()
+        active = ~df[CANCELLED_COLUMN].to_numpy() & (checkin_days != MISSING_DAY)
+        stays = active & (checkout_days != MISSING_DAY) & (checkout_days > checkin_days)
+        if not active.any():
+            return cls(0, empty, empty, empty)
+
+        origin = int(checkin_days[active].min())
+        last = int(max(checkin_days[active].max(), checkout_days[stays].max() if stays.any() else origin))
+        length = last - origin + 1
+
+        delta = np.zeros(length + 1, dtype='int64')
+        np.add.at(delta, checkin_days[stays] - origin, 1)
+        np.add.at(delta, checkout_days[stays] - origin, -1)
+        occupied = np.cumsum(delta[:length])
+
+        arrival_offsets = checkin_days[active] - origin
+        arrivals = np.bincount(arrival_offsets, minlength=length).astype('int64')
+        amounts = df['Tổng thanh toán'].to_numpy()[active] if 'Tổng thanh toán' in df.columns \
+            else np.zeros(len(arrival_offsets))
+        revenue = np.bincount(arrival_offsets, weights=amounts, minlength=length).round().astype('int64')
+        return cls(origin, occupied, arrivals, revenue)
+
+    def _slice(self, values: np.ndarray, first_day: int, last_day: int) -> np.ndarray:
+        """values cho mọi ngày trong [first_day, last_day], ngoài phạm vi dữ liệu là 0."""
+        out = np.zeros(last_day - first_day + 1, dtype=values.dtype)
+        lo, hi = max(first_day, self.origin), min(last_day, self.origin + len(values) - 1)
+        if lo <= hi:
+            out[lo - first_day:hi - first_day + 1] = values[lo - self.origin:hi - self.origin + 1]
+        return out
+
+    def heatmap(self, start_date: datetime.date, end_date: datetime.date, capacity: int) -> dict:
+        """
+        Công suất, số lượt đến và doanh thu theo ngày trong [start_date, end_date],
+        kèm tổng theo tháng. Các mảng theo ngày bắt đầu từ start_date. Không tính đơn đã hủy.
+        """
+        first_day, last_day = date_to_day(start_date), date_to_day(end_date)
+        occupied = self._slice(self.occupied, first_day, last_day)
+        arrivals = self._slice(self.arrivals, first_day, last_day)
+        revenue = self._slice(self.revenue, first_day, last_day)
+
+        # Điểm bắt đầu của từng tháng trong đoạn, để cộng dồn theo tháng bằng np.add.reduceat.
+        month_starts, labels = [], []
+        current = start_date
+        while current <= end_date:
+            month_starts.append(date_to_day(current) - first_day)
+            labels.append(current.strftime('%Y-%m'))
+            current = (current.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        month_days = np.diff(month_starts + [len(occupied)])
+        month_nights = np.add.reduceat(occupied, month_starts)
+        months = [{
+            'month': label,
+            'occupied_nights': int(nights),
+            'occupancy_rate': round(float(nights) / (capacity * int(days)), 3) if capacity else 0.0,
+            'arrivals': int(arrival_count),
+            'revenue': int(month_revenue),
+        } for label, days, nights, arrival_count, month_revenue in zip(
+            labels, month_days, month_nights, np.add.reduceat(arrivals, month_starts),
+            np.add.reduceat(revenue, month_starts))]
+
+        return {
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'days': len(occupied),
+            'capacity': capacity,
+            'excludes_cancelled': True,
+            'occupied': occupied.tolist(),
+            'rate': (np.round(occupied / capacity, 3).tolist() if capacity else [0.0] * len(occupied)),
+            'arrivals': arrivals.tolist(),
+            'revenue': revenue.tolist(),
+            'months': months,
+        }
+
+
+# ==============================================================================
+# CHỈ MỤC KHOẢNG THỜI GIAN LƯU TRÚ (STAY INDEX)
+# ==============================================================================
+# Trả lời "ai đến / ai đi / ai đang ở trong ngày D" và "các lượt ở giao với
+# [A, B)" mà không quét cả bảng. Dữ liệu là các mảng đã sắp xếp theo ngày
+# (check-in, check-out) kèm vị trí hàng trong DataFrame:
+#
+# - đến/đi trong ngày D: hai lần searchsorted trên mảng tương ứng;
+# - giao với [A, B): mọi lượt ở dài tối đa max_nights đêm, nên chỉ cần xét các
+#   lượt có check-in trong [A - max_nights + 1, B) rồi lọc check-out > A.
+#
+# Khi dữ liệu được sửa/xóa/thêm tại chỗ (write-through), chỉ mục được cập nhật
+# bằng cách chèn/bỏ đúng các hàng bị ảnh hưởng (StayIndex.updated) thay vì dựng
+# lại từ đầu. Mỗi lần cập nhật tạo đối tượng mới nên request đang đọc không bị ảnh hưởng.
+
+
+class _SortedDays:
+    """
+    Mảng ngày đã sắp xếp, kèm vị trí hàng (và ngày check-out nếu có) tương ứng.
+    """
+
+    __slots__ = ('days', 'positions', 'ends')
+
+    def __init__(self, days: np.ndarray, positions: np.ndarray, ends: np.ndarray | None = None):
+        self.days = days
+        self.positions = positions
+        self.ends = ends
+
+    @classmethod
+    def build(cls, days, positions, ends=None) -> '_SortedDays':
+        order = np.argsort(days, kind='stable')
+        return cls(days[order], positions[order], None if ends is None else ends[order])
+
+    def between(self, low: int, high: int) -> slice:
+        """Vị trí trong mảng của các ngày thuộc [low, high)."""
+        return slice(np.searchsorted(self.days, low, side='left'), np.searchsorted(self.days, high, side='left'))
+
+    def without(self, removed: np.ndarray) -> '_SortedDays':
+        """
+        Bỏ các hàng có vị trí thuộc removed (đã sắp xếp) và dồn vị trí các hàng
+        phía sau như DataFrame sau khi xóa.
+        """
+        keep = ~np.isin(self.positions, removed)
+        positions = self.positions[keep]
+        positions = positions - np.searchsorted(removed, positions, side='left')
+        return _SortedDays(self.days[keep], positions, None if self.ends is None else self.ends[keep])
+
+    def dropping(self, positions_to_drop: np.ndarray) -> '_SortedDays':
+        """Bỏ các hàng theo vị trí mà không dồn vị trí (dùng khi sửa một hàng)."""
+        keep = ~np.isin(self.positions, positions_to_drop)
+        return _SortedDays(self.days[keep], self.positions[keep], None if self.ends is None else self.ends[keep])
+
+    def with_rows(self, days, positions, ends=None) -> '_SortedDays':
+        if len(days) == 0:
+            return self
+        order = np.argsort(days, kind='stable')
+        days, positions = days[order], positions[order]
+        at = np.searchsorted(self.days, days, side='right')
+        return _SortedDays(np.insert(self.days, at, days), np.insert(self.positions, at, positions),
+                           None if self.ends is None else np.insert(self.ends, at, ends[order]))
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+
+class StayIndex:
+    """
+    Chỉ mục các booking chưa hủy theo ngày check-in/check-out.
+    Kết quả truy vấn là vị trí hàng (iloc) trong DataFrame đã dựng chỉ mục, theo thứ tự hàng.
+    """
+
+    def __init__(self, arrivals: _SortedDays, departures: _SortedDays, stays: _SortedDays, max_nights: int):
+        self.arrivals_by_day = arrivals
+        self.departures_by_day = departures
+        # Lượt ở hợp lệ (đủ hai ngày, check-out sau check-in), sắp theo check-in.
+        self.stays = stays
+        # Cận trên số đêm của một lượt ở (không giảm khi xóa, vẫn đúng).
+        self.max_nights = max_nights
+
+    @staticmethod
+    def _rows(df: pd.DataFrame, positions: np.ndarray):
+        checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()[positions]
+        checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()[positions]
+        active = ~df[CANCELLED_COLUMN].to_numpy()[positions]
+        has_in = active & (checkin_days != MISSING_DAY)
+        has_out = active & (checkout_days != MISSING_DAY)
+        is_stay = has_in & has_out & (checkout_days > checkin_days)
+        return checkin_days, checkout_days, has_in, has_out, is_stay
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'StayIndex':
+        empty = np.empty(0, dtype='int64')
+        if df is None or df.empty:
+            return cls(_SortedDays(empty, empty), _SortedDays(empty, empty), _SortedDays(empty, empty, empty), 0)
+        df = ensure_derived_columns(df)
+        positions = np.arange(len(df), dtype='int64')
+        checkin_days, checkout_days, has_in, has_out, is_stay = cls._rows(df, positions)
+        nights = checkout_days[is_stay] - checkin_days[is_stay]
+        return cls(
+            _SortedDays.build(checkin_days[has_in], positions[has_in]),
+            _SortedDays.build(checkout_days[has_out], positions[has_out]),
+            _SortedDays.build(checkin_days[is_stay], positions[is_stay], checkout_days[is_stay]),
+            int(nights.max()) if len(nights) else 0,
+        )
+
+    def updated(self, change: dict, df: pd.DataFrame) -> 'StayIndex':
+        """
+        Chỉ mục mới sau một thay đổi tại chỗ (xem BookingStore.derived):
+        change = {'kind': 'update'|'delete'|'append', 'positions': [...]}, df là DataFrame sau thay đổi.
+        """
+        positions = np.asarray(sorted(change['positions']), dtype='int64')
+        arrivals, departures, stays = self.arrivals_by_day, self.departures_by_day, self.stays
+        if change['kind'] == 'delete':
+            return StayIndex(arrivals.without(positions), departures.without(positions),
+                             stays.without(positions), self.max_nights)
+
+        if change['kind'] == 'update':
+            arrivals, departures, stays = (arrivals.dropping(positions), departures.dropping(positions),
+                                           stays.dropping(positions))
+        elif change['kind'] != 'append':
+            raise ValueError(f"Loại thay đổi không hỗ trợ: {change['kind']}")
+
+        checkin_days, checkout_days, has_in, has_out, is_stay = self._rows(df, positions)
+        nights = checkout_days[is_stay] - checkin_days[is_stay]
+        return StayIndex(
+            arrivals.with_rows(checkin_days[has_in], positions[has_in]),
+            departures.with_rows(checkout_days[has_out], positions[has_out]),
+            stays.with_rows(checkin_days[is_stay], positions[is_stay], checkout_days[is_stay]),
+            max(self.max_nights, int(nights.max()) if len(nights) else 0),
+        )
+
+    def arrivals(self, day: int) -> np.ndarray:
+        return np.sort(self.arrivals_by_day.positions[self.arrivals_by_day.between(day, day + 1)])
+
+    def departures(self, day: int) -> np.ndarray:
+        return np.sort(self.departures_by_day.positions[self.departures_by_day.between(day, day + 1)])
+
+    def staying_over(self, day: int) -> np.ndarray:
+        """Khách đã check-in trước ngày day và check-out sau ngày day."""
+        window = self.stays.between(day - self.max_nights + 1, day)
+        ends = self.stays.ends[window]
+        return np.sort(self.stays.positions[window][ends > day])
+
+    def overlapping(self, first_day: int, end_day: int) -> np.ndarray:
+        """Các lượt ở giao với [first_day, end_day)."""
+        window = self.stays.between(first_day - self.max_nights + 1, end_day)
+        ends = self.stays.ends[window]
+        return np.sort(self.stays.positions[window][ends > first_day])
+
+    def stays_between(self, start_date: datetime.date, end_date: datetime.date) -> np.ndarray:
+        """Như overlapping() nhưng nhận ngày: các lượt ở giao với [start_date, end_date)."""
+        return self.overlapping(date_to_day(start_date), date_to_day(end_date))
+
+
+# ==============================================================================
+# CÔNG SUẤT THEO TỪNG CHỖ NGHỈ (MA TRẬN ĐẾM PHÒNG-ĐÊM)
+# ==============================================================================
+# counts[p, d] = số booking của chỗ nghỉ p có khách ở đêm (origin + d). Ma trận
+# được dựng một lần bằng mảng hiệu (np.add.at + cumsum theo trục ngày); sau đó
+# mỗi lần sửa/xóa/thêm booking chỉ cộng/trừ đúng đoạn ngày của booking đó.
+# Vì vậy lưới tháng của một chỗ nghỉ hay heatmap nhiều chỗ nghỉ chỉ là cắt
+# một lát của ma trận.
+#
+# Công suất chỉ theo dõi ở mức chỗ nghỉ, không theo từng phòng: sheet đặt phòng
+# không có cột số phòng nên không biết booking nằm ở phòng nào. Mỗi chỗ nghỉ
+# có PROPERTY_CAPACITIES phòng, và một booking chiếm một phòng mỗi đêm.
+
+
+class PropertyOccupancy:
+    """
+    Ma trận số phòng có khách theo (chỗ nghỉ, ngày), kèm sức chứa từng chỗ nghỉ.
+    Không có chiều theo phòng vì sheet không ghi booking ở phòng nào.
+    """
+
+    def __init__(self, properties: list[str], origin: int, counts: np.ndarray, row_property: np.ndarray,
+                 row_start: np.ndarray, row_end: np.ndarray, capacities: dict | None = None):
+        self.properties = properties
+        self._property_index = {name: i for i, name in enumerate(properties)}
+        self.origin = origin
+        self.counts = counts
+        # Đóng góp của từng hàng DataFrame (theo vị trí): chỗ nghỉ (-1 nếu không tính) và [start, end).
+        self.row_property = row_property
+        self.row_start = row_start
+        self.row_end = row_end
+        self.capacities = PROPERTY_CAPACITIES if capacities is None else capacities
+
+    @staticmethod
+    def _stays(df: pd.DataFrame, positions: np.ndarray):
+        checkin_days = df[CHECKIN_DAY_COLUMN].to_numpy()[positions]
+        checkout_days = df[CHECKOUT_DAY_COLUMN].to_numpy()[positions]
+        names = df[PROPERTY_COLUMN].to_numpy()[positions] if PROPERTY_COLUMN in df.columns \
+            else np.full(len(positions), None, dtype=object)
+        valid = ((checkin_days != MISSING_DAY) & (checkout_days != MISSING_DAY) & (checkout_days > checkin_days)
+                 & ~df[CANCELLED_COLUMN].to_numpy()[positions] & pd.notna(names))
+        return checkin_days, checkout_days, names, valid
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, capacities: dict | None = None) -> 'PropertyOccupancy':
+        empty = np.empty(0, dtype='int64')
+        if df is None or df.empty:
+            return cls([], 0, np.zeros((0, 0), dtype='int32'), empty, empty, empty, capacities)
+        df = ensure_derived_columns(df)
+        positions = np.arange(len(df), dtype='int64')
+        starts, ends, names, valid = cls._stays(df, positions)
+
+        properties = sorted({str(name) for name in names[valid]})
+        lookup = {name: i for i, name in enumerate(properties)}
+        row_property = np.full(len(df), -1, dtype='int64')
+        row_property[valid] = [lookup[str(name)] for name in names[valid]]
+
+        if not valid.any():
+            return cls(properties, 0, np.zeros((len(properties), 0), dtype='int32'),
+                       row_property, starts, ends, capacities)
+        origin = int(starts[valid].min())
+        span = int(ends[valid].max()) - origin
+        diff = np.zeros((len(properties), span + 1), dtype='int32')
+        np.add.at(diff, (row_property[valid], starts[valid] - origin), 1)
+        np.add.at(diff, (row_property[valid], ends[valid] - origin), -1)
+        counts = np.cumsum(diff, axis=1, dtype='int32')[:, :span]
+        return cls(properties, origin, counts, row_property, starts, ends, capacities)
+
+    # --------------------------------------------------------------------------
+    # Cập nhật tăng dần
+    # --------------------------------------------------------------------------
+
+    def _ensure(self, property_name: str, first_day: int, end_day: int) -> int:
+        index = self._property_index.get(property_name)
+        if index is None:
+            index = len(self.properties)
+            self.properties = self.properties + [property_name]
+            self._property_index[property_name] = index
+            self.counts = np.vstack([self.counts, np.zeros((1, self.counts.shape[1]), dtype='int32')])
+        if self.counts.shape[1] == 0:
+            self.origin = first_day
+        if first_day < self.origin:
+            pad = self.origin - first_day
+            self.counts = np.hstack([np.zeros((self.counts.shape[0], pad), dtype='int32'), self.counts])
+            self.origin = first_day
+        if end_day > self.origin + self.counts.shape[1]:
+            pad = end_day - self.origin - self.counts.shape[1]
+            self.counts = np.hstack([self.counts, np.zeros((self.counts.shape[0], pad), dtype='int32')])
+        return index
+
+    def _remove_rows(self, positions: np.ndarray):
+        for position in positions:
+            index = self.row_property[position]
+            if index >= 0:
+                self.counts[index, self.row_start[position] - self.origin:self.row_end[position] - self.origin] -= 1
+
+    def _add_rows(self, df: pd.DataFrame, positions: np.ndarray):
+        starts, ends, names, valid = self._stays(df, positions)
+        for position, start, end, name, ok in zip(positions, starts, ends, names, valid):
+            if not ok:
+                self.row_property[position] = -1
+                continue
+            index = self._ensure(str(name), int(start), int(end))
+            self.counts[index, start - self.origin:end - self.origin] += 1
+            self.row_property[position], self.row_start[position], self.row_end[position] = index, start, end
+
+    def updated(self, change: dict, df: pd.DataFrame) -> 'PropertyOccupancy':
+        """
+        Ma trận mới sau một thay đổi tại chỗ (xem BookingStore.derived). Bản cũ
+        không bị sửa để các request đang đọc vẫn thấy dữ liệu nhất quán.
+        """
+        positions = np.asarray(sorted(change['positions']), dtype='int64')
+        new = PropertyOccupancy(list(self.properties), self.origin, self.counts.copy(), self.row_property.copy(),
+                                self.row_start.copy(), self.row_end.copy(), self.capacities)
+        if change['kind'] == 'delete':
+            new._remove_rows(positions)
+            new.row_property, new.row_start, new.row_end = (np.delete(new.row_property, positions),
+                                                             np.delete(new.row_start, positions),
+                                                             np.delete(new.row_end, positions))
+        elif change['kind'] == 'update':
+            new._remove_rows(positions)
+            new._add_rows(df, positions)
+        elif change['kind'] == 'append':
+            grow = len(df) - len(new.row_property)
+            new.row_property = np.concatenate([new.row_property, np.full(grow, -1, dtype='int64')])
+            new.row_start = np.concatenate([new.row_start, np.zeros(grow, dtype='int64')])
+            new.row_end = np.concatenate([new.row_end, np.zeros(grow, dtype='int64')])
+            new._add_rows(df, positions)
+        else:
+            raise ValueError(f"Loại thay đổi không hỗ trợ: {change['kind']}")
+        return new
+
+    # --------------------------------------------------------------------------
+    # Truy vấn
+    # --------------------------------------------------------------------------
+
+    def capacity(self, property_name: str) -> int:
+        return self.capacities.get(property_name, DEFAULT_PROPERTY_CAPACITY)
+
+    def occupied(self, property_name: str, first_day: int, last_day: int) -> np.ndarray:
+        """
+        Số phòng có khách mỗi ngày trong [first_day, last_day] (0 ngoài khoảng có dữ liệu).
+        """
+        result = np.zeros(last_day - first_day + 1, dtype='int32')
+        index = self._property_index.get(property_name)
+        if index is None or self.counts.shape[1] == 0:
+            return result
+        low = max(first_day, self.origin)
+        high = min(last_day + 1, self.origin + self.counts.shape[1])
+        if low < high:
+            result[low - first_day:high - first_day] = self.counts[index, low - self.origin:high - self.origin]
+        return result
+
+    def month_grid(self, property_name: str, year: int, month: int) -> dict:
+        """
+        {date: thông tin trạng thái} cho một chỗ nghỉ trong một tháng (cùng định
+        dạng với get_calendar_occupancy), theo sức chứa của chỗ nghỉ đó.
+        """
+        first = datetime.date(year, month, 1)
+        first_day = date_to_day(first)
+        last_day = first_day + calendar.monthrange(year, month)[1] - 1
+        capacity = self.capacity(property_name)
+        return {
+            day_to_date(first_day + offset): calendar_day_status(int(count), capacity)
+            for offset, count in enumerate(self.occupied(property_name, first_day, last_day))
+        }
+
+    def heatmap(self, start_date: datetime.date, end_date: datetime.date, properties: list[str] | None = None) -> dict:
+        """
+        Số phòng có khách và tỉ lệ lấp đầy theo (chỗ nghỉ, ngày) trong [start_date, end_date], dạng mảng gọn.
+        """
+        first_day, last_day = date_to_day(start_date), date_to_day(end_date)
+        names = self.properties if properties is None else properties
+        rows = []
+        for name in names:
+            occupied = self.occupied(name, first_day, last_day)
+            capacity = self.capacity(name)
+            rows.append({
+                'name': name,
+                'capacity': capacity,
+                'occupied': occupied.tolist(),
+                'rate': (np.round(occupied / capacity, 3).tolist() if capacity else [0.0] * len(occupied)),
+            })
+        return {
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'days': last_day - first_day + 1,
+            'properties': rows,
+        }
+
+
+# ==============================================================================
+# TÌM NGÀY CÒN TRỐNG (SLIDING-WINDOW MINIMUM)
+# ==============================================================================
+# Một lượt ở N đêm bắt đầu ngày c còn trống k phòng nếu min(free[c .. c+N-1]) >= k,
+# với free = sức chứa - số phòng có khách. Cực tiểu trượt được tính theo thuật
+# toán van Herk/Gil-Werman: chia mảng thành các khối dài N, lấy cực tiểu tích
+# lũy xuôi và ngược trong từng khối, rồi mỗi cửa sổ = min(hậu tố, tiền tố).
+# Cả năm chỉ tốn vài phép numpy, không phụ thuộc N.
+
+
+def sliding_window_min(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    result[i] = min(values[i:i + window]) cho i = 0 .. len(values) - window.
+    """
+    n = len(values)
+    if window <= 0 or n < window:
+        return np.empty(0, dtype=values.dtype)
+    pad = (-n) % window
+    fill = np.iinfo(values.dtype).max if np.issubdtype(values.dtype, np.integer) else np.inf
+    blocks = np.concatenate([values, np.full(pad, fill, dtype=values.dtype)]).reshape(-1, window)
+    prefix = np.minimum.accumulate(blocks, axis=1).ravel()
+    suffix = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    starts = np.arange(n - window + 1)
+    return np.minimum(suffix[starts], prefix[starts + window - 1])
+
+
+def find_available_checkins(property_occupancy: PropertyOccupancy, start_date: datetime.date,
+                            end_date: datetime.date, nights: int, properties: list[str] | None = None,
+                            rooms: int = 1) -> dict:
+    """
+    Mọi ngày check-in trong [start_date, end_date] mà lượt ở `nights` đêm còn ít
+    nhất `rooms` phòng trống, cho từng chỗ nghỉ (hoặc các chỗ nghỉ được chỉ định).
+    """
+    first_day, last_day = date_to_day(start_date), date_to_day(end_date)
+    names = property_occupancy.properties if not properties else properties
+    results = []
+    for name in names:
+        capacity = property_occupancy.capacity(name)
+        # Cần công suất tới đêm cuối của lượt ở bắt đầu vào ngày cuối cùng.
+        occupied = property_occupancy.occupied(name, first_day, last_day + nights - 1)
+        free = (capacity - occupied).astype('int32')
+        remaining = sliding_window_min(free, nights)
+        feasible = np.nonzero(remaining >= rooms)[0]
+        results.append({
+            'name': name,
+            'capacity': capacity,
+            'available': [{
+                'check_in': day_to_date(first_day + offset).isoformat(),
+                'check_out': day_to_date(first_day + offset + nights).isoformat(),
+                'remaining': int(remaining[offset]),
+            } for offset in feasible],
+        })
+    return {
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'nights': nights,
+        'rooms': rooms,
+        'properties': results,
+    }
+
+
+# ==============================================================================
+# PHÁT HIỆN ĐẶT TRÙNG / VƯỢT SỨC CHỨA (SWEEP LINE)
+# ==============================================================================
+# Mỗi lượt ở sinh hai sự kiện: +1 ở ngày check-in, -1 ở ngày check-out. Sắp xếp
+# mọi sự kiện theo (chỗ nghỉ, ngày, loại) với check-out đứng trước check-in
+# trong cùng ngày (khách trả phòng rồi khách mới nhận phòng thì không trùng), rồi
+# cộng dồn: giữa hai sự kiện liên tiếp số phòng có khách không đổi. Tổng các sự
+# kiện của mỗi chỗ nghỉ bằng 0 nên một lần cumsum trên toàn bộ là đủ. Mọi thứ
+# là O(n log n) cho lần sắp xếp, đủ nhanh để kiểm tra trước mỗi lần ghi.
+#
+# OVERBOOKING_POLICY: 'warn' (mặc định, vẫn ghi nhưng cảnh báo) hoặc 'block'
+# (từ chối ghi khi booking mới/sửa làm vượt sức chứa).
+OVERBOOKING_POLICY = os.getenv("OVERBOOKING_POLICY", "warn").lower()
+
+
+def _active_stays(df: pd.DataFrame) -> tuple:
+    """(mã booking, chỗ nghỉ, ngày check-in, ngày check-out) của các lượt ở hợp lệ chưa hủy."""
+    if df is None or df.empty or PROPERTY_COLUMN not in df.columns:
+        empty = np.empty(0, dtype='int64')
+        return np.empty(0, dtype=object), np.empty(0, dtype=object), empty, empty
+    df = ensure_derived_columns(df)
+    starts = df[CHECKIN_DAY_COLUMN].to_numpy()
+    ends = df[CHECKOUT_DAY_COLUMN].to_numpy()
+    valid = ((starts != MISSING_DAY) & (ends != MISSING_DAY) & (ends > starts)
+             & ~df[CANCELLED_COLUMN].to_numpy())
+    return (df['Số đặt phòng'].to_numpy(dtype=object)[valid],
+            df[PROPERTY_COLUMN].to_numpy(dtype=object)[valid],
+            starts[valid], ends[valid])
+
+
+def sweep_overbookings(ids: np.ndarray, properties: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                       capacities: dict | None = None) -> list[dict]:
+    """
+    Các khoảng ngày [start, end) mà một chỗ nghỉ có nhiều lượt ở hơn sức chứa.
+    Các đêm vượt liên tiếp được gộp thành một khoảng, kèm số phòng cao nhất và các booking liên quan.
+    """
+    if len(starts) == 0:
+        return []
+    capacities = PROPERTY_CAPACITIES if capacities is None else capacities
+    codes, names = pd.factorize(pd.Series(properties, dtype=object).fillna(''))
+    capacity_by_code = np.array([capacities.get(name, DEFAULT_PROPERTY_CAPACITY) for name in names])
+
+    event_codes = np.concatenate([codes, codes])
+    event_days = np.concatenate([starts, ends])
+    event_deltas = np.concatenate([np.ones(len(starts), dtype='int64'), -np.ones(len(ends), dtype='int64')])
+    order = np.lexsort((event_deltas, event_days, event_codes))
+    event_codes, event_days = event_codes[order], event_days[order]
+    running = np.cumsum(event_deltas[order])
+
+    # Đoạn [event_days[i], event_days[i+1]) có running[i] phòng có khách.
+    same_property = event_codes[:-1] == event_codes[1:]
+    over = (same_property & (event_days[1:] > event_days[:-1])
+            & (running[:-1] > capacity_by_code[event_codes[:-1]]))
+    segments = np.nonzero(over)[0]
+    if len(segments) == 0:
+        return []
+
+    # Gộp các đoạn nối tiếp nhau của cùng một chỗ nghỉ.
+    merged = []
+    for i in segments:
+        code, start, end, peak = int(event_codes[i]), int(event_days[i]), int(event_days[i + 1]), int(running[i])
+        if merged and merged[-1][0] == code and merged[-1][2] == start:
+            merged[-1][2] = end
+            merged[-1][3] = max(merged[-1][3], peak)
+        else:
+            merged.append([code, start, end, peak])
+
+    # Booking liên quan: lượt ở của chỗ nghỉ đó giao với khoảng vượt sức chứa.
+    by_start = np.lexsort((starts, codes))
+    sorted_codes, sorted_starts = codes[by_start], starts[by_start]
+    conflicts = []
+    for code, start, end, peak in merged:
+        lo = np.searchsorted(sorted_codes, code, side='left')
+        hi = lo + np.searchsorted(sorted_starts[lo:np.searchsorted(sorted_codes, code, side='right')], end)
+        rows = by_start[lo:hi]
+        rows = rows[ends[rows] > start]
+        conflicts.append({
+            'property': names[code],
+            'capacity': int(capacity_by_code[code]),
+            'peak': peak,
+            'start': day_to_date(start).isoformat(),
+            'end': day_to_date(end).isoformat(),
+            'nights': end - start,
+            'booking_ids': sorted(str(booking_id) for booking_id in ids[rows]),
+        })
+    return conflicts
+
+
+def audit_overbookings(df: pd.DataFrame, capacities: dict | None = None) -> dict:
+    """
+    Báo cáo toàn bảng: mọi khoảng ngày vượt sức chứa của từng chỗ nghỉ.
+    """
+    conflicts = sweep_overbookings(*_active_stays(df), capacities=capacities)
+    return {
+        'conflict_count': len(conflicts),
+        'overbooked_nights': sum(conflict['nights'] for conflict in conflicts),
+        'properties': sorted({conflict['property'] for conflict in conflicts}),
+        'conflicts': conflicts,
+    }
+
+
+def check_new_stays(df: pd.DataFrame, bookings: list[dict], replaced_ids: list | None = None,
+                    capacities: dict | None = None) -> list[dict]:
+    """
+    Kiểm tra trước khi ghi: các khoảng vượt sức chứa mà `bookings` (dạng dict như
+    khi ghi lên sheet) gây ra khi thêm vào dữ liệu hiện tại. `replaced_ids` là các
+    booking sẽ bị thay thế (khi sửa), không tính bản cũ của chúng.
+    Chỉ quét các chỗ nghỉ có booking mới, và chỉ trả về xung đột có liên quan tới booking mới.
+    """
+    new_ids, new_properties, new_starts, new_ends = [], [], [], []
+    for booking in bookings:
+        if booking.get('Tình trạng') == 'Đã hủy':
+            continue
+        try:
+            start, end = date_to_day(booking.get('Check-in Date')), date_to_day(booking.get('Check-out Date'))
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if end <= start:
+            continue
+        new_ids.append(str(booking.get('Số đặt phòng') or ''))
+        new_properties.append(booking.get(PROPERTY_COLUMN) or '')
+        new_starts.append(start)
+        new_ends.append(end)
+    if not new_ids:
+        return []
+
+    ids, properties, starts, ends = _active_stays(df)
+    excluded = [booking_id for booking_id in list(replaced_ids or []) + new_ids if booking_id]
+    keep = np.isin(properties, new_properties) & ~np.isin(ids, excluded)
+    conflicts = sweep_overbookings(
+        np.concatenate([ids[keep], np.array(new_ids, dtype=object)]),
+        np.concatenate([properties[keep], np.array(new_properties, dtype=object)]),
+        np.concatenate([starts[keep], np.array(new_starts, dtype='int64')]),
+        np.concatenate([ends[keep], np.array(new_ends, dtype='int64')]),
+        capacities=capacities)
+    new_id_set = set(new_ids)
+    return [conflict for conflict in conflicts if new_id_set.intersection(conflict['booking_ids'])]
+
+
+def describe_overbookings(conflicts: list[dict], limit: int = 3) -> str:
+    """Mô tả ngắn gọn các xung đột để hiển thị bằng flash."""
+    parts = [
+        f"{c['property']} {c['start']} → {c['end']} ({c['peak']}/{c['capacity']} phòng: {', '.join(c['booking_ids'])})"
+        for c in conflicts[:limit]
+    ]
+    if len(conflicts) > limit:
+        parts.append(f"và {len(conflicts) - limit} khoảng khác")
+    return '; '.join(parts)
+
+
+# ==============================================================================
+# GHI NHẬN DOANH THU THEO ĐÊM Ở (ADR, REVPAR, CÔNG SUẤT)
+# ==============================================================================
+# Doanh thu theo ngày check-in dồn cả lượt ở vào tháng check-in, nên lượt ở vắt
+# qua hai tháng làm lệch biểu đồ. Ở đây mỗi lượt ở được trải thành từng đêm
+# (np.repeat + cumsum, không vòng lặp Python theo hàng), tiền được chia đều cho
+# các đêm (phần dư chia cho các đêm đầu để tổng giữ nguyên đến từng đồng), rồi
+# cộng vào ma trận (chỗ nghỉ, ngày) bằng np.bincount. Ma trận cộng dồn theo ngày
+# cho phép tính doanh thu, số đêm đã bán, ADR, RevPAR và công suất của khoảng
+# ngày bất kỳ bằng một phép trừ. Tính một lần cho mỗi phiên bản dữ liệu.
+
+
+def expand_stay_nights(starts: np.ndarray, ends: np.ndarray, amounts: np.ndarray) -> tuple:
+    """
+    Trải các lượt ở [start, end) thành từng đêm. Trả về (chỉ số lượt ở, ngày, doanh thu) của mỗi đêm.
+    """
+    nights = (ends - starts).astype('int64')
+    total = int(nights.sum())
+    stay = np.repeat(np.arange(len(nights)), nights)
+    # Thứ tự của đêm trong lượt ở: vị trí toàn cục trừ vị trí đêm đầu tiên của lượt ở đó.
+    offsets = np.arange(total, dtype='int64') - np.repeat(np.cumsum(nights) - nights, nights)
+    base, remainder = np.divmod(amounts.astype('int64'), np.maximum(nights, 1))
+    revenue = base[stay] + (offsets < remainder[stay])
+    return stay, starts[stay] + offsets, revenue
+
+
+class NightlyRevenue:
+    """
+    Doanh thu và số đêm đã bán theo (chỗ nghỉ, ngày), dạng cộng dồn theo ngày.
+    """
+
+    def __init__(self, properties: list[str], origin: int, revenue_cum: np.ndarray, nights_cum: np.ndarray,
+                 capacities: dict | None = None):
+        self.properties = properties
+        self.origin = origin
+        # Cột 0 là tổng rỗng: tổng các ngày [a, b) của chỗ nghỉ p = cum[p, b - origin] - cum[p, a - origin].
+        self.revenue_cum = revenue_cum
+        self.nights_cum = nights_cum
+        self.capacities = PROPERTY_CAPACITIES if capacities is None else capacities
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, capacities: dict | None = None) -> 'NightlyRevenue':
+        empty = np.zeros((0, 1), dtype='int64')
+        if df is None or df.empty or PROPERTY_COLUMN not in df.columns:
+            return cls([], 0, empty, empty, capacities)
+        df = ensure_derived_columns(df)
+        starts, ends, names, valid = PropertyOccupancy._stays(df, np.arange(len(df), dtype='int64'))
+        if not valid.any():
+            return cls([], 0, empty, empty, capacities)
+        starts, ends, names = starts[valid], ends[valid], names[valid].astype(str)
+        amounts = df['Tổng thanh toán'].to_numpy()[valid]
+
+        codes, properties = pd.factorize(names, sort=True)
+        origin = int(starts.min())
+        span = int(ends.max()) - origin
+        stay, days, revenue = expand_stay_nights(starts, ends, amounts)
+        flat = codes[stay] * span + (days - origin)
+        size = len(properties) * span
+        revenue_by_day = np.bincount(flat, weights=revenue, minlength=size).round().astype('int64')
+        nights_by_day = np.bincount(flat, minlength=size).astype('int64')
+
+        def cumulative(values: np.ndarray) -> np.ndarray:
+            matrix = values.reshape(len(properties), span)
+            return np.hstack([np.zeros((len(properties), 1), dtype='int64'), np.cumsum(matrix, axis=1)])
+
+        return cls(list(properties), origin, cumulative(revenue_by_day), cumulative(nights_by_day), capacities)
+
+    def capacity(self, property_name: str) -> int:
+        return self.capacities.get(property_name, DEFAULT_PROPERTY_CAPACITY)
+
+    def _range_sums(self, cum: np.ndarray, first_day: int, end_day: int) -> np.ndarray:
+        """Tổng theo từng chỗ nghỉ của các ngày [first_day, end_day), ngoài phạm vi dữ liệu là 0."""
+        span = cum.shape[1] - 1
+        lo = np.clip(first_day - self.origin, 0, span)
+        hi = np.clip(end_day - self.origin, 0, span)
+        return cum[:, hi] - cum[:, lo] if hi > lo else np.zeros(cum.shape[0], dtype='int64')
+
+    def _metrics(self, name: str, revenue: int, nights: int, days: int) -> dict:
+        available = self.capacity(name) * days
+        return {
+            'revenue': int(revenue),
+            'nights_sold': int(nights),
+            'available_nights': available,
+            'adr': round(revenue / nights) if nights else 0,
+            'revpar': round(revenue / available) if available else 0,
+            'occupancy_rate': round(nights / available, 3) if available else 0.0,
+        }
+
+    def summary(self, first_day: int, last_day: int, properties: list[str] | None = None) -> list[dict]:
+        """
+        Doanh thu theo đêm ở, số đêm đã bán, ADR, RevPAR và công suất của từng chỗ nghỉ trong [first_day, last_day].
+        Đơn đã hủy không được tính (khác doanh thu theo tháng check-in của dashboard).
+        """
+        if last_day < first_day:
+            return []
+        revenue = self._range_sums(self.revenue_cum, first_day, last_day + 1)
+        nights = self._range_sums(self.nights_cum, first_day, last_day + 1)
+        days = last_day - first_day + 1
+        index = {name: i for i, name in enumerate(self.properties)}
+        names = self.properties if properties is None else properties
+        return [{'property': name, **self._metrics(name, revenue[index[name]] if name in index else 0,
+                                                    nights[index[name]] if name in index else 0, days)}
+                for name in names]
+
+    def monthly(self, start_date: datetime.date, end_date: datetime.date, properties: list[str] | None = None) -> dict:
+        """
+        Chuỗi theo tháng (từ tháng của start_date tới tháng của end_date) cho từng
+        chỗ nghỉ, kèm doanh thu theo đêm ở của tất cả chỗ nghỉ. Đơn đã hủy không
+        được tính; 'excludes_cancelled' ghi rõ điều đó cho người dùng API.
+        """
+        months, labels = [], []
+        current = start_date.replace(day=1)
+        while current <= end_date:
+            following = (current + datetime.timedelta(days=32)).replace(day=1)
+            months.append((date_to_day(current), date_to_day(following)))
+            labels.append(current.strftime('%Y-%m'))
+            current = following
+        names = self.properties if properties is None else properties
+        series = {name: [] for name in names}
+        total_revenue = []
+        for first_day, end_day in months:
+            rows = self.summary(first_day, end_day - 1, names)
+            for row in rows:
+                series[row['property']].append(row)
+            total_revenue.append(int(self._range_sums(self.revenue_cum, first_day, end_day).sum()))
+        return {
+            'months': labels,
+            'revenue': total_revenue,
+            'excludes_cancelled': True,
+            'properties': [{
+                'name': name,
+                'capacity': self.capacity(name),
+                **{key: [row[key] for row in series[name]]
+                   for key in ('revenue', 'nights_sold', 'available_nights', 'adr', 'revpar', 'occupancy_rate')},
+            } for name in names],
+        }
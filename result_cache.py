@@ -0,0 +1,100 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+# ==============================================================================
+# BỘ NHỚ ĐỆM KẾT QUẢ THEO PHIÊN BẢN DỮ LIỆU (LRU, GIỚI HẠN THEO BYTE)
+# ==============================================================================
+# Dùng cho các trang tốn công dựng (dashboard): kết quả cuối cùng được giữ theo
+# (phiên bản dữ liệu, tham số request). Phiên bản là số tăng dần (ví dụ
+# BookingStore.version); khi nó tăng, mọi kết quả cũ bị bỏ ngay vì không thể
+# được dùng lại. Kích thước mỗi mục được ước lượng bằng độ dài bản pickle; khi
+# vượt giới hạn byte hoặc số mục, mục ít được dùng gần đây nhất bị loại trước.
+# Mỗi worker gunicorn có bộ nhớ đệm riêng.
+
+DASHBOARD_CACHE_MAX_BYTES = int(os.getenv("DASHBOARD_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+DASHBOARD_CACHE_MAX_ENTRIES = int(os.getenv("DASHBOARD_CACHE_MAX_ENTRIES", "64"))
+
+
+def estimate_bytes(value: Any) -> int:
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class VersionedLRUCache:
+    """
+    LRU theo phiên bản dữ liệu, giới hạn tổng số byte và số mục. Giá trị phải được coi là chỉ đọc.
+    """
+
+    def __init__(self, name: str, max_bytes: int = DASHBOARD_CACHE_MAX_BYTES,
+                 max_entries: int = DASHBOARD_CACHE_MAX_ENTRIES):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.version: int | None = None
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'too_large': 0}
+
+    def _switch_version(self, version: int):
+        if self.version is None or version > self.version:
+            if self._entries:
+                self.stats['invalidations'] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.version = version
+
+    def get_or_build(self, version: int, key: Hashable, builder: Callable[[], Any]) -> Any:
+        """
+        Trả về giá trị đã lưu cho (version, key), hoặc gọi builder() rồi lưu lại.
+        """
+        with self._lock:
+            self._switch_version(version)
+            entry = self._entries.get(key) if version == self.version else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+
+        value = builder()
+        size = estimate_bytes(value)
+        with self._lock:
+            # Request của phiên bản cũ (hoặc dữ liệu đã đổi trong lúc dựng): không lưu.
+            if version != self.version:
+                return value
+            if self.max_entries <= 0 or size > self.max_bytes:
+                self.stats['too_large'] += 1
+                return value
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def status(self) -> dict:
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries,
+                'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else None,
+                **self.stats,
+            }
@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import gspread
+from gspread.exceptions import APIError
+
+# ==============================================================================
+# LẬP LỊCH GỌI GOOGLE SHEETS API THEO QUOTA
+# ==============================================================================
+# Mọi request HTTP của gspread đều đi qua Client.request; ScheduledClient chặn
+# ở đúng chỗ đó nên mọi lời gọi (đọc, ghi, xóa, template...) đều được điều phối:
+#
+# - Token bucket riêng cho đọc (GET) và ghi (các method khác), theo quota
+#   "requests per minute per user" của Sheets API. Các worker gunicorn không
+#   dùng chung bucket, nên giới hạn mặc định đã chia cho 2 worker.
+# - Hai làn ưu tiên: INTERACTIVE (request của người dùng) và BACKGROUND (làm
+#   mới nền, đẩy hàng đợi ghi). Làn nền nhường token khi có request tương tác
+#   đang chờ và không được dùng phần token dự trữ cho làn tương tác.
+# - Khi Google trả 429/5xx: thử lại với backoff lũy thừa + jitter (tôn trọng
+#   Retry-After nếu có) và làm cạn bucket để các lời gọi khác cũng chậm lại.
+#   429 luôn được thử lại (Google từ chối trước khi áp dụng lệnh). Với 5xx chỉ
+#   lời gọi lặp lại an toàn (GET, PUT values.update, values:batchUpdate...) được
+#   tự động thử lại: 5xx có thể đến sau khi server đã áp dụng lệnh, nên
+#   values:append hay spreadsheets:batchUpdate (deleteDimension) gửi lại sẽ tạo
+#   hàng trùng / xóa nhầm hàng. Các lệnh đó báo lỗi ngay cho người gọi, người
+#   gọi tự đối chiếu với sheet rồi mới gửi lại (append_multiple_bookings_to_sheet).
+# - Bộ đếm số lời gọi, số lần phải chờ, số lần bị 429... cho /api/data_status.
+
+READS_PER_MINUTE = float(os.getenv("GSHEET_READS_PER_MINUTE", "30"))
+WRITES_PER_MINUTE = float(os.getenv("GSHEET_WRITES_PER_MINUTE", "30"))
+# Request tương tác chờ token tối đa bao lâu trước khi báo lỗi (làn nền chờ không giới hạn).
+INTERACTIVE_MAX_WAIT_SECONDS = float(os.getenv("GSHEET_INTERACTIVE_MAX_WAIT_SECONDS", "30"))
+MAX_RETRIES = int(os.getenv("GSHEET_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 32.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# POST nhưng lặp lại an toàn (ghi đè cùng giá trị / chỉ đọc). values:append và
+# spreadsheets:batchUpdate cố ý không có trong danh sách.
+IDEMPOTENT_POST_SUFFIXES = ('values:batchUpdate', 'values:batchGet', 'values:batchClear',
+                            'values:batchGetByDataFilter', ':clear')
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_lane: contextvars.ContextVar[str] = contextvars.ContextVar('sheets_lane', default=INTERACTIVE)
+
+
+class QuotaWaitTimeout(Exception):
+    """Chờ quá lâu mà vẫn chưa tới lượt gọi Google Sheets API."""
+
+
+def retryable_status(error: Exception) -> Optional[int]:
+    """Mã HTTP nếu lỗi là 429/5xx (có thể thử lại), ngược lại None."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(error, APIError) and status in RETRYABLE_STATUS else None
+
+
+@contextmanager
+def sheets_priority(lane: str):
+    """
+    Đặt làn ưu tiên cho các lời gọi Sheets API trong khối with (theo thread/context).
+    """
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def background_priority():
+    return sheets_priority(BACKGROUND)
+
+
+class TokenBucket:
+    """
+    Token bucket có hai làn ưu tiên. Làn nền chỉ lấy token khi không có request
+    tương tác nào đang chờ và bucket còn nhiều hơn phần dự trữ.
+    """
+
+    def __init__(self, name: str, rate_per_minute: float, burst: Optional[float] = None, reserve: float = 1.0):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, rate_per_minute / 6)
+        self.reserve = min(reserve, self.capacity - 1) if self.capacity > 1 else 0.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.stats = {'acquired': 0, 'throttled': 0, 'wait_seconds': 0.0, 'timeouts': 0, 'drained': 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _can_take(self, lane: str) -> bool:
+        if lane == BACKGROUND:
+            return self._waiting[INTERACTIVE] == 0 and self.tokens >= 1 + self.reserve
+        return self.tokens >= 1
+
+    def acquire(self, lane: str = INTERACTIVE, max_wait: Optional[float] = None) -> float:
+        """
+        Lấy một token, chờ nếu cần. Trả về số giây đã chờ.
+        """
+        if self.rate <= 0:
+            return 0.0
+        start = time.monotonic()
+        with self._cond:
+            self._refill()
+            if self._can_take(lane):
+                self.tokens -= 1
+                self.stats['acquired'] += 1
+                return 0.0
+
+            self.stats['throttled'] += 1
+            self._waiting[lane] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._can_take(lane):
+                        self.tokens -= 1
+                        break
+                    waited = time.monotonic() - start
+                    if max_wait is not None and waited >= max_wait:
+                        self.stats['timeouts'] += 1
+                        raise QuotaWaitTimeout(
+                            f"Đã chờ {waited:.0f}s mà chưa đến lượt gọi Google Sheets ({self.name}). Vui lòng thử lại sau.")
+                    needed = (1 + (self.reserve if lane == BACKGROUND else 0)) - self.tokens
+                    timeout = max(0.05, needed / self.rate)
+                    if max_wait is not None:
+                        timeout = min(timeout, max_wait - waited)
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting[lane] -= 1
+                # Đánh thức các thread khác để làn nền biết làn tương tác đã hết người chờ.
+                self._cond.notify_all()
+
+            waited = time.monotonic() - start
+            self.stats['acquired'] += 1
+            self.stats['wait_seconds'] += waited
+            return waited
+
+    def drain(self):
+        """Bỏ hết token hiện có (sau khi bị Google trả 429)."""
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+            self.stats['drained'] += 1
+
+    def status(self) -> dict:
+        with self._cond:
+            self._refill()
+            return {
+                'rate_per_minute': round(self.rate * 60, 2),
+                'capacity': self.capacity,
+                'tokens': round(self.tokens, 2),
+                'waiting': dict(self._waiting),
+                **{k: (round(v, 2) if isinstance(v, float) else v) for k, v in self.stats.items()},
+            }
+
+
+class SheetsScheduler:
+    """
+    Điều phối mọi lời gọi Sheets API: token bucket theo loại, làn ưu tiên, backoff khi bị giới hạn.
+    """
+
+    def __init__(self, reads_per_minute: float = READS_PER_MINUTE, writes_per_minute: float = WRITES_PER_MINUTE,
+                 max_retries: int = MAX_RETRIES, sleep: Callable[[float], None] = time.sleep):
+        self.buckets = {
+            'read': TokenBucket('đọc', reads_per_minute),
+            'write': TokenBucket('ghi', writes_per_minute),
+        }
+        self.max_retries = max_retries
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0, 'reads': 0, 'writes': 0, 'unmetered': 0,
+            'rate_limited': 0, 'server_errors': 0, 'retries': 0, 'failures': 0,
+            'not_retried': 0, 'backoff_seconds': 0.0,
+            INTERACTIVE: 0, BACKGROUND: 0,
+        }
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    @staticmethod
+    def classify(method: str, endpoint: str) -> Optional[str]:
+        # Drive API (modifiedTime) có quota riêng, không tính vào quota của Sheets.
+        if '/drive/' in endpoint:
+            return None
+        return 'read' if method.lower() == 'get' else 'write'
+
+    @staticmethod
+    def is_idempotent(method: str, endpoint: str) -> bool:
+        method = method.lower()
+        if method in ('get', 'head', 'put'):
+            return True
+        return method == 'post' and endpoint.split('?')[0].endswith(IDEMPOTENT_POST_SUFFIXES)
+
+    @staticmethod
+    def _retry_after(error: APIError) -> Optional[float]:
+        try:
+            value = error.response.headers.get('Retry-After')
+            return float(value) if value else None
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def execute(self, method: str, endpoint: str, call: Callable[[], object]):
+        lane = _lane.get()
+        kind = self.classify(method, endpoint)
+        self._count('calls')
+        self._count(lane)
+        self._count(kind + 's' if kind else 'unmetered')
+        max_wait = INTERACTIVE_MAX_WAIT_SECONDS if lane == INTERACTIVE else None
+
+        idempotent = self.is_idempotent(method, endpoint)
+        attempt = 0
+        while True:
+            if kind is not None:
+                self.buckets[kind].acquire(lane, max_wait)
+            try:
+                return call()
+            except APIError as e:
+                status = retryable_status(e)
+                if status is None:
+                    raise
+                if status == 429:
+                    self._count('rate_limited')
+                    if kind is not None:
+                        self.buckets[kind].drain()
+                else:
+                    self._count('server_errors')
+                if status != 429 and not idempotent:
+                    # 5xx có thể đến sau khi lệnh đã được áp dụng: không gửi lại mù quáng.
+                    # 429 thì Google từ chối trước khi làm gì nên luôn thử lại được.
+                    self._count('not_retried')
+                    raise
+                if attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                self.backoff(attempt, e)
+                attempt += 1
+
+    def backoff(self, attempt: int, error: APIError):
+        """
+        Chờ trước lần thử lại thứ attempt + 1 (dùng chung cho lời gọi tự thử lại
+        lệnh không lặp lại an toàn sau khi đã đối chiếu với sheet).
+        """
+        # Full jitter: chờ ngẫu nhiên trong [0, base * 2^attempt], trừ khi Google chỉ định Retry-After.
+        delay = self._retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+        self._count('retries')
+        self._count('backoff_seconds', delay)
+        print(f"Google Sheets trả {retryable_status(error)}, thử lại lần {attempt + 1} sau {delay:.1f}s ({_lane.get()}).")
+        self._sleep(delay)
+
+    def status(self) -> dict:
+        with self._lock:
+            stats = {k: (round(v, 2) if isinstance(v, float) else v) for k, v in self.stats.items()}
+        return {**stats, 'buckets': {name: bucket.status() for name, bucket in self.buckets.items()}}
+
+
+scheduler = SheetsScheduler()
+
+
+class ScheduledClient(gspread.Client):
+    """
+    gspread.Client mà mọi request HTTP đều đi qua scheduler dùng chung của process.
+    """
+
+    def request(self, method, endpoint, *args, **kwargs):
+        parent = super().request
+        return scheduler.execute(method, endpoint, lambda: parent(method, endpoint, *args, **kwargs))
@@ -0,0 +1,169 @@
+"""
+BookingStore: đồng bộ delta theo fingerprint, gộp lời gọi đồng bộ (SingleFlight),
+ghi trực tiếp vào bộ nhớ (write-through) và công bố snapshot cho worker khác.
+"""
+
+import gc
+import threading
+import time
+import weakref
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import booking_store
+from booking_store import SingleFlight
+from conftest import memory_store
+from data_snapshot import SharedVersionCounter
+
+
+@pytest.fixture
+def bookings(sheet_values):
+    """20 booking cố định B0..B19 (Khách i, check-in 2025-03-(1 + i % 20), 2 đêm)."""
+    sheet_values.extend([f'B{i}', 'Home A' if i % 2 else 'Home B', f'Khách {i}', f'2025-03-{1 + i % 20:02d}',
+                         f'2025-03-{3 + i % 20:02d}', 'OK', str(100000 * (i + 1)), 'LOC LE', '']
+                        for i in range(20))
+    return sheet_values
+
+
+def test_single_row_edit_copies_only_the_edited_columns(bookings, tmp_path):
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    before = store.get()
+
+    assert store.apply_update('B3', {'Tên người đặt': 'Mới', 'Check-out Date': '2025-03-09'})
+    after = store.get()
+
+    assert after is not before
+    assert before.loc[3, 'Tên người đặt'] == 'Khách 3'
+    assert after.loc[3, 'Tên người đặt'] == 'Mới'
+    assert after.loc[3, 'Nights'] == 5
+    # Cột không bị sửa dùng chung dữ liệu với frame cũ.
+    assert np.shares_memory(before['Tổng thanh toán'].to_numpy(), after['Tổng thanh toán'].to_numpy())
+    assert not np.shares_memory(before['Nights'].to_numpy(), after['Nights'].to_numpy())
+
+
+def test_snapshot_publication_is_debounced(bookings, tmp_path):
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    published = store.stats['snapshot_publishes']
+    shared = SharedVersionCounter(tmp_path)
+    version = shared.read()
+
+    for i in range(5):
+        store.apply_update(f'B{i}', {'Tên người đặt': f'Sửa {i}'})
+    assert store.stats['snapshot_publishes'] == published
+    assert shared.read() == version
+
+    store.flush_publish()
+    assert store.stats['snapshot_publishes'] == published + 1
+    assert shared.read() == version + 1
+
+    # Worker khác thấy đúng cả năm lần sửa.
+    other = memory_store(tmp_path)
+    with other._lock:
+        other._check_shared_version()
+    assert other._df['Tên người đặt'].head(5).tolist() == [f'Sửa {i}' for i in range(5)]
+
+
+def test_exit_hook_flushes_live_stores_without_keeping_them_alive(bookings, tmp_path):
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    store.apply_update('B0', {'Tên người đặt': 'Lúc tắt'})
+    published = store.stats['snapshot_publishes']
+
+    booking_store._flush_all_publishes()
+    assert store.stats['snapshot_publishes'] == published + 1
+
+    # Store đã hết dùng được thu hồi, không còn nằm trong danh sách của hook.
+    gone = weakref.ref(memory_store(tmp_path))
+    gc.collect()
+    assert gone() is None
+    assert store in booking_store._stores
+
+
+def test_unpublished_local_write_is_not_lost_to_another_workers_snapshot(bookings, tmp_path):
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    store.apply_update('B1', {'Tên người đặt': 'Chưa công bố'})
+
+    SharedVersionCounter(tmp_path).bump()  # worker khác vừa ghi
+    with store._lock:
+        store._check_shared_version()
+    assert store._dirty
+    assert store._df.loc[1, 'Tên người đặt'] == 'Chưa công bố'
+
+
+def test_delta_sync_reparses_only_changed_rows(bookings, tmp_path):
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    reparsed, reused = store.stats['rows_reparsed'], store.stats['rows_reused']
+
+    bookings[4][2] = 'Sửa trên sheet'
+    del bookings[10]
+    bookings.insert(7, ['N1', 'Home C', 'Mới', '2025-04-01', '2025-04-03', 'OK', '5', '', ''])
+    assert store.sync(force=True)
+
+    assert store.stats['delta_syncs'] == 1
+    assert store.stats['rows_reparsed'] - reparsed == 2
+    assert store.stats['rows_reused'] - reused == 18
+    # Kết quả phải giống hệt một lần parse lại toàn bộ sheet.
+    expected = booking_store.build_bookings_dataframe(bookings[0], bookings[1:])
+    pd.testing.assert_frame_equal(store.get(), expected)
+
+
+def _run_collapsed(flight, fn, followers):
+    """Một lời gọi dẫn đầu đang chạy fn, `followers` lời gọi khác đến trong lúc đó."""
+    release = threading.Event()
+    outcomes = []
+
+    def leader_fn():
+        release.wait(5)
+        return fn()
+
+    def call(body):
+        try:
+            outcomes.append(('ok', flight.do('key', body)))
+        except Exception as e:
+            outcomes.append(('error', e))
+
+    threads = [threading.Thread(target=call, args=(leader_fn,))]
+    threads[0].start()
+    while flight.in_flight() == 0:
+        time.sleep(0.001)
+    threads += [threading.Thread(target=call, args=(fn,)) for _ in range(followers)]
+    for thread in threads[1:]:
+        thread.start()
+    while flight.stats['collapsed'] < followers:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+def test_single_flight_runs_concurrent_calls_once():
+    flight = SingleFlight()
+    runs = []
+    outcomes = _run_collapsed(flight, lambda: runs.append(1) or object(), followers=4)
+
+    assert len(runs) == 1
+    assert len({id(value) for _, value in outcomes}) == 1
+    assert flight.stats == {'calls': 5, 'executions': 1, 'collapsed': 4, 'errors': 0}
+    assert flight.in_flight() == 0
+    # Lời gọi sau khi đã xong chạy lại từ đầu.
+    flight.do('key', lambda: runs.append(1))
+    assert len(runs) == 2
+
+
+def test_single_flight_shares_the_leaders_exception():
+    flight = SingleFlight()
+    error = ConnectionError('mất kết nối')
+
+    def fail():
+        raise error
+    outcomes = _run_collapsed(flight, fail, followers=3)
+
+    assert outcomes == [('error', error)] * 4
+    assert flight.stats['errors'] == 1 and flight.in_flight() == 0
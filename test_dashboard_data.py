@@ -0,0 +1,139 @@
+"""
+Số liệu dashboard đọc từ RevenueCube phải giống hệt cách tính cũ (lọc và groupby
+trực tiếp trên DataFrame), kể cả sau khi khối được cập nhật tăng dần.
+"""
+
+import datetime
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import logic
+from conftest import HEADER, bookings_frame, random_booking
+from logic import RevenueCube, prepare_dashboard_data
+
+# Gần ba năm check-in, một số booking để trống mã đặt phòng.
+BOOKINGS = {'first': datetime.date(2023, 1, 1), 'span': 900, 'missing_id': 0.02}
+
+
+def _frame(seed, n=1500):
+    return bookings_frame(random.Random(seed), n, **BOOKINGS)
+
+
+def _reference_dashboard(df, start_date, end_date, sort_by=None, sort_order='asc'):
+    """Cách tính cũ của prepare_dashboard_data, làm chuẩn để so sánh."""
+    df = df.copy()
+    df['Check-in Date'] = pd.to_datetime(df['Check-in Date'])
+    uncollected = df['Người thu tiền'].isna() | df['Người thu tiền'].isin(['', 'N/A'])
+    month = df['Check-in Date'].dt.to_period('M')
+
+    monthly_revenue = df.groupby(month, observed=True)['Tổng thanh toán'].sum().reset_index()
+    monthly_revenue = pd.DataFrame({'Tháng': monthly_revenue['Check-in Date'].dt.strftime('%Y-%m'),
+                                    'Doanh thu': monthly_revenue['Tổng thanh toán']})
+    collected = df[~uncollected]
+    monthly_collected = collected.groupby(month[~uncollected])['Tổng thanh toán'].sum().reset_index()
+    monthly_collected = pd.DataFrame({'Tháng': monthly_collected['Check-in Date'].dt.strftime('%Y-%m'),
+                                      'Doanh thu đã thu': monthly_collected['Tổng thanh toán']})
+    genius_stats = df.groupby('Thành viên Genius', observed=True).agg(
+        {'Tổng thanh toán': 'sum', 'Số đặt phòng': 'count'}).reset_index()
+    genius_stats.columns = ['Thành viên Genius', 'Tổng doanh thu', 'Số lượng booking']
+    monthly_guests = df.groupby(month).size().reset_index(name='Số khách')
+    monthly_guests = pd.DataFrame({'Tháng': monthly_guests['Check-in Date'].dt.strftime('%Y-%m'),
+                                   'Số khách': monthly_guests['Số khách']})
+    weekly_guests = df.groupby(df['Check-in Date'].dt.to_period('W')).size().reset_index(name='Số khách')
+    weekly_guests = pd.DataFrame({'Tuần': weekly_guests['Check-in Date'].astype(str),
+                                  'Số khách': weekly_guests['Số khách']})
+
+    selected = df[(df['Check-in Date'] >= pd.Timestamp(start_date)) & (df['Check-in Date'] <= pd.Timestamp(end_date))
+                  & (df['Check-in Date'] <= pd.Timestamp.now())]
+    collector_revenue = selected.groupby('Người thu tiền', observed=True)['Tổng thanh toán'].sum().reset_index()
+    collector_revenue = collector_revenue[~collector_revenue['Người thu tiền'].isin(['', 'N/A'])]
+
+    if sort_by and sort_by in monthly_revenue.columns:
+        monthly_revenue = monthly_revenue.sort_values(by=sort_by, ascending=sort_order == 'asc')
+    else:
+        monthly_revenue = monthly_revenue.sort_values(by='Tháng', ascending=False)
+    return {
+        'total_revenue_selected': int(selected['Tổng thanh toán'].sum()),
+        'total_guests_selected': len(selected),
+        'collector_revenue_selected': collector_revenue,
+        'monthly_revenue_all_time': monthly_revenue,
+        'monthly_collected_revenue': monthly_collected.sort_values('Tháng', ascending=False),
+        'genius_stats': genius_stats,
+        'monthly_guests_all_time': monthly_guests.sort_values('Tháng', ascending=False),
+        'weekly_guests_all_time': weekly_guests.sort_values('Tuần', ascending=False),
+    }
+
+
+def _assert_same_dashboard(actual, expected):
+    for key, value in expected.items():
+        if isinstance(value, pd.DataFrame):
+            got = actual[key].reset_index(drop=True)
+            value = value.reset_index(drop=True)
+            assert list(got.columns) == list(value.columns), key
+            assert got.astype(str).values.tolist() == value.astype(str).values.tolist(), key
+        else:
+            assert actual[key] == value, key
+
+
+RANGES = [
+    (datetime.datetime(2023, 3, 1, 15, 30), datetime.datetime(2023, 5, 31, 10)),
+    (datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 31)),
+    (datetime.datetime(2020, 1, 1), datetime.datetime(2030, 1, 1)),
+    (datetime.datetime(2024, 6, 1), datetime.datetime(2024, 5, 1)),
+]
+
+
+@pytest.mark.parametrize('start_date, end_date', RANGES)
+@pytest.mark.parametrize('sort_by, sort_order', [(None, 'asc'), ('Doanh thu', 'asc'), ('Tháng', 'desc')])
+def test_dashboard_matches_reference(start_date, end_date, sort_by, sort_order):
+    df = _frame(1)
+    _assert_same_dashboard(prepare_dashboard_data(df, start_date, end_date, sort_by, sort_order),
+                           _reference_dashboard(df, start_date, end_date, sort_by, sort_order))
+
+
+def test_range_totals_match_filtering_the_frame():
+    df = _frame(2)
+    totals = RevenueCube.from_dataframe(df).range_totals()
+    days = df['Checkin_Day'].to_numpy()
+    rng = random.Random(4)
+    origin = logic.date_to_day(BOOKINGS['first'])
+    for _ in range(200):
+        first = origin + rng.randint(-30, 950)
+        last = first + rng.randint(-3, 200)
+        selected = df[(days != logic.MISSING_DAY) & (days >= first) & (days <= last)]
+        assert totals.totals(first, last) == (int(selected['Tổng thanh toán'].sum()), len(selected))
+        by_collector = selected.groupby('Người thu tiền', observed=True)['Tổng thanh toán'].sum()
+        assert dict(totals.by_collector(first, last)) == {name: int(v) for name, v in by_collector.items()}
+
+
+def test_updated_cube_matches_rebuild():
+    rng = random.Random(5)
+    df = _frame(3, n=400)
+    cube = RevenueCube.from_dataframe(df)
+    for step in range(30):
+        choice = rng.random()
+        if choice < 0.5:
+            position = rng.randrange(len(df))
+            row = random_booking(rng, f'U{step}', **BOOKINGS)
+            df = logic.update_booking_row(df, position, dict(zip(HEADER[1:], row[1:])))
+            change = {'kind': 'update', 'positions': [position]}
+        elif choice < 0.75:
+            positions = rng.sample(range(len(df)), 3)
+            df = df.drop(index=df.index[positions]).reset_index(drop=True)
+            change = {'kind': 'delete', 'positions': positions}
+        else:
+            extra = logic.build_bookings_dataframe(HEADER, [random_booking(rng, f'N{step}-{j}', **BOOKINGS)
+                                                          for j in range(2)])
+            df = logic.concat_booking_frames([df, extra], ignore_index=True)
+            change = {'kind': 'append', 'positions': [len(df) - 2, len(df) - 1]}
+        cube = cube.updated(change, df)
+
+        fresh = RevenueCube.from_dataframe(df)
+        assert cube.cells == fresh.cells
+        assert cube.row_keys == fresh.row_keys
+        assert np.array_equal(cube.row_amounts, fresh.row_amounts)
+        _assert_same_dashboard(prepare_dashboard_data(df, *RANGES[2], cube=cube),
+                               _reference_dashboard(df, *RANGES[2]))
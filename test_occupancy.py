@@ -0,0 +1,222 @@
+"""
+Chỉ mục lượt ở, công suất theo chỗ nghỉ, tìm ngày trống, phát hiện đặt trùng và
+doanh thu theo đêm ở: so với cách tính từng đêm, kể cả sau các lần sửa/xóa/thêm tại chỗ.
+"""
+
+import datetime
+import random
+from collections import Counter, defaultdict
+
+import numpy as np
+import pytest
+
+import logic
+from conftest import FIRST_DAY, HEADER, bookings_frame, memory_store, random_booking
+from occupancy import (
+    DailySeries, NightlyRevenue, PropertyOccupancy, StayIndex, find_available_checkins, sliding_window_min, sweep_overbookings
+)
+
+
+CAPACITIES = {'A': 1, 'B': 2, 'C': 3}
+
+
+def _brute_stays(df):
+    """[(mã, chỗ nghỉ, ngày check-in, ngày check-out, tiền)] của các lượt ở hợp lệ chưa hủy."""
+    columns = ['Số đặt phòng', 'Tên chỗ nghỉ', 'Checkin_Day', 'Checkout_Day', 'Tổng thanh toán', 'Is_Cancelled']
+    return [(booking_id, name, start, end, amount)
+            for booking_id, name, start, end, amount, cancelled in zip(*(df[column].tolist() for column in columns))
+            if logic.MISSING_DAY not in (start, end) and end > start and not cancelled]
+
+
+def _brute_counts(stays):
+    """Số lượt ở của từng (chỗ nghỉ, đêm), đếm từng đêm một."""
+    counts = Counter()
+    for _, name, start, end, _ in stays:
+        for day in range(start, end):
+            counts[name, day] += 1
+    return counts
+
+
+@pytest.fixture
+def store(sheet_values, tmp_path):
+    rng = random.Random(7)
+    sheet_values.extend(random_booking(rng, f'B{i}') for i in range(200))
+    store = memory_store(tmp_path, publish_delay=60)
+    store.sync()
+    return store
+
+
+def _random_edits(store, steps=40, seed=1):
+    """Sửa/xóa/thêm ngẫu nhiên qua BookingStore; trả về DataFrame sau mỗi bước."""
+    rng = random.Random(seed)
+    for step in range(steps):
+        ids = store.get()['Số đặt phòng'].tolist()
+        choice = rng.random()
+        if choice < 0.5:
+            booking = random_booking(rng, rng.choice(ids))
+            assert store.apply_update(booking[0], dict(zip(HEADER[1:], booking[1:])))
+        elif choice < 0.75:
+            store.apply_delete(rng.sample(ids, 3))
+        else:
+            store.apply_append([dict(zip(HEADER, random_booking(rng, f'N{step}-{j}'))) for j in range(3)])
+        yield store.get()
+
+
+def test_stay_index_updated_matches_rebuild(store):
+    built = []
+
+    def build(df):
+        built.append(1)
+        return StayIndex.from_dataframe(df)
+
+    store.derived('stay_index', build, StayIndex.updated)
+    origin = logic.date_to_day(FIRST_DAY)
+    for df in _random_edits(store):
+        index = store.derived('stay_index', build, StayIndex.updated)
+        fresh = StayIndex.from_dataframe(df)
+        for day in range(origin - 3, origin + 75, 3):
+            assert index.arrivals(day).tolist() == fresh.arrivals(day).tolist()
+            assert index.departures(day).tolist() == fresh.departures(day).tolist()
+            assert index.staying_over(day).tolist() == fresh.staying_over(day).tolist()
+            assert index.overlapping(day, day + 7).tolist() == fresh.overlapping(day, day + 7).tolist()
+    assert len(built) == 1
+
+
+def test_property_occupancy_updated_matches_per_night_counts(store):
+    build = lambda df: PropertyOccupancy.from_dataframe(df, CAPACITIES)
+    first, last = logic.date_to_day(FIRST_DAY) - 5, logic.date_to_day(FIRST_DAY) + 80
+    store.derived('property_occupancy', build, PropertyOccupancy.updated)
+    for df in _random_edits(store, seed=2):
+        occupancy = store.derived('property_occupancy', build, PropertyOccupancy.updated)
+        counts = _brute_counts(_brute_stays(df))
+        for name in 'ABC':
+            expected = [counts[name, day] for day in range(first, last + 1)]
+            assert occupancy.occupied(name, first, last).tolist() == expected
+
+
+@pytest.mark.parametrize('dtype', ['int32', 'float64'])
+def test_sliding_window_min_matches_brute_force(dtype):
+    rng = np.random.default_rng(3)
+    for n in (0, 1, 5, 17, 64):
+        values = rng.integers(-5, 10, n).astype(dtype)
+        for window in (0, 1, 2, 3, 7, 16, 64, 65):
+            expected = [values[i:i + window].min() for i in range(n - window + 1)] if 0 < window <= n else []
+            assert sliding_window_min(values, window).tolist() == expected
+
+
+@pytest.mark.parametrize('nights, rooms', [(1, 1), (3, 1), (4, 2), (10, 3)])
+def test_find_available_checkins_matches_brute_force(nights, rooms):
+    df = bookings_frame(random.Random(11), 300)
+    counts = _brute_counts(_brute_stays(df))
+    start, end = FIRST_DAY - datetime.timedelta(days=5), FIRST_DAY + datetime.timedelta(days=75)
+    result = find_available_checkins(PropertyOccupancy.from_dataframe(df, CAPACITIES), start, end, nights,
+                                     rooms=rooms)
+
+    for row in result['properties']:
+        name = row['name']
+        expected = []
+        for day in range(logic.date_to_day(start), logic.date_to_day(end) + 1):
+            remaining = min(CAPACITIES[name] - counts[name, night] for night in range(day, day + nights))
+            if remaining >= rooms:
+                expected.append((logic.day_to_date(day).isoformat(), remaining))
+        assert [(slot['check_in'], slot['remaining']) for slot in row['available']] == expected
+
+
+def _brute_overbookings(stays):
+    """Các đêm vượt sức chứa, gộp thành khoảng liên tiếp theo từng chỗ nghỉ."""
+    counts = _brute_counts(stays)
+    conflicts = []
+    for name in sorted({stay[1] for stay in stays}):
+        runs = []
+        for day in sorted(day for (prop, day), count in counts.items() if prop == name and count > CAPACITIES[name]):
+            if runs and runs[-1][1] == day:
+                runs[-1][1] = day + 1
+            else:
+                runs.append([day, day + 1])
+        for start, end in runs:
+            conflicts.append({
+                'property': name,
+                'capacity': CAPACITIES[name],
+                'peak': max(counts[name, day] for day in range(start, end)),
+                'start': logic.day_to_date(start).isoformat(),
+                'end': logic.day_to_date(end).isoformat(),
+                'nights': end - start,
+                'booking_ids': sorted(stay[0] for stay in stays
+                                      if stay[1] == name and stay[2] < end and stay[3] > start),
+            })
+    return conflicts
+
+
+def _sweep(stays):
+    ids, names, starts, ends = (list(column) for column in zip(*stays)) if stays else ([], [], [], [])
+    return sweep_overbookings(np.array(ids, dtype=object), np.array(names, dtype=object),
+                              np.array(starts, dtype='int64'), np.array(ends, dtype='int64'),
+                              capacities=CAPACITIES)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sweep_overbookings_matches_brute_force(seed):
+    stays = _brute_stays(bookings_frame(random.Random(seed), 80))
+    by_property = lambda conflicts: sorted(conflicts, key=lambda c: (c['property'], c['start']))
+    assert by_property(_sweep([stay[:4] for stay in stays])) == by_property(_brute_overbookings(stays))
+
+
+def test_checkout_and_checkin_on_the_same_day_do_not_overlap():
+    day = logic.date_to_day(FIRST_DAY)
+    stays = [('X1', 'A', day, day + 2), ('X2', 'A', day + 2, day + 4)]
+    assert _sweep(stays) == []
+
+    stays.append(('X3', 'A', day + 1, day + 2))
+    assert _sweep(stays) == [{
+        'property': 'A', 'capacity': 1, 'peak': 2,
+        'start': '2025-01-02', 'end': '2025-01-03', 'nights': 1, 'booking_ids': ['X1', 'X3'],
+    }]
+
+
+def test_nightly_revenue_matches_per_night_split():
+    df = bookings_frame(random.Random(13), 300)
+    stays = _brute_stays(df)
+    revenue, nights = defaultdict(int), defaultdict(int)
+    for _, name, start, end, amount in stays:
+        base, remainder = divmod(amount, end - start)
+        for offset, day in enumerate(range(start, end)):
+            revenue[name, day] += base + (offset < remainder)
+            nights[name, day] += 1
+
+    nightly = NightlyRevenue.from_dataframe(df, CAPACITIES)
+    origin = logic.date_to_day(FIRST_DAY)
+    rng = random.Random(1)
+    for _ in range(30):
+        first = origin + rng.randint(-10, 70)
+        last = first + rng.randint(-1, 40)
+        for row in nightly.summary(first, last, ['A', 'B', 'C', 'Z']):
+            days = range(first, last + 1)
+            assert row['revenue'] == sum(revenue[row['property'], day] for day in days)
+            assert row['nights_sold'] == sum(nights[row['property'], day] for day in days)
+            assert row['available_nights'] == CAPACITIES.get(row['property'], 1) * len(days)
+
+    # Tổng qua mọi tháng giữ nguyên tổng tiền của các lượt ở (không mất đồng nào khi chia).
+    monthly = nightly.monthly(FIRST_DAY - datetime.timedelta(days=31), FIRST_DAY + datetime.timedelta(days=120))
+    assert sum(monthly['revenue']) == sum(stay[4] for stay in stays)
+    assert monthly['excludes_cancelled'] is True
+
+
+def test_daily_series_heatmap_matches_per_day_sums():
+    df = bookings_frame(random.Random(17), 300)
+    stays = _brute_stays(df)
+    counts = _brute_counts(stays)
+    arrivals, revenue = Counter(), Counter()
+    for start, cancelled, amount in zip(df['Checkin_Day'], df['Is_Cancelled'], df['Tổng thanh toán']):
+        if start != logic.MISSING_DAY and not cancelled:
+            arrivals[start] += 1
+            revenue[start] += amount
+
+    start, end = FIRST_DAY - datetime.timedelta(days=10), FIRST_DAY + datetime.timedelta(days=80)
+    heatmap = DailySeries.from_dataframe(df).heatmap(start, end, 6)
+    days = range(logic.date_to_day(start), logic.date_to_day(end) + 1)
+    assert heatmap['occupied'] == [sum(counts[name, day] for name in 'ABC') for day in days]
+    assert heatmap['arrivals'] == [arrivals[day] for day in days]
+    # Doanh thu theo ngày check-in, không tính đơn đã hủy (khác dashboard).
+    assert heatmap['revenue'] == [revenue[day] for day in days]
+    assert heatmap['excludes_cancelled'] is True
+    assert sum(month['revenue'] for month in heatmap['months']) == sum(heatmap['revenue'])
@@ -0,0 +1,113 @@
+"""
+Chỉ mục mã đặt phòng -> số hàng: mọi lệnh sửa/xóa phải rơi đúng booking kể cả
+khi sheet bị dịch hàng ngoài process (worker khác xóa hàng, nhân viên sửa tay).
+"""
+
+import logic
+from booking_store import BookingStore
+from data_snapshot import SharedVersionCounter
+
+SHEET = ('sheet-id', 'BookingManager')
+
+
+def _warm_index(sheet):
+    logic.refresh_row_index_from_values(*SHEET, sheet.get_all_values())
+    return logic._row_index_for(*SHEET)
+
+
+def test_update_after_rows_shift_elsewhere_hits_the_right_booking(fake_sheet):
+    index = _warm_index(fake_sheet)
+    assert index.lookup('B4') == [5]
+
+    # Worker khác xóa B2: B4 dịch lên hàng 4, chỉ mục của process này vẫn nói hàng 5.
+    fake_sheet.delete_rows(3)
+    assert logic.update_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B4', {'Tên người đặt': 'Mới'})
+
+    assert fake_sheet.cell('B4', 'Tên người đặt') == ['Mới']
+    assert fake_sheet.cell('B5', 'Tên người đặt') == ['Khách 5']
+    assert index.stats['mismatches'] == 1
+
+
+def test_verified_write_costs_one_read(fake_sheet):
+    _warm_index(fake_sheet)
+    assert logic.update_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B3', {'Tổng thanh toán': '1'})
+    assert len(fake_sheet.api_calls('batch_get')) == 1
+    assert len(fake_sheet.api_calls('get_all_values')) == 1  # chỉ lần _warm_index
+    assert fake_sheet.cell('B3', 'Tổng thanh toán') == ['1']
+
+
+def test_delete_after_manual_insert_never_deletes_another_booking(fake_sheet):
+    _warm_index(fake_sheet)
+    # Nhân viên chèn tay một hàng lên đầu bảng: mọi booking dịch xuống một hàng.
+    fake_sheet.rows.insert(1, ['X1', 'Khách tay', '0'])
+
+    assert logic.delete_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B2')
+    assert fake_sheet.ids() == ['X1', 'B1', 'B3', 'B4', 'B5']
+
+
+def test_duplicate_booking_id_is_updated_and_deleted_on_every_row(fake_sheet):
+    # Mã B2 bị nhập trùng ở cuối bảng: sửa/xóa một mã phải tác động mọi hàng như khi xóa hàng loạt.
+    fake_sheet.rows.append(['B2', 'Khách trùng', '0'])
+    _warm_index(fake_sheet)
+
+    assert logic.update_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B2', {'Tên người đặt': 'Mới'})
+    assert fake_sheet.cell('B2', 'Tên người đặt') == ['Mới', 'Mới']
+
+    assert logic.delete_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B2')
+    assert fake_sheet.ids() == ['B1', 'B3', 'B4', 'B5']
+    assert fake_sheet.api_calls('deleteDimension') == [('deleteDimension', 2)]
+    assert fake_sheet.api_calls('delete_rows') == []
+
+
+def test_delete_many_after_shift_deletes_exactly_the_requested_ids(fake_sheet):
+    _warm_index(fake_sheet)
+    fake_sheet.delete_rows(2)  # B1 bị xóa ở worker khác
+
+    report = logic.delete_multiple_rows_in_gsheet('sheet-id', 'creds', 'BookingManager', ['B3', 'B4', 'B1'])
+    assert report['success']
+    assert report['deleted'] == ['B3', 'B4']
+    assert report['missing'] == ['B1']
+    assert fake_sheet.ids() == ['B2', 'B5']
+
+
+def test_update_many_reports_missing_only_after_checking_the_sheet(fake_sheet):
+    _warm_index(fake_sheet)
+    fake_sheet.rows.append(['B6', 'Khách 6', '600000'])  # thêm ở worker khác
+
+    report = logic.update_multiple_rows_in_gsheet(
+        'sheet-id', 'creds', 'BookingManager', {'B6': {'Tên người đặt': 'Sáu'}, 'B9': {'Tên người đặt': '?'}})
+    assert report['updated'] == ['B6'] and report['missing'] == ['B9']
+    assert fake_sheet.cell('B6', 'Tên người đặt') == ['Sáu']
+
+
+def test_rebuild_from_values_fetched_before_a_local_delete_is_ignored(fake_sheet):
+    index = _warm_index(fake_sheet)
+    generation = logic.row_index_generation(*SHEET)
+    values_before_delete = fake_sheet.get_all_values()
+
+    # Trong lúc BookingStore.sync đang tải, process này xóa B1.
+    assert logic.delete_row_in_gsheet('sheet-id', 'creds', 'BookingManager', 'B1')
+    logic.refresh_row_index_from_values(*SHEET, values_before_delete, generation)
+
+    assert not index.is_fresh()
+    assert index.lookup('B2') == [2]
+
+
+def test_shared_version_change_invalidates_row_index(fake_sheet, tmp_path):
+    index = _warm_index(fake_sheet)
+    store = BookingStore('sheet-id', 'creds', 'BookingManager', shared_version=SharedVersionCounter(tmp_path))
+    with store._lock:
+        store._check_shared_version()
+    _warm_index(fake_sheet)
+    assert index.is_fresh()
+
+    # Worker khác ghi và tăng bộ đếm dùng chung.
+    SharedVersionCounter(tmp_path).bump()
+    with store._lock:
+        store._check_shared_version()
+    assert not index.is_fresh()
+
+
+def test_merge_row_ranges_is_bottom_up():
+    assert logic._merge_row_ranges([2, 3, 4, 7, 9, 10, 3]) == [(9, 10), (7, 7), (2, 4)]
+    assert logic._merge_row_ranges([]) == []
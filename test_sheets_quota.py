@@ -0,0 +1,145 @@
+"""
+Scheduler gọi Sheets API: 429 luôn được thử lại, 5xx chỉ với lệnh lặp lại an toàn;
+token bucket hai làn so với mô hình tham chiếu.
+"""
+
+import random
+from types import SimpleNamespace
+
+import pytest
+from gspread.exceptions import APIError
+
+import sheets_quota
+from sheets_quota import BACKGROUND, INTERACTIVE, QuotaWaitTimeout, SheetsScheduler, TokenBucket
+
+BASE = 'https://sheets.googleapis.com/v4/spreadsheets/abc'
+
+
+class _Response:
+    headers = {}
+    text = 'error'
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': 'error', 'status': 'UNAVAILABLE'}}
+
+
+def _flaky(status, failures=1):
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise APIError(_Response(status))
+        return 'ok'
+    return call, calls
+
+
+@pytest.fixture
+def sched():
+    return SheetsScheduler(reads_per_minute=0, writes_per_minute=0, sleep=lambda delay: None)
+
+
+@pytest.mark.parametrize('method, endpoint', [
+    ('get', f'{BASE}/values/Sheet!A1:B2'),
+    ('put', f'{BASE}/values/Sheet!A1'),
+    ('post', f'{BASE}/values:batchUpdate'),
+    ('post', f'{BASE}/values:batchGet'),
+])
+def test_idempotent_calls_are_retried(sched, method, endpoint):
+    call, calls = _flaky(503, failures=2)
+    assert sched.execute(method, endpoint, call) == 'ok'
+    assert len(calls) == 3
+    assert sched.stats['retries'] == 2
+
+
+@pytest.mark.parametrize('status', [500, 503])
+@pytest.mark.parametrize('endpoint', [f'{BASE}/values/Sheet!A1:append', f'{BASE}:batchUpdate'])
+def test_append_and_structural_batch_update_are_not_retried_on_server_errors(sched, endpoint, status):
+    call, calls = _flaky(status)
+    with pytest.raises(APIError):
+        sched.execute('post', endpoint, call)
+    assert len(calls) == 1
+    assert sched.stats['not_retried'] == 1
+
+
+@pytest.mark.parametrize('endpoint', [f'{BASE}/values/Sheet!A1:append', f'{BASE}:batchUpdate'])
+def test_rate_limited_non_idempotent_calls_are_retried(sched, endpoint):
+    # 429 bị từ chối trước khi áp dụng nên gửi lại không tạo hàng trùng.
+    call, calls = _flaky(429, failures=2)
+    assert sched.execute('post', endpoint, call) == 'ok'
+    assert len(calls) == 3
+    assert sched.stats['rate_limited'] == 2 and sched.stats['not_retried'] == 0
+
+
+def test_retries_stop_after_max_retries(sched):
+    call, calls = _flaky(500, failures=99)
+    with pytest.raises(APIError):
+        sched.execute('get', f'{BASE}/values/Sheet', call)
+    assert len(calls) == sched.max_retries + 1
+    assert sched.stats['failures'] == 1
+
+
+def test_client_errors_are_not_retried(sched):
+    call, calls = _flaky(400)
+    with pytest.raises(APIError):
+        sched.execute('get', f'{BASE}/values/Sheet', call)
+    assert len(calls) == 1
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(sheets_quota, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_token_bucket_matches_reference_model(clock):
+    # 60 lượt/phút = 1 token/giây, tối đa 3 token, giữ 1 token cho làn tương tác.
+    bucket = TokenBucket('test', 60, burst=3, reserve=1)
+    rng = random.Random(5)
+    tokens = 3.0
+    for _ in range(500):
+        elapsed = rng.choice([0, 0, 0.25, 0.5, 1, 2, 5])
+        lane = rng.choice([INTERACTIVE, BACKGROUND])
+        interactive_waiting = rng.random() < 0.2
+        clock.now += elapsed
+
+        tokens = min(3.0, tokens + elapsed)
+        if lane == BACKGROUND:
+            expected = not interactive_waiting and tokens >= 2
+        else:
+            expected = tokens >= 1
+
+        bucket._waiting[INTERACTIVE] = int(interactive_waiting)
+        try:
+            bucket.acquire(lane, max_wait=0)
+            taken = True
+        except QuotaWaitTimeout:
+            taken = False
+        bucket._waiting[INTERACTIVE] = 0
+
+        assert taken == expected, (lane, interactive_waiting, tokens)
+        if taken:
+            tokens -= 1
+        assert bucket.tokens == pytest.approx(tokens)
+
+
+def test_drain_after_rate_limit_empties_the_bucket(clock):
+    bucket = TokenBucket('test', 60, burst=3)
+    bucket.drain()
+    with pytest.raises(QuotaWaitTimeout):
+        bucket.acquire(INTERACTIVE, max_wait=0)
+    clock.now += 1
+    assert bucket.acquire(INTERACTIVE, max_wait=0) == 0.0
+    assert bucket.stats['drained'] == 1 and bucket.stats['timeouts'] == 1
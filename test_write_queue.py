@@ -0,0 +1,184 @@
+"""
+Hàng đợi ghi trễ: gộp thao tác, thứ tự theo từng booking khi thử lại, append không tạo hàng trùng.
+"""
+
+import pytest
+from gspread.exceptions import APIError
+
+import logic
+from sheets_quota import scheduler
+from write_queue import WriteBehindQueue
+
+
+class _Response:
+    status_code = 503
+    headers = {}
+
+    def json(self):
+        return {'error': {'code': 503, 'message': 'backend error', 'status': 'UNAVAILABLE'}}
+
+    text = 'backend error'
+
+
+def _server_error():
+    return APIError(_Response())
+
+
+@pytest.fixture
+def queue(fake_sheet, tmp_path):
+    return WriteBehindQueue('sheet-id', 'creds', 'BookingManager', db_path=tmp_path / 'queue.sqlite3',
+                            flush_seconds=0.01, max_attempts=5)
+
+
+def _expire_backoff(queue):
+    with queue._connect() as conn:
+        conn.execute("UPDATE pending_writes SET next_attempt_at = 0 WHERE status = 'pending'")
+
+
+def _fail_next(monkeypatch, sheet, method):
+    # Lỗi mạng (không có phản hồi HTTP): không tự thử lại, cả lô chờ backoff của hàng đợi.
+    original = getattr(sheet, method)
+
+    def failing(*args, **kwargs):
+        monkeypatch.setattr(sheet, method, original)
+        raise ConnectionError('mất kết nối')
+    monkeypatch.setattr(sheet, method, failing)
+
+
+def test_coalesce_keeps_last_value_and_folds_into_appends():
+    ops = [
+        {'id': 1, 'kind': 'update', 'payload': {'booking_id': 'B1', 'new_data': {'a': 1, 'b': 1}}},
+        {'id': 2, 'kind': 'append', 'payload': {'bookings': [{'Số đặt phòng': 'N1', 'a': 0}]}},
+        {'id': 3, 'kind': 'update', 'payload': {'booking_id': 'B1', 'new_data': {'a': 2}}},
+        {'id': 4, 'kind': 'update', 'payload': {'booking_id': 'N1', 'new_data': {'a': 5}}},
+        {'id': 5, 'kind': 'delete', 'payload': {'booking_ids': ['B2']}},
+        {'id': 6, 'kind': 'update', 'payload': {'booking_id': 'B2', 'new_data': {'a': 9}}},
+        {'id': 7, 'kind': 'append', 'payload': {'bookings': [{'Số đặt phòng': 'N2'}]}},
+        {'id': 8, 'kind': 'delete', 'payload': {'booking_ids': ['N2']}},
+    ]
+    batch = WriteBehindQueue.coalesce(ops)
+    assert batch['updates'] == {'B1': {'a': 2, 'b': 1}}
+    assert batch['deletes'] == ['B2']
+    assert batch['appends'] == [{'Số đặt phòng': 'N1', 'a': 5}]
+
+
+def test_newer_update_waits_for_older_update_in_backoff(queue, fake_sheet, monkeypatch):
+    queue.enqueue_update('B1', {'Tên người đặt': 'Cũ'})
+    _fail_next(monkeypatch, fake_sheet, 'batch_update')
+    assert queue.flush()['success'] is False
+
+    queue.enqueue_update('B1', {'Tên người đặt': 'Mới'})
+    queue.enqueue_update('B2', {'Tên người đặt': 'Khác'})
+    result = queue.flush()
+    # Chỉ B2 được đẩy; lần sửa mới của B1 phải chờ lần sửa cũ.
+    assert result['updates'] == 1
+    assert fake_sheet.cell('B2', 'Tên người đặt') == ['Khác']
+    assert fake_sheet.cell('B1', 'Tên người đặt') == ['Khách 1']
+    assert queue.status()['held'] == 1
+
+    _expire_backoff(queue)
+    queue.flush()
+    assert fake_sheet.cell('B1', 'Tên người đặt') == ['Mới']
+    assert queue.status()['pending'] == 0
+
+
+def test_update_stays_pending_while_its_append_is_in_backoff(queue, fake_sheet, monkeypatch):
+    queue.enqueue_append([{'Số đặt phòng': 'N1', 'Tên người đặt': 'Mới', 'Tổng thanh toán': '1'}])
+    _fail_next(monkeypatch, fake_sheet, 'append_rows')
+    assert queue.flush()['success'] is False
+
+    queue.enqueue_update('N1', {'Tên người đặt': 'Đã sửa'})
+    assert queue.flush() == {'ops': 0}
+
+    _expire_backoff(queue)
+    queue.flush()
+    assert fake_sheet.cell('N1', 'Tên người đặt') == ['Đã sửa']
+    assert queue.status()['done'] == 2
+
+
+def test_append_retry_does_not_duplicate_rows_applied_by_the_server(queue, fake_sheet, monkeypatch):
+    monkeypatch.setattr(scheduler, '_sleep', lambda delay: None)
+    original = fake_sheet.append_rows
+
+    def applied_then_failed(values, value_input_option=None):
+        # Server đã ghi N1 nhưng vẫn trả 503.
+        monkeypatch.setattr(fake_sheet, 'append_rows', original)
+        original(values, value_input_option)
+        raise _server_error()
+    monkeypatch.setattr(fake_sheet, 'append_rows', applied_then_failed)
+
+    queue.enqueue_append([{'Số đặt phòng': 'N1', 'Tên người đặt': 'Mới'},
+                          {'Số đặt phòng': 'N2', 'Tên người đặt': 'Mới'}])
+    assert queue.flush()['success'] is True
+    assert fake_sheet.ids().count('N1') == 1
+    assert fake_sheet.ids().count('N2') == 1
+    assert len(fake_sheet.api_calls('append_rows')) == 1  # lần gửi lại không cần thiết
+
+
+def test_append_retry_resends_only_missing_bookings(fake_sheet, monkeypatch):
+    monkeypatch.setattr(scheduler, '_sleep', lambda delay: None)
+    original = fake_sheet.append_rows
+
+    def partially_applied(values, value_input_option=None):
+        monkeypatch.setattr(fake_sheet, 'append_rows', original)
+        original(values[:1], value_input_option)
+        raise _server_error()
+    monkeypatch.setattr(fake_sheet, 'append_rows', partially_applied)
+
+    report = logic.append_multiple_bookings_to_sheet(
+        [{'Số đặt phòng': 'N1'}, {'Số đặt phòng': 'N2'}], 'creds', 'sheet-id', 'BookingManager')
+    assert report == {'appended': ['N2'], 'skipped': ['N1']}
+    assert fake_sheet.ids()[-2:] == ['N1', 'N2']
+
+
+def test_ops_requeued_after_claim_timeout_are_not_applied_twice(queue, fake_sheet, monkeypatch):
+    queue.enqueue_append([{'Số đặt phòng': 'N1'}])
+    queue.enqueue_delete(['B3'])
+
+    mark_done = queue._mark_done
+
+    def crash(*args, **kwargs):
+        raise RuntimeError('worker chết trước khi đánh dấu xong')
+    monkeypatch.setattr(queue, '_mark_done', crash)
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    monkeypatch.setattr(queue, '_mark_done', mark_done)
+
+    with queue._connect() as conn:
+        conn.execute("UPDATE pending_writes SET claimed_at = 0 WHERE status = 'in_progress'")
+    assert queue.flush()['success'] is True
+    assert fake_sheet.ids() == ['B1', 'B2', 'B4', 'B5', 'N1']
+
+
+def test_append_without_booking_id_is_rejected_before_enqueue(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue_append([{'Số đặt phòng': 'N1'}, {'Số đặt phòng': None, 'Tên người đặt': 'Không mã'}])
+    assert queue.status()['pending'] == 0
+
+
+def test_update_of_booking_missing_on_sheet_is_marked_failed(queue, fake_sheet):
+    fake_sheet.delete_rows(3)  # B2 bị xóa ở nơi khác
+    queue.enqueue_update('B2', {'Tên người đặt': 'Mất'})
+    queue.enqueue_update('B3', {'Tên người đặt': 'Ba'})
+
+    result = queue.flush()
+    assert result['success'] and result['missing_updates'] == ['B2']
+    assert fake_sheet.cell('B3', 'Tên người đặt') == ['Ba']
+    status = queue.status()
+    assert status['failed'] == 1 and status['missing_updates'] == 1
+    assert [op['payload']['booking_id'] for op in status['ops']] == ['B2']
+
+    # Lần sửa sau của B2 bị giữ lại sau lần sửa đã thất bại.
+    queue.enqueue_update('B2', {'Tên người đặt': 'Mất nữa'})
+    assert queue.flush() == {'ops': 0}
+    assert queue.status()['held'] == 1
+
+
+def test_flush_reports_deletes_missing_on_the_sheet(queue, fake_sheet):
+    fake_sheet.delete_rows(2)  # B1 bị xóa ở nơi khác
+    op_id = queue.enqueue_delete(['B1', 'B4'])
+    result = queue.flush()
+    assert op_id in result['op_ids']
+    assert result['missing_deletes'] == ['B1']
+    assert fake_sheet.ids() == ['B2', 'B3', 'B5']
+    assert queue.status()['done'] == 1
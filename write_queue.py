@@ -0,0 +1,424 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from logic import (
+    append_multiple_bookings_to_sheet, delete_multiple_rows_in_gsheet,
+    update_multiple_rows_in_gsheet
+)
+from data_snapshot import SNAPSHOT_DIR
+from sheets_quota import background_priority
+
+# ==============================================================================
+# HÀNG ĐỢI GHI TRỄ (WRITE-BEHIND) LÊN GOOGLE SHEETS
+# ==============================================================================
+# Khi bật (WRITE_BEHIND_ENABLED=1), các thao tác sửa/xóa/thêm booking được ghi
+# vào một journal SQLite trên đĩa rồi trả lời người dùng ngay; thay đổi được áp
+# vào bộ nhớ (BookingStore.apply_*) ngay lập tức. Một thread nền định kỳ lấy các
+# thao tác đang chờ, gộp chúng lại và đẩy lên sheet bằng số lệnh tối thiểu:
+#
+# - mọi lần sửa -> một lệnh values batch_update (nhiều lần sửa cùng booking được
+#   gộp thành một, giá trị sau cùng thắng);
+# - mọi lần xóa -> một lệnh batchUpdate deleteDimension;
+# - mọi booking mới -> một lệnh append_rows (sửa/xóa booking chưa kịp đẩy lên
+#   được gộp thẳng vào hàng sẽ thêm, hoặc bỏ luôn).
+#
+# Journal dùng chung cho mọi worker gunicorn (SQLite khóa theo file), nên worker
+# bị recycle hay container khởi động lại vẫn tiếp tục đẩy các thao tác còn dở.
+# Khi lỗi, cả lô được thử lại với backoff lũy thừa; thứ tự sửa -> xóa -> thêm
+# giúp việc thử lại an toàn (sửa và xóa theo ID đều lặp lại được, append được
+# đối chiếu với cột mã đặt phòng trước khi gửi để không tạo hàng trùng).
+#
+# Thứ tự theo từng booking: thao tác chỉ được nhận khi mọi thao tác CŨ HƠN trên
+# cùng mã đặt phòng đã xong. Thao tác đang chờ backoff, đang được worker khác
+# đẩy hoặc đã thất bại sẽ giữ lại các thao tác mới hơn của booking đó (ví dụ
+# lần sửa của booking mà lệnh thêm còn đang chờ thử lại), để lần thử lại sau
+# không ghi đè giá trị mới hơn (giá trị sau cùng luôn thắng).
+#
+# Lần sửa booking không còn trên sheet (đã bị xóa ở nơi khác) bị đánh dấu
+# 'failed' để hiện trong /api/write_queue và có thể retry_failed, thay vì bị bỏ
+# qua trong im lặng.
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "2"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "8"))
+WRITE_BEHIND_MAX_BACKOFF_SECONDS = 300
+# Thao tác bị một worker "nhận" quá lâu (worker chết giữa chừng) được trả lại hàng đợi.
+CLAIM_TIMEOUT_SECONDS = 120
+QUEUE_DB_PATH = Path(os.getenv("WRITE_BEHIND_DB_PATH", SNAPSHOT_DIR / "write_queue.sqlite3"))
+ID_COLUMN = 'Số đặt phòng'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    done_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_pending_writes_status ON pending_writes (status, id);
+"""
+
+
+class WriteBehindQueue:
+    """
+    Journal các thao tác ghi đang chờ và thread nền đẩy chúng lên Google Sheets.
+    """
+
+    def __init__(self, sheet_id: str, gcp_creds_file_path: str, worksheet_name: str | None = None,
+                 db_path: Path = QUEUE_DB_PATH, flush_seconds: float = WRITE_BEHIND_FLUSH_SECONDS,
+                 max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS):
+        self.sheet_id = sheet_id
+        self.gcp_creds_file_path = gcp_creds_file_path
+        self.worksheet_name = worksheet_name
+        self.db_path = Path(db_path)
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.last_flush_at: Optional[datetime.datetime] = None
+        self.last_error: Optional[str] = None
+        self.stats = {'enqueued': 0, 'flushes': 0, 'ops_flushed': 0, 'api_calls': 0,
+                      'retries': 0, 'failed': 0, 'missing_updates': 0}
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    # --------------------------------------------------------------------------
+    # Journal
+    # --------------------------------------------------------------------------
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def _enqueue(self, kind: str, payload: dict) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO pending_writes (kind, payload, created_at) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False, default=str), time.time()))
+            op_id = cursor.lastrowid
+        self.stats['enqueued'] += 1
+        self._wakeup.set()
+        return op_id
+
+    def enqueue_update(self, booking_id: str, new_data: Dict[str, Any]) -> int:
+        return self._enqueue('update', {'booking_id': booking_id, 'new_data': new_data})
+
+    def enqueue_delete(self, booking_ids: List[str]) -> int:
+        return self._enqueue('delete', {'booking_ids': list(booking_ids)})
+
+    def enqueue_append(self, bookings: List[Dict[str, Any]]) -> int:
+        # Khi đẩy lại, append đối chiếu theo mã đặt phòng: không nhận booking thiếu mã.
+        if not all(booking.get(ID_COLUMN) for booking in bookings):
+            raise ValueError("Booking thêm qua hàng đợi ghi phải có mã đặt phòng.")
+        return self._enqueue('append', {'bookings': bookings})
+
+    def pending_ops(self) -> List[dict]:
+        """
+        Các thao tác chưa được ghi lên sheet (kể cả đang được đẩy), theo thứ tự.
+        Dùng cho BookingStore.set_pending_overlay.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, kind, payload FROM pending_writes "
+                "WHERE status IN ('pending', 'in_progress') ORDER BY id").fetchall()
+        return [{'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload'])} for row in rows]
+
+    @staticmethod
+    def booking_keys(kind: str, payload: dict) -> set:
+        """Các mã đặt phòng mà một thao tác đụng tới."""
+        if kind == 'update':
+            return {payload.get('booking_id')}
+        if kind == 'delete':
+            return set(payload.get('booking_ids') or [])
+        if kind == 'append':
+            return {booking.get(ID_COLUMN) for booking in payload.get('bookings') or [] if booking.get(ID_COLUMN)}
+        return set()
+
+    @classmethod
+    def claimable(cls, rows: List[sqlite3.Row], now: float) -> List[sqlite3.Row]:
+        """
+        Chọn các thao tác được đẩy ngay từ mọi thao tác chưa xong (theo id tăng dần):
+        thao tác phải đã tới hạn và không có thao tác cũ hơn nào trên cùng booking
+        còn đang chờ backoff / đang được đẩy / đã thất bại / bị giữ lại.
+        """
+        blocked: set = set()
+        claimed = []
+        for row in rows:
+            keys = cls.booking_keys(row['kind'], json.loads(row['payload']))
+            ready = row['status'] == 'pending' and row['next_attempt_at'] <= now
+            if ready and not (keys & blocked):
+                claimed.append(row)
+            else:
+                blocked |= keys
+        return claimed
+
+    def _claim(self) -> List[sqlite3.Row]:
+        now = time.time()
+        with self._connect() as conn:
+            # BEGIN IMMEDIATE: chỉ một worker nhận được cùng một lô thao tác.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE pending_writes SET status = 'pending' "
+                    "WHERE status = 'in_progress' AND claimed_at < ?", (now - CLAIM_TIMEOUT_SECONDS,))
+                rows = self.claimable(conn.execute(
+                    "SELECT * FROM pending_writes WHERE status IN ('pending', 'in_progress', 'failed') "
+                    "ORDER BY id").fetchall(), now)
+                if rows:
+                    conn.executemany(
+                        "UPDATE pending_writes SET status = 'in_progress', claimed_at = ? WHERE id = ?",
+                        [(now, row['id']) for row in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _mark_done(self, op_ids: List[int], note: Optional[str] = None):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE pending_writes SET status = 'done', done_at = ?, last_error = ? WHERE id = ?",
+                [(time.time(), note, op_id) for op_id in op_ids])
+
+    def _mark_failed(self, op_ids: List[int], error: str):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE pending_writes SET status = 'failed', attempts = attempts + 1, last_error = ?, "
+                "claimed_at = NULL WHERE id = ?", [(error, op_id) for op_id in op_ids])
+        self.stats['failed'] += len(op_ids)
+
+    def _mark_retry(self, rows: List[sqlite3.Row], error: str):
+        now = time.time()
+        updates = []
+        for row in rows:
+            attempts = row['attempts'] + 1
+            if attempts >= self.max_attempts:
+                updates.append(('failed', attempts, now, error, row['id']))
+                self.stats['failed'] += 1
+                continue
+            # Backoff lũy thừa có jitter để hai worker không thử lại cùng lúc.
+            delay = min(WRITE_BEHIND_MAX_BACKOFF_SECONDS, self.flush_seconds * (2 ** attempts))
+            updates.append(('pending', attempts, now + delay * random.uniform(0.5, 1.0), error, row['id']))
+            self.stats['retries'] += 1
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE pending_writes SET status = ?, attempts = ?, next_attempt_at = ?, "
+                "last_error = ?, claimed_at = NULL WHERE id = ?", updates)
+
+    # --------------------------------------------------------------------------
+    # Gộp và đẩy lên sheet
+    # --------------------------------------------------------------------------
+
+    @staticmethod
+    def coalesce(ops: List[dict]) -> dict:
+        """
+        Gộp danh sách thao tác (theo thứ tự) thành tối đa ba nhóm:
+        {'updates': {id: new_data}, 'deletes': [id, ...], 'appends': [booking, ...]}.
+        """
+        updates: Dict[str, dict] = {}
+        deletes: Dict[str, None] = {}
+        appends: Dict[Any, dict] = {}
+        for op in ops:
+            payload = op['payload']
+            if op['kind'] == 'append':
+                for i, booking in enumerate(payload.get('bookings') or []):
+                    key = booking.get(ID_COLUMN) or ('__no_id__', op.get('id'), i)
+                    appends[key] = dict(booking)
+            elif op['kind'] == 'update':
+                booking_id = payload['booking_id']
+                if booking_id in appends:
+                    appends[booking_id].update(payload['new_data'])
+                elif booking_id not in deletes:
+                    updates.setdefault(booking_id, {}).update(payload['new_data'])
+            elif op['kind'] == 'delete':
+                for booking_id in payload.get('booking_ids') or []:
+                    updates.pop(booking_id, None)
+                    # Booking chưa kịp đẩy lên thì chỉ cần bỏ khỏi danh sách thêm.
+                    if appends.pop(booking_id, None) is None:
+                        deletes[booking_id] = None
+        return {'updates': updates, 'deletes': list(deletes), 'appends': list(appends.values())}
+
+    def flush(self) -> dict:
+        """
+        Đẩy toàn bộ thao tác đang chờ (đã tới hạn) lên sheet. Trả về tóm tắt lô vừa đẩy,
+        kèm các mã không tìm thấy trên sheet: lần sửa booking không còn trên sheet
+        bị đánh dấu 'failed' (không âm thầm bỏ qua), còn xóa booking không có thì coi như xong.
+        """
+        with self._flush_lock:
+            rows = self._claim()
+            if not rows:
+                return {'ops': 0}
+            ops = [{'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload'])} for row in rows]
+            batch = self.coalesce(ops)
+            op_ids = [row['id'] for row in rows]
+            notes = []
+            missing_updates, missing_deletes = [], []
+            try:
+                # Thứ tự sửa -> xóa -> thêm: nếu lỗi giữa chừng, thử lại cả lô vẫn an toàn.
+                if batch['updates']:
+                    report = update_multiple_rows_in_gsheet(
+                        self.sheet_id, self.gcp_creds_file_path, self.worksheet_name, batch['updates'])
+                    self.stats['api_calls'] += 1
+                    if not report.get('success'):
+                        raise RuntimeError(report.get('error') or 'Cập nhật hàng loạt thất bại')
+                    missing_updates = list(report['missing'])
+                if batch['deletes']:
+                    report = delete_multiple_rows_in_gsheet(
+                        self.sheet_id, self.gcp_creds_file_path, self.worksheet_name, batch['deletes'])
+                    self.stats['api_calls'] += 1
+                    if not report.get('success'):
+                        raise RuntimeError(report.get('error') or 'Xóa hàng loạt thất bại')
+                    missing_deletes = list(report.get('missing') or [])
+                    if missing_deletes:
+                        notes.append(f"Không có trên sheet để xóa: {', '.join(map(str, missing_deletes))}")
+                if batch['appends']:
+                    # Lô này có thể đã được gửi một lần (lỗi sau khi server đã ghi, hoặc
+                    # worker chết trước khi đánh dấu xong): bỏ qua booking đã có trên sheet.
+                    report = append_multiple_bookings_to_sheet(
+                        batch['appends'], self.gcp_creds_file_path, self.sheet_id, self.worksheet_name,
+                        skip_existing=True)
+                    self.stats['api_calls'] += 2
+                    if report['skipped']:
+                        notes.append(f"Đã có trên sheet, không thêm lại: {', '.join(map(str, report['skipped']))}")
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Đẩy {len(rows)} thao tác ghi lên sheet thất bại, sẽ thử lại: {e}")
+                self._mark_retry(rows, str(e))
+                return {'ops': len(rows), 'success': False, 'error': str(e)}
+
+            lost = [op['id'] for op in ops
+                    if op['kind'] == 'update' and op['payload']['booking_id'] in missing_updates]
+            self._mark_done([op_id for op_id in op_ids if op_id not in lost], '; '.join(notes) or None)
+            if lost:
+                print(f"Không tìm thấy trên sheet để sửa: {', '.join(map(str, missing_updates))}")
+                self._mark_failed(lost, f"Không tìm thấy mã đặt phòng trên sheet để sửa: "
+                                        f"{', '.join(map(str, missing_updates))}")
+                self.stats['missing_updates'] += len(lost)
+            self.stats['flushes'] += 1
+            self.stats['ops_flushed'] += len(rows)
+            self.last_flush_at = datetime.datetime.now()
+            self.last_error = None
+            print(f"Đã đẩy {len(rows)} thao tác ghi lên sheet: {len(batch['updates'])} sửa, "
+                  f"{len(batch['deletes'])} xóa, {len(batch['appends'])} thêm.")
+            return {'ops': len(rows), 'success': True, 'op_ids': op_ids, 'updates': len(batch['updates']),
+                    'deletes': len(batch['deletes']), 'appends': len(batch['appends']),
+                    'missing_updates': missing_updates, 'missing_deletes': missing_deletes}
+
+    def start(self) -> bool:
+        """
+        Khởi động thread nền đẩy hàng đợi (mỗi process một thread).
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        try:
+            self.purge_done()
+        except sqlite3.Error as e:
+            print(f"Không dọn được journal hàng đợi ghi: {e}")
+
+        def _run():
+            while True:
+                # Chờ thao tác mới (hoặc hết chu kỳ), rồi đợi thêm một nhịp để gộp các thao tác liền nhau.
+                self._wakeup.wait(self.flush_seconds)
+                if self._wakeup.is_set():
+                    self._wakeup.clear()
+                    time.sleep(min(1.0, self.flush_seconds))
+                try:
+                    with background_priority():
+                        self.flush()
+                except Exception as e:
+                    print(f"Lỗi trong thread đẩy hàng đợi ghi: {e}")
+
+        self._thread = threading.Thread(target=_run, name="write-behind-flusher", daemon=True)
+        self._thread.start()
+        return True
+
+    # --------------------------------------------------------------------------
+    # Trạng thái
+    # --------------------------------------------------------------------------
+
+    def retry_failed(self) -> int:
+        """
+        Đưa các thao tác đã thất bại quá số lần cho phép trở lại hàng đợi. Chúng
+        vẫn giữ id cũ nên được đẩy trước (và gộp cùng) các thao tác mới hơn của
+        cùng booking đang bị giữ lại.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE pending_writes SET status = 'pending', attempts = 0, next_attempt_at = 0 "
+                "WHERE status = 'failed'")
+            count = cursor.rowcount
+        self._wakeup.set()
+        return count
+
+    def status(self, limit: int = 50) -> dict:
+        with self._connect() as conn:
+            counts = {row['status']: row['n'] for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM pending_writes GROUP BY status")}
+            oldest = conn.execute(
+                "SELECT MIN(created_at) AS t FROM pending_writes "
+                "WHERE status IN ('pending', 'in_progress')").fetchone()['t']
+            rows = conn.execute(
+                "SELECT id, kind, payload, status, attempts, next_attempt_at, last_error, created_at "
+                "FROM pending_writes WHERE status != 'done' ORDER BY id LIMIT ?", (limit,)).fetchall()
+            open_rows = conn.execute(
+                "SELECT * FROM pending_writes WHERE status IN ('pending', 'in_progress', 'failed') "
+                "ORDER BY id").fetchall()
+        now = time.time()
+        due = [row for row in open_rows if row['status'] == 'pending' and row['next_attempt_at'] <= now]
+        # Đã tới hạn nhưng phải chờ thao tác cũ hơn của cùng booking.
+        held = len(due) - len(self.claimable(open_rows, now))
+        return {
+            'enabled': True,
+            'pending': counts.get('pending', 0),
+            'in_progress': counts.get('in_progress', 0),
+            'failed': counts.get('failed', 0),
+            'held': held,
+            'done': counts.get('done', 0),
+            'oldest_pending_age_seconds': None if oldest is None else round(time.time() - oldest, 1),
+            'last_flush_at': self.last_flush_at.isoformat() if self.last_flush_at else None,
+            'last_error': self.last_error,
+            'flusher_running': self._thread is not None and self._thread.is_alive(),
+            **self.stats,
+            'ops': [{
+                'id': row['id'],
+                'kind': row['kind'],
+                'status': row['status'],
+                'attempts': row['attempts'],
+                'payload': json.loads(row['payload']),
+                'last_error': row['last_error'],
+                'created_at': datetime.datetime.fromtimestamp(row['created_at']).isoformat(),
+                'next_attempt_at': (datetime.datetime.fromtimestamp(row['next_attempt_at']).isoformat()
+                                    if row['next_attempt_at'] else None),
+            } for row in rows],
+        }
+
+    def purge_done(self, older_than_seconds: float = 7 * 24 * 3600) -> int:
+        """Xóa các thao tác đã hoàn tất lâu ngày khỏi journal."""
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM pending_writes WHERE status = 'done' AND done_at < ?",
+                                  (time.time() - older_than_seconds,))
+            return cursor.rowcount